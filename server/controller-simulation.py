@@ -1,22 +1,107 @@
 #!/usr/bin/env python3
 """
 Simulate the controller connection by sending packets over UDP. Used for
-testing the software agnostic of the hardware
+testing the software agnostic of the hardware.
+
+Run with no arguments for the interactive single-controller simulator, or
+with `load` to simulate many controllers at once and measure throughput, e.g.
+
+    python controller-simulation.py load --devices 20 --rate 200 --duration 30
+
+or with `replay` to play back a capture recorded by the server (with
+LUME_CAPTURE_DIR set), at the original speed, N times faster, or as fast as
+possible with --speed 0:
+
+    python controller-simulation.py replay captures/capture-20250101-120000.lcap --speed 2
 """
 
+import argparse
+import heapq
+import math
+import random
 import socket
+import struct
 import time
 import signal
 import sys
 import threading
 
+from shared.capture import read_capture
+
+SENSOR_FRAME_FORMAT = '<12fB'
+
+# Optional sequenced payload: the usual 12 floats and flex byte, followed by a
+# uint32 sequence number the server uses to count lost packets
+SEQUENCED_FRAME_FORMAT = '<12fBI'
+
+SENSOR_FRAME_STRUCT = struct.Struct(SENSOR_FRAME_FORMAT)
+SEQUENCED_FRAME_STRUCT = struct.Struct(SEQUENCED_FRAME_FORMAT)
+
+GRAVITY = 9.81
+
+
+class SyntheticController:
+    """
+    Generates plausible sensor frames for a single controller: slowly
+    wandering attitude with some hand tremor on top, gyro rates and
+    accelerometer readings consistent with it, and flex sensors that are
+    occasionally pressed. Every controller gets its own random phase, so
+    that simulated gloves do not all move in lockstep.
+    """
+
+    def __init__(self, rate: float, sequenced: bool = False, seed=None) -> None:
+        self.dt = 1.0 / rate
+        self.sequenced = sequenced
+        self.seq = 0
+        self.t = 0.0
+        self.rng = random.Random(seed)
+
+        # (amplitude in degrees, frequency in Hz, phase) for pitch, roll, yaw
+        self.motion = [(self.rng.uniform(10, 40), self.rng.uniform(0.1, 0.6),
+                        self.rng.uniform(0, 2 * math.pi)) for _ in range(3)]
+        self.tremor_hz = self.rng.uniform(6, 10)
+        self.flex = 0
+        self.last_attitude = self._attitude(-self.dt)
+
+    def _attitude(self, t: float):
+        tremor = 0.5 * math.sin(2 * math.pi * self.tremor_hz * t)
+        return [a * math.sin(2 * math.pi * f * t + ph) + tremor for a, f, ph in self.motion]
+
+    def next_frame(self) -> bytes:
+        """Produce the next frame, advancing simulated time by one sample"""
+        attitude = self._attitude(self.t)
+        d_attitude = [(a - b) / self.dt for a, b in zip(attitude, self.last_attitude)]
+        self.last_attitude = attitude
+
+        pitch, roll = math.radians(attitude[0]), math.radians(attitude[1])
+        noise = self.rng.gauss
+        acc = [-GRAVITY * math.sin(pitch) + noise(0, 0.05),
+               GRAVITY * math.sin(roll) * math.cos(pitch) + noise(0, 0.05),
+               GRAVITY * math.cos(roll) * math.cos(pitch) + noise(0, 0.05)]
+        gyro = [d + noise(0, 0.5) for d in d_attitude]
+
+        # Occasionally press or release one of the flex sensors
+        if self.rng.random() < 0.01:
+            self.flex ^= (0b10000000 >> self.rng.randrange(3))
+
+        values = attitude + d_attitude + acc + gyro
+        self.t += self.dt
+
+        if self.sequenced:
+            frame = SEQUENCED_FRAME_STRUCT.pack(*values, self.flex, self.seq)
+            self.seq = (self.seq + 1) & 0xFFFFFFFF
+            return frame
+        return SENSOR_FRAME_STRUCT.pack(*values, self.flex)
+
+
 class UDPSender:
-    def __init__(self, target_ip="127.0.0.1", target_port=12345, frequency=64):
+    def __init__(self, target_ip="127.0.0.1", target_port=12345, frequency=64, sequenced=False):
         self.target_ip = target_ip
         self.target_port = target_port
         self.frequency = frequency
         self.interval = 1.0 / frequency  # Time between packets in seconds
         self.running = False
+        self.generator = SyntheticController(frequency, sequenced=sequenced)
         
         # Create UDP socket
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
@@ -33,11 +118,9 @@ class UDPSender:
     def create_packet_data(self):
         """
         Create packet data - customize this method with your own data
-        Currently returns arbitrary bytes that you can replace
+        Currently returns synthetic sensor frames
         """
-        # Example arbitrary data - replace with your own
-        packet_data = b'0123456789012345678901234567890123456789012345678'  # "Hello!" in hex
-        return packet_data
+        return self.generator.next_frame()
     
     def send_packet(self):
         """Send a single UDP packet"""
@@ -62,17 +145,18 @@ class UDPSender:
         print("Press Ctrl+C to stop\n")
         
         try:
+            # Pace against absolute deadlines, so that time spent sending (or
+            # oversleeping) does not accumulate into drift
+            deadline = time.perf_counter()
             while self.running:
-                loop_start = time.time()
-                
                 # Send packet
                 bytes_sent = self.send_packet()
                 if bytes_sent:
                     packet_count += 1
                 
                 # Calculate sleep time to maintain frequency
-                loop_duration = time.time() - loop_start
-                sleep_time = self.interval - loop_duration
+                deadline += self.interval
+                sleep_time = deadline - time.perf_counter()
                 
                 if sleep_time > 0:
                     time.sleep(sleep_time)
@@ -120,20 +204,198 @@ class UDPSender:
             self.sock.close()
             print("Socket closed")
 
-def main():
-    # Configuration - modify these values as needed
-    TARGET_IP = "127.0.0.1"      # Correct for your Docker port mapping
-    TARGET_PORT = 8888           # Updated to match your tcpdump
-    FREQUENCY = 64               # Packets per second
-    
+class LoadGenerator:
+    """
+    Simulates many controllers at once to find the saturation point of the
+    server. Each device sends from its own socket (and so its own source
+    port, i.e. its own session on the server), at its own rate. Sends are
+    scheduled against absolute deadlines from a heap, so pacing does not
+    drift, and a device that falls behind catches up rather than losing
+    packets. Devices are spread across a number of sender threads.
+    """
+
+    def __init__(self, target_ip: str, target_port: int, devices: int, rate: float,
+                 duration: float = 0.0, threads: int = 1, sequenced: bool = False,
+                 report_interval: float = 1.0) -> None:
+        self.target = (target_ip, target_port)
+        self.devices = devices
+        self.rate = rate
+        self.duration = duration
+        self.threads = max(1, min(threads, devices))
+        self.sequenced = sequenced
+        self.report_interval = report_interval
+        self.running = False
+
+        self.sent = [0] * devices
+        self.errors = [0] * devices
+        self.late = [0] * devices
+        self.max_lag = [0.0] * devices
+
+    def _sender(self, device_ids) -> None:
+        """Send for a subset of devices from a single thread"""
+        interval = 1.0 / self.rate
+        socks = {}
+        generators = {}
+        schedule = []
+
+        start = time.perf_counter()
+        for n, d in enumerate(device_ids):
+            socks[d] = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            generators[d] = SyntheticController(self.rate, sequenced=self.sequenced, seed=d)
+            # Stagger the devices across one period, as real gloves would be
+            heapq.heappush(schedule, (start + interval * n / len(device_ids), d))
+
+        try:
+            while self.running:
+                deadline, d = schedule[0]
+                now = time.perf_counter()
+
+                if deadline > now:
+                    time.sleep(deadline - now)
+                    continue
+
+                lag = now - deadline
+                if lag > interval:
+                    self.late[d] += 1
+                self.max_lag[d] = max(self.max_lag[d], lag)
+
+                try:
+                    socks[d].sendto(generators[d].next_frame(), self.target)
+                    self.sent[d] += 1
+                except OSError:
+                    self.errors[d] += 1
+
+                heapq.heapreplace(schedule, (deadline + interval, d))
+        finally:
+            for sock in socks.values():
+                sock.close()
+
+    def run(self) -> None:
+        """Run until the duration elapses (or forever if it is 0), printing
+        the achieved throughput every report interval"""
+        self.running = True
+        shards = [list(range(self.devices))[i::self.threads] for i in range(self.threads)]
+        workers = [threading.Thread(target=self._sender, args=(shard,), daemon=True) for shard in shards]
+
+        print(f"Simulating {self.devices} controllers at {self.rate} Hz each "
+              f"({self.devices * self.rate:.0f} packets/s) to {self.target[0]}:{self.target[1]}, "
+              f"{self.threads} sender thread(s)")
+        print("Press Ctrl+C to stop\n")
+
+        start = time.perf_counter()
+        for worker in workers:
+            worker.start()
+
+        last_report, last_sent = start, 0
+        try:
+            while True:
+                time.sleep(self.report_interval)
+                now = time.perf_counter()
+                sent = sum(self.sent)
+                print(f"[{now - start:7.1f}s] {(sent - last_sent) / (now - last_report):9.1f} packets/s, "
+                      f"{sum(self.late)} late, {sum(self.errors)} errors")
+                last_report, last_sent = now, sent
+
+                if self.duration and now - start >= self.duration:
+                    break
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.running = False
+            for worker in workers:
+                worker.join()
+
+        elapsed = time.perf_counter() - start
+        total = sum(self.sent)
+        rates = [n / elapsed for n in self.sent]
+        print(f"\nLoad generation complete:")
+        print(f"Total packets sent: {total} in {elapsed:.2f} seconds")
+        print(f"Aggregate rate: {total / elapsed:.1f} packets/s (target {self.devices * self.rate:.0f})")
+        print(f"Per-device rate: min {min(rates):.2f} Hz, max {max(rates):.2f} Hz (target {self.rate} Hz)")
+        print(f"Late sends: {sum(self.late)}, send errors: {sum(self.errors)}, "
+              f"worst lag: {1000 * max(self.max_lag):.2f}ms")
+
+
+class CaptureReplayer:
+    """
+    Replays a raw UDP capture against the server, keeping the original
+    inter-arrival timing (scaled by `speed`, or none at all if speed is 0).
+    Each source address in the capture is replayed from its own socket, so
+    that multi-controller captures come back as separate sessions.
+    """
+
+    def __init__(self, path: str, target_ip: str, target_port: int, speed: float = 1.0,
+                 loops: int = 1) -> None:
+        self.path = path
+        self.target = (target_ip, target_port)
+        self.speed = speed
+        self.loops = loops
+
+    def run(self) -> None:
+        socks = {}
+        sent = 0
+        late = 0
+        max_lag = 0.0
+        span = 0.0
+
+        print(f"Replaying {self.path} to {self.target[0]}:{self.target[1]} "
+              f"at {'max speed' if self.speed <= 0 else f'{self.speed}x'}")
+        print("Press Ctrl+C to stop\n")
+
+        start = time.perf_counter()
+        try:
+            for _ in range(self.loops):
+                loop_start = time.perf_counter()
+                first = None
+
+                for timestamp, source, payload in read_capture(self.path):
+                    if first is None:
+                        first = timestamp
+                    span = timestamp - first
+
+                    # Absolute deadline relative to the start of this loop,
+                    # so timing errors do not accumulate over the replay
+                    if self.speed > 0:
+                        deadline = loop_start + span / self.speed
+                        now = time.perf_counter()
+                        if deadline > now:
+                            time.sleep(deadline - now)
+                        else:
+                            lag = now - deadline
+                            max_lag = max(max_lag, lag)
+                            if lag > 0.001:
+                                late += 1
+
+                    sock = socks.get(source)
+                    if sock is None:
+                        sock = socks[source] = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                    sock.sendto(payload, self.target)
+                    sent += 1
+
+        except KeyboardInterrupt:
+            pass
+        finally:
+            for sock in socks.values():
+                sock.close()
+
+        elapsed = time.perf_counter() - start
+        print(f"\nReplay complete:")
+        print(f"Total packets sent: {sent} from {len(socks)} source(s) in {elapsed:.2f} seconds")
+        print(f"Average rate: {sent / elapsed if elapsed > 0 else 0:.1f} packets/s, "
+              f"capture spans {span:.2f} seconds per loop")
+        if self.speed > 0:
+            print(f"Packets more than 1ms late: {late}, worst lag: {1000 * max_lag:.2f}ms")
+
+
+def interactive(target_ip: str, target_port: int, frequency: float, sequenced: bool):
     print("Docker UDP Communication:")
     print(f"Your container mapping: 0.0.0.0:8888->8888/udp")
-    print(f"Sending to: {TARGET_IP}:{TARGET_PORT}")
+    print(f"Sending to: {target_ip}:{target_port}")
     print()
     
     # Create and start sender to send arbitrary packets in the background in
     # order to keep the UDPServer happy on the server side
-    sender = UDPSender(TARGET_IP, TARGET_PORT, FREQUENCY)
+    sender = UDPSender(target_ip, target_port, frequency, sequenced=sequenced)
     sender_thread = threading.Thread(target=sender.start, daemon=True)
     sender_thread.start()
 
@@ -142,5 +404,44 @@ def main():
     # Now allow the user to test using the control commands
     sender.send_control_commands()
 
+def main():
+    # Configuration - modify these values as needed
+    TARGET_IP = "127.0.0.1"      # Correct for your Docker port mapping
+    TARGET_PORT = 8888           # Updated to match your tcpdump
+    FREQUENCY = 64               # Packets per second
+    SEQUENCED = False            # Append a sequence number for loss tracking
+
+    parser = argparse.ArgumentParser(description="Simulate Lume controllers over UDP")
+    parser.add_argument("--ip", default=TARGET_IP, help="server address")
+    parser.add_argument("--port", type=int, default=TARGET_PORT, help="server UDP port")
+    parser.add_argument("--sequenced", action="store_true", default=SEQUENCED,
+                        help="append a sequence number to every frame")
+    modes = parser.add_subparsers(dest="mode")
+
+    single = modes.add_parser("interactive", help="one controller plus control commands (default)")
+    single.add_argument("--rate", type=float, default=FREQUENCY, help="packets per second")
+
+    load = modes.add_parser("load", help="many controllers, reporting throughput")
+    load.add_argument("--devices", type=int, default=10, help="number of simulated controllers")
+    load.add_argument("--rate", type=float, default=FREQUENCY, help="packets per second per controller")
+    load.add_argument("--duration", type=float, default=0.0, help="seconds to run for, 0 for no limit")
+    load.add_argument("--threads", type=int, default=1, help="number of sender threads")
+
+    replay = modes.add_parser("replay", help="play back a raw UDP capture")
+    replay.add_argument("file", help="capture file recorded by the server")
+    replay.add_argument("--speed", type=float, default=1.0,
+                        help="playback speed multiplier, 0 for as fast as possible")
+    replay.add_argument("--loops", type=int, default=1, help="number of times to play the capture")
+
+    args = parser.parse_args()
+
+    if args.mode == "replay":
+        CaptureReplayer(args.file, args.ip, args.port, speed=args.speed, loops=args.loops).run()
+    elif args.mode == "load":
+        LoadGenerator(args.ip, args.port, args.devices, args.rate, duration=args.duration,
+                      threads=args.threads, sequenced=args.sequenced).run()
+    else:
+        interactive(args.ip, args.port, getattr(args, "rate", FREQUENCY), args.sequenced)
+
 if __name__ == "__main__":
     main()
@@ -1,174 +1,438 @@
 """Database for storing training data"""
 
+import argparse
+import collections
+import os
+import queue
+import threading
 import psycopg2
 import sys
 import redis
-import json
 import time 
+import numpy as np
 
 from shared.lume_logger import *
 from shared.config import config
-from shared.packer import unpack_binary
-
-# define constants
-USERS_TABLE = "users"
-GESTURES_TABLE = "gestures"
+from shared.packer import WireDecoder, WireHeader, unpack_record_control
+from shared.gestures import CopyRows, gesture_copy_row, read_recording, recording_user, save_recording
+from shared.metrics import LatencyTracker
+from shared import database
+from shared.database import GESTURES_TABLE, GESTURE_INSERT_COLUMNS
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+# Frames kept from before a recording starts, since frames from just after
+# the start time can arrive ahead of the start message
+RECORD_LOOKBACK = 256
+# Longest to wait after a stop message for the frames up to the stop time
+RECORD_STOP_GRACE = 0.5
+
+# How long a wait for messages blocks, and how often to check on a stop
+MESSAGE_TIMEOUT = 1.0
+STOP_POLL_INTERVAL = 0.05
+
+# How often a wait for room in the write queue checks the writer is alive
+WRITER_CHECK_INTERVAL = 1.0
 
 # define globals
 running = True
 
 
+class GestureRecorder:
+    """
+    Cuts gestures out of the stream of feature frames using the in-band
+    start and stop messages. A frame belongs to a gesture if the timestamp
+    of its newest sample lies between the start and stop times, whether it
+    arrives before the start message or after the stop message (the
+    post-processor publishes a little behind the sockets server), so no
+    frames are lost at the start and none leak in after the stop. Bare
+    packets have no timestamp, so for those the gesture is simply whatever
+    arrives between the two messages.
+
+    Every method that can complete a gesture returns it as a (list of
+    frames, packet layout) tuple, and None otherwise.
+    """
+
+    def __init__(self) -> None:
+        self.decoder = WireDecoder()
+        self.recent = collections.deque(maxlen=RECORD_LOOKBACK)
+        self.timestamped = False
+
+        self.start_time = None
+        self.stop_time = None
+        self.stop_deadline = 0.0
+        self.frames = []
+        self.times = []
+        self.layout = None
+
+    @property
+    def recording(self) -> bool:
+        return self.start_time is not None
+
+    @property
+    def stopping(self) -> bool:
+        return self.stop_time is not None
+
+    def start(self, timestamp: float) -> Optional[Tuple[List[np.ndarray], int]]:
+        # A second start without a stop ends the previous gesture there
+        finished = self.finish() if self.recording else None
+
+        self.start_time = timestamp
+        for header, values in self.recent:
+            self._add(header, values)
+        self.recent.clear()
+        return finished
+
+    def stop(self, timestamp: float) -> Optional[Tuple[List[np.ndarray], int]]:
+        if not self.recording:
+            return None
+        self.stop_time = timestamp
+        self.stop_deadline = time.monotonic() + RECORD_STOP_GRACE
+
+        # Without timestamps there is nothing more to wait for
+        return self.poll() if self.timestamped else self.finish()
+
+    def frame(self, data: bytes) -> Optional[Tuple[List[np.ndarray], int]]:
+        decoded = self.decoder.decode(data)
+        if decoded is None:
+            return None  # waiting for a keyframe after a missed frame
+        header, values = decoded
+        self.timestamped = header.version != 0
+
+        if not self.recording:
+            self.recent.append(decoded)
+            return None
+
+        # The first frame from after the stop time completes the gesture
+        if self.stopping and (not self.timestamped or header.timestamp >= self.stop_time):
+            finished = self.finish()
+            self.recent.append(decoded)
+            return finished
+
+        self._add(header, values)
+        return None
+
+    def poll(self) -> Optional[Tuple[List[np.ndarray], int]]:
+        """Complete a stopped gesture whose last frames never showed up"""
+        if self.stopping and time.monotonic() >= self.stop_deadline:
+            return self.finish()
+        return None
+
+    def finish(self) -> Optional[Tuple[List[np.ndarray], int]]:
+        """End the current gesture, returning it if it has any frames"""
+        frames = self.frames
+        if self.stopping and self.timestamped:
+            # Drop anything from after the stop that arrived ahead of it
+            frames = [f for f, t in zip(frames, self.times) if t < self.stop_time]
+        finished = (frames, self.layout) if frames else None
+
+        self.start_time = None
+        self.stop_time = None
+        self.frames = []
+        self.times = []
+        self.layout = None
+        return finished
+
+    def _add(self, header: WireHeader, values: np.ndarray) -> None:
+        if header.version and header.timestamp < self.start_time:
+            return  # from before the start
+        if not self.frames:
+            self.layout = header.layout
+        elif header.layout != self.layout:
+            return  # the layout cannot change within a gesture
+        self.frames.append(values)
+        self.times.append(header.timestamp)
+
+
+class GestureWriter(threading.Thread):
+    """
+    Write-behind for recorded gestures. The recording loop hands finished
+    gestures to submit() and carries on listening, while this thread writes
+    them through a connection borrowed from the shared pool, batching
+    whatever has queued up into one transaction. The queue is bounded, so a
+    database that cannot keep up eventually holds up recording rather than
+    eating memory. Failed writes are retried with exponential backoff, on a
+    fresh connection if the old one went bad, and gestures that still cannot
+    be written are spooled to recording files which can be imported later
+    with --import. The queue depth, flush latency and counts are kept in the
+    REDIS_DB_STATS_KEY hash.
+    """
+
+    def __init__(self, redisconn: redis.client.Redis, logger: logging.Logger) -> None:
+        super().__init__(name="gesture-writer", daemon=True)
+        self.redisconn = redisconn
+        self.logger = logger
+        self.queue = queue.Queue(maxsize=config.LUME_DB_WRITE_QUEUE_SIZE)
+
+        self.flush_latency = LatencyTracker("gesture flush latency")
+        self.written = 0
+        self.retries = 0
+        self.spooled = 0
+
+    def submit(self, gesture: str, user_id: str, frames: np.ndarray, layout: int) -> None:
+        """Queue a gesture to be written, waiting for room if the queue is
+        full. Raises RuntimeError if the writer has stopped"""
+        item = (gesture, user_id, frames, layout)
+        if not self.is_alive():
+            raise RuntimeError("Gesture writer has stopped")
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            self.logger.warning("Gesture write queue is full, waiting for the database to catch up")
+            self._put(item)
+        self.report()
+
+    def close(self) -> None:
+        """Write everything still queued, then stop"""
+        if not self.is_alive():
+            self.logger.error(f"Gesture writer had stopped, {self.queue.qsize()} queued gestures were not written")
+            return
+        try:
+            self._put(None)
+        except RuntimeError:
+            pass  # stopped in the meantime, which join() returns on straight away
+        self.join()
+
+    def _put(self, item) -> None:
+        """Block until there is room for `item`, giving up if the writer
+        stops, since the queue would then never drain"""
+        while True:
+            try:
+                self.queue.put(item, timeout=WRITER_CHECK_INTERVAL)
+                return
+            except queue.Full:
+                if not self.is_alive():
+                    raise RuntimeError("Gesture writer has stopped")
+
+    def run(self) -> None:
+        stopping = False
+        while not stopping:
+            batch = []
+            item = self.queue.get()
+
+            # Take everything else that has queued up meanwhile as well
+            while True:
+                if item is None:
+                    stopping = True
+                else:
+                    batch.append(item)
+                try:
+                    item = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+
+            # Nothing may end the thread early, or the queue stops draining
+            try:
+                if batch:
+                    self.write(batch)
+                self.report()
+            except Exception:
+                self.logger.exception(f"Lost {len(batch)} gestures that could be neither written nor spooled")
+
+    def write(self, batch: List[Tuple[str, str, np.ndarray, int]]) -> None:
+        start = time.perf_counter()
+
+        for attempt in range(config.LUME_DB_WRITE_RETRIES + 1):
+            if attempt:
+                self.retries += 1
+                time.sleep(config.LUME_DB_RETRY_DELAY * 2 ** (attempt - 1))
+            try:
+                with database.connection() as conn, conn.cursor() as cursor:
+                    database.insert_gestures(cursor, batch)
+
+                self.written += len(batch)
+                elapsed = self.flush_latency.record_since(start)
+                self.logger.debug(f"Wrote {len(batch)} gestures in {1000.0 * elapsed:.1f}ms")
+                return
+            except psycopg2.Error as e:
+                self.logger.warning(f"Failed to write {len(batch)} gestures (attempt {attempt + 1}): {e}")
+            except Exception:
+                # Not something a retry would fix
+                self.logger.exception(f"Failed to write {len(batch)} gestures")
+                break
+
+        self.spool(batch)
+
+    def spool(self, batch: List[Tuple[str, str, np.ndarray, int]]) -> None:
+        """Save gestures that could not be written, one recording file per
+        user and layout"""
+        os.makedirs(config.LUME_DB_SPOOL_DIR, exist_ok=True)
+        groups = {}
+        for gesture, user_id, frames, layout in batch:
+            groups.setdefault((user_id, layout), []).append((gesture, frames))
+
+        stamp = time.strftime("%Y%m%d-%H%M%S")
+        for i, ((user_id, layout), gestures) in enumerate(groups.items()):
+            path = os.path.join(config.LUME_DB_SPOOL_DIR, f"gestures-{stamp}-{self.spooled + i}.npz")
+            save_recording(path, user_id, layout, gestures)
+            self.logger.error(f"Gave up writing {len(gestures)} gestures, saved to {Fore.CYAN}{path}{Style.RESET_ALL}")
+        self.spooled += len(groups)
+
+    def report(self) -> None:
+        stats = {
+            'queue_depth': self.queue.qsize(),
+            'written': self.written,
+            'retries': self.retries,
+            'spooled_files': self.spooled,
+        }
+        summary = self.flush_latency.summary(reset=False)
+        if summary is not None:
+            stats.update({f"flush_{k}": v for k, v in summary.items()})
+        try:
+            self.redisconn.hset(config.REDIS_DB_STATS_KEY, mapping=stats)
+        except redis.RedisError as e:
+            self.logger.debug(f"Could not publish training DB stats: {e}")
+
+
 class TrainingDatabase:
 
     def __init__(self, user: str, redisconn: redis.client.Redis, verbose: bool = False) -> None:
-        # Establish connection
-        self.conn = psycopg2.connect(
-            database=config.PG_DB_NAME,
-            host=config.PG_DB_HOST,
-            user=config.PG_DB_USER,
-            password=config.PG_DB_PASS,
-            port=config.PG_DB_PORT
-        )
-
-        # Init cursor
-        self.cursor = self.conn.cursor()
-
         # Initialise redis connection
         self.redisconn = redisconn
 
         # Setup coloured logging
         self._setup_colored_logging(verbose)
-    
-        # Check if the USERS table exists: 
-        if not self.table_exists(USERS_TABLE):
-
-            # Warn if not
-            self.logger.info(f"{Fore.CYAN}USERS TABLE HAS NOT BEEN FOUND - CREATING NEW ONE.{Style.RESET_ALL}")
-
-            # Create the table if not
-            self.cursor.execute(f"""
-            CREATE TABLE IF NOT EXISTS {USERS_TABLE}(
-                id TEXT PRIMARY KEY
-            )
-            """)
-
-        # Check if the user exists in the table. If they do not, create. 
-        if not self.user_exists(user):
-            self.logger.info(f"{Fore.CYAN}USER {user} DOES NOT EXIST. Creating new entry.{Style.RESET_ALL}")
-            self.insert_user(user)
-
-        # Check if the GESTURES table exists:
-        if not self.table_exists(GESTURES_TABLE):
-            # Warn if not
-            self.logger.info(f"{Fore.CYAN}GESTURES TABLE HAS NOT BEEN FOUND - CREATING NEW ONE.{Style.RESET_ALL}")
-
-            # Define the gestures enum type if it does not already exist
-            self.cursor.execute("""
-            DO $$
-            BEGIN
-                IF NOT EXISTS (SELECT 1 FROM pg_type WHERE typname = 'gesture_type') THEN
-                    CREATE TYPE gesture_type AS ENUM ('takeoff', 'land', 'action_1', 'action_2', 'action_3');
-                END IF;
-            END $$
-            """)
-
-            # Create the table if not found
-            self.cursor.execute(f"""
-            CREATE TABLE IF NOT EXISTS {GESTURES_TABLE}(
-                id SERIAL PRIMARY KEY,
-                gesture gesture_type,
-                user_id TEXT REFERENCES users(id) ON DELETE CASCADE,
-                data JSONB
-            )
-            """)
-        
 
-    def table_exists(self, table_name: str) -> bool: 
-        """Check if a table exists in the LUME database"""
-        self.cursor.execute(f"""
-        SELECT EXISTS (
-            SELECT FROM information_schema.tables
-            WHERE table_schema = 'public' AND table_name = '{table_name}'
-        )
-        """)
-        return self.cursor.fetchone()[0]
-
-    def user_exists(self, id: str) -> bool: 
-        """Check if a user exists in the users table"""
-        self.cursor.execute(f"SELECT 1 FROM {USERS_TABLE} WHERE id = '{id}' LIMIT 1")
-        return self.cursor.fetchone() is not None
+        # Make sure the user exists. The first pooled connection also creates
+        # or migrates the schema if needed (see shared/database.py)
+        self.insert_user(user)
 
     def insert_user(self, id: str):
-        """Insert a new user into the users table"""
-        self.cursor.execute(f"INSERT INTO {USERS_TABLE} (id) VALUES ('{id}')")
-        self.conn.commit()
+        """Insert a new user into the users table, if they do not exist yet"""
+        self.insert_users([id])
+
+    def insert_users(self, ids: Iterable[str]) -> None:
+        """Insert any of `ids` that are not already in the users table"""
+        with database.connection() as conn, conn.cursor() as cursor:
+            database.insert_users(cursor, ids)
+
+    def insert_gesture(self, gesture: str, user_id: str, frames: np.ndarray, layout: int):
+        """Insert a new gesture into the gestures table, given its frames as
+        a (frames, features) array in the order of packet layout `layout`"""
+        self.insert_gestures([(gesture, user_id, frames, layout)])
+
+    def insert_gestures(self, gestures: List[Tuple[str, str, np.ndarray, int]]) -> bool:
+        """
+        Insert (gesture, user, frames, layout) tuples, all in one
+        transaction, creating any users that do not exist yet. Returns False,
+        having rolled back, if the write failed
+        """
+        if not gestures:
+            return True
 
-    def insert_gesture(self, gesture: str, user_id: str, data):
-        """Insert a new gesture into the gestures table"""
         try:
-            self.cursor.execute(f"""
-            INSERT INTO {GESTURES_TABLE} (gesture, user_id, data)
-            VALUES ('{gesture}', '{user_id}', '{json.dumps(data)}') 
-            """)
-            self.conn.commit()
-        except Exception as e:
+            with database.connection() as conn, conn.cursor() as cursor:
+                database.insert_gestures(cursor, gestures)
+            return True
+        except psycopg2.Error as e:
             self.logger.error(f"Postgres error: {e}")
-            self.conn.rollback()
+            return False
+
+    def import_recordings(self, paths: List[str]) -> int:
+        """
+        Bulk import recording files (see shared/gestures.py) with COPY, all
+        in a single transaction, so a back-fill either lands completely or
+        not at all. The rows are encoded lazily as the COPY reads them.
+        Returns the number of gestures imported
+        """
+        count = 0
+
+        def rows() -> Iterator[str]:
+            nonlocal count
+            for path in paths:
+                for gesture, user_id, frames, layout in read_recording(path):
+                    count += 1
+                    yield gesture_copy_row(gesture, user_id, frames, layout)
+                self.logger.info(f"Read {Fore.CYAN}{path}{Style.RESET_ALL}")
 
-    def flush_gesture(self, buffer, gesture):
-        """Flush the current gesture stored into the training DB"""
+        try:
+            with database.connection() as conn, conn.cursor() as cursor:
+                database.insert_users(cursor, (recording_user(path) for path in paths))
+                cursor.copy_expert(f"COPY {GESTURES_TABLE} ({GESTURE_INSERT_COLUMNS}) FROM STDIN", CopyRows(rows()))
+        except psycopg2.Error as e:
+            self.logger.error(f"Postgres error, nothing was imported: {e}")
+            return 0
+
+        self.logger.info(f"Imported {Fore.CYAN}{count}{Style.RESET_ALL} gestures from {len(paths)} recordings")
+        return count
+
+    def flush_gesture(self, buffer, gesture, layout):
+        """Hand the current gesture to the writer, to be flushed into the
+        training DB in the background"""
         try:
             # Get the current user
             user = self.redisconn.get(config.REDIS_UID_VARIABLE)
             user = user.decode('utf-8') if isinstance(user, bytes) else user
-            self.insert_gesture(gesture, str(user), buffer)
+            self.writer.submit(gesture, str(user), np.stack(buffer), layout)
             self.logger.info(f"Recorded {Fore.CYAN}{len(buffer)}{Style.RESET_ALL}" \
                             f" readings as gesture {Fore.CYAN}{gesture.upper()}{Style.RESET_ALL}" \
-                            f" to database for user {Fore.CYAN}{user}{Style.RESET_ALL}")
+                            f" for user {Fore.CYAN}{user}{Style.RESET_ALL}")
         except Exception:
-            self.logger.error("Failed to write gesture to training database")
+            self.logger.error("Failed to queue gesture for the training database")
+
 
+    def recorder_for(self, recorders: Dict[bytes, GestureRecorder], channel: bytes) -> GestureRecorder:
+        """The recorder for a sensors channel, created on its first message.
+        A new recorder picks up a recording that was already under way, going
+        by the record variable of the channel's controller session"""
+        recorder = recorders.get(channel)
+        if recorder is None:
+            recorder = recorders[channel] = GestureRecorder()
+
+            prefix = config.REDIS_SENSORS_CHANNEL.encode('utf-8')
+            session_id = channel[len(prefix) + 1:].decode('utf-8') if channel != prefix else None
+            rg = self.redisconn.get(config.get_session_key(config.REDIS_RECORD_VARIABLE, session_id))
+            if (rg.decode('utf-8') if isinstance(rg, bytes) else rg) == '1':
+                recorder.start(time.time())
+        return recorder
 
     def run(self, gesture: str) -> None:
-        # Listen on the sensors topic for data
+        # Listen on the sensors topic for data, and for the recording control
+        # messages that sockets.py publishes in band on the same channel. With
+        # several controllers (the async ingest server, or sharded
+        # post-processing) each session has its own 'sensors:<session>'
+        # channel, so those are listened on too, with a recorder per channel
         global running
-        channel = 'sensors'
+        channel = config.REDIS_SENSORS_CHANNEL
+        session_channels = config.get_session_key(channel, '*')
         sensors_subscription = self.redisconn.pubsub()
         sensors_subscription.subscribe(channel)
+        sensors_subscription.psubscribe(session_channels)
+
+        self.logger.info(f"Listening for gestures on {channel} and {session_channels}")
 
-        self.logger.info(f"Listening for gestures on {channel}")
+        # Gestures are written in the background, so that a slow database
+        # does not hold up the subscription
+        self.writer = GestureWriter(self.redisconn, self.logger)
+        self.writer.start()
 
-        buffer = []
-        # Controlled by redis!!
-        record_gesture = False
+        recorders: Dict[bytes, GestureRecorder] = {}
+        self.recorder_for(recorders, channel.encode('utf-8'))
 
         try:
             while running:
-                # Check if time to record a gesture (controlled by sockets.py)
-                rg = self.redisconn.get(config.REDIS_RECORD_VARIABLE)
-                record_gesture = (rg.decode('utf-8') if isinstance(rg, bytes) else rg) == '1'
-                recording = False  # Used to only flush gesture once after finishing recording
-
-                while record_gesture:
-                    recording = True
-                    # Update redis-held control variable
-                    rg = self.redisconn.get(config.REDIS_RECORD_VARIABLE)
-                    record_gesture = (rg.decode('utf-8') if isinstance(rg, bytes) else rg) == '1'
-
-                    msg = sensors_subscription.get_message(ignore_subscribe_messages=True, timeout=0.01)
-
-                    if msg:
-                        data = unpack_binary(msg['data'])
-                        buffer.append(data)
-                        print(data)
-
-                if recording:
-                    # Flush the data to the db when finished
-                    self.flush_gesture(buffer, gesture)
-                    buffer.clear()
-                    recording = False
-
-                time.sleep(0.05)
+                # Blocks until a message arrives, only waking up regularly
+                # while a stop is waiting on its last frames
+                stopping = any(r.stopping for r in recorders.values())
+                timeout = STOP_POLL_INTERVAL if stopping else MESSAGE_TIMEOUT
+                msg = sensors_subscription.get_message(ignore_subscribe_messages=True, timeout=timeout)
+
+                if msg:
+                    recorder = self.recorder_for(recorders, msg['channel'])
+                    control = unpack_record_control(msg['data'])
+                    if control is None:
+                        finished = recorder.frame(msg['data'])
+                    elif control[0]:
+                        self.logger.info(f"Recording gesture on {msg['channel'].decode('utf-8')}...")
+                        finished = recorder.start(control[1])
+                    else:
+                        finished = recorder.stop(control[1])
+                    if finished is not None:
+                        self.flush_gesture(finished[0], gesture, finished[1])
+
+                for recorder in recorders.values():
+                    finished = recorder.poll()
+                    if finished is not None:
+                        self.flush_gesture(finished[0], gesture, finished[1])
 
         except KeyboardInterrupt:
             logging.info("Shutting down gracefully...")
@@ -178,8 +442,11 @@ class TrainingDatabase:
         except Exception as e:
             logging.error(f"Unexpected error: {e}")
         finally:
-            if buffer:
-                self.flush_gesture(buffer, gesture)
+            for recorder in recorders.values():
+                finished = recorder.finish()
+                if finished is not None:
+                    self.flush_gesture(finished[0], gesture, finished[1])
+            self.writer.close()
     
     def _setup_colored_logging(self, verbose: bool):
         """Set up colored logging for the application."""
@@ -205,17 +472,21 @@ class TrainingDatabase:
         if not COLORS_AVAILABLE:
             self.logger.warning("colorama not installed. For colored logs, install with: pip install colorama")
 
-
-    def __del__(self) -> None:
-        # Close the database
-        self.conn.commit()
-        self.cursor.close()
-        self.conn.close()
-
 if __name__ == "__main__":
 
+    parser = argparse.ArgumentParser(description="Training database for recorded gestures")
+    parser.add_argument('--import', dest='recordings', nargs='+', metavar='RECORDING',
+                        help="bulk import recording files (.npz) and exit")
+    args = parser.parse_args()
+
     redisconn = redis.Redis(host=config.REDIS_HOST, port=config.REDIS_PORT, db=0, decode_responses=False)
 
+    if args.recordings:
+        db = TrainingDatabase(user="nl621", redisconn=redisconn, verbose=config.LUME_VERBOSE)
+        imported = db.import_recordings(args.recordings)
+        database.close_pool()
+        sys.exit(0 if imported else 1)
+
     # Get the run mode, only spin up the database if we are going to be recording gestures
 
     run_mode = str(redisconn.get(config.LUME_RUN_MODE)).lower()
@@ -224,3 +495,4 @@ if __name__ == "__main__":
         db = TrainingDatabase(user="nl621", redisconn=redisconn, verbose=config.LUME_VERBOSE)
         # TODO: set correct action based on frontend
         db.run("action_1")
+        database.close_pool()
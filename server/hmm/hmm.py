@@ -4,7 +4,6 @@ Enhanced definitions for the hidden markov model (HMM) to be used in gesture rec
 with improved feature selection, preprocessing, and model selection
 """
 
-import psycopg2
 import redis
 import sys
 import numpy as np
@@ -18,6 +17,8 @@ from collections import Counter
 
 from shared.lume_logger import *
 from shared.config import config
+from shared.gestures import gesture_array
+from shared import database
 
 class LumeHMM:
     def __init__(self, redisconn: redis.client.Redis, verbose: bool = False) -> None:
@@ -27,8 +28,6 @@ class LumeHMM:
 
         # Variables that may or may not be initialised depending on the system mode
         self.training_data = {}
-        self.conn = None
-        self.cursor = None
         
         # Model config parameters - these can be tuned
         self.n_components = 7  
@@ -45,28 +44,12 @@ class LumeHMM:
         self.smoothing_window = 5
     
     def load_training_data(self) -> None: 
-        # Establish the connection to the postgres database - note this is
-        # only done if we are loading training data, since we don't want to
-        # call this every time the system is being deployed. 
-        self.conn = psycopg2.connect(
-            database=config.PG_DB_NAME,
-            host=config.PG_DB_HOST,
-            user=config.PG_DB_USER,
-            password=config.PG_DB_PASS,
-            port=config.PG_DB_PORT
-        )
-
-        self.cursor = self.conn.cursor()
-
+        # The postgres connection is only taken from the pool if we are
+        # loading training data, since we don't want to connect every time
+        # the system is being deployed. 
         training_data = {}
         self.test_data = {}
 
-        training_data['takeoff'] = self.get_gesture('takeoff')
-        training_data['land'] = self.get_gesture('land')
-        training_data['action_1'] = self.get_gesture('action_1')
-        # training_data['action_2'] = self.get_gesture('action_2')
-        training_data['action_3'] = self.get_gesture('action_3')
-        
         # Feature keys
         keys = [
             'pitch', 'roll', 'yaw',
@@ -82,18 +65,17 @@ class LumeHMM:
         ]
         self.feature_keys = keys
 
-        for gesture in training_data:
-            # Unpack the tuples
-            unpacked_data = training_data.copy()
-            unpacked_data[gesture] = [frame[0] for frame in training_data[gesture]]
-            training_data = unpacked_data
+        training_data['takeoff'] = self.get_gesture('takeoff')
+        training_data['land'] = self.get_gesture('land')
+        training_data['action_1'] = self.get_gesture('action_1')
+        # training_data['action_2'] = self.get_gesture('action_2')
+        training_data['action_3'] = self.get_gesture('action_3')
 
+        for gesture in training_data:
             np_sequences = []
-            for sequence in training_data[gesture]:
-                if sequence:
-                    feature_vectors = [[frame[k] for k in keys] for frame in sequence]
-                    np_sequence = np.array(feature_vectors)
-                    
+            # Samples are streamed in from the database as they are needed
+            for np_sequence in training_data[gesture]:
+                if len(np_sequence):
                     # Apply smoothing if enabled
                     if self.apply_smoothing:
                         np_sequence = self._apply_smoothing(np_sequence)
@@ -491,13 +473,13 @@ class LumeHMM:
             setattr(self, param, value)
 
     def get_gesture(self, gesture : str):
-        """Retrieve all the gesture samples for a specific gesture"""
-        if self.cursor is not None:
-            self.cursor.execute(f"""SELECT data FROM gestures
-                                    WHERE gesture = '{gesture}'""")
-            return self.cursor.fetchall() 
-        else: 
-            self.logger.error("pSQL cursor does not exist, operation failed")
+        """Stream all the gesture samples for a specific gesture, as one
+        (frames, feature keys) float32 array per sample. Rows are fetched in
+        batches through a server-side cursor and converted one at a time, so
+        only a batch of raw rows is ever held in memory"""
+        with database.connection() as conn:
+            for row in database.stream_gestures(conn, gesture, config.LUME_DB_FETCH_SIZE):
+                yield gesture_array(row, self.feature_keys)
 
     def _setup_colored_logging(self, verbose: bool):
         """Set up colored logging for the application."""
@@ -0,0 +1,366 @@
+#!/usr/bin/env python3
+"""
+Feature extraction for the post-processor. The statistics published on the
+'sensors' channel (means and variances of the accelerometer and gyro axes,
+and the energy of each) are all functions of the running sums of x and x^2
+over the window, so rather than recomputing them from the whole window for
+every new sample, SlidingWindowStats keeps those sums and updates them in
+O(1) as samples enter and leave.
+
+window_features() computes the same packet from scratch for a whole window
+(or a batch of windows, e.g. one per controller) in a handful of NumPy
+reductions, and pack_features() writes packets straight into a buffer in
+the same layout as pack_binary().
+
+Packet layout version 2 (see shared/packer.py) adds spectral features per
+axis: the dominant frequency, the spectral centroid, and the energy in a few
+frequency bands. The streaming engine keeps these up to date with a sliding
+DFT, which costs O(window / 2) per sample rather than a full FFT.
+"""
+
+from typing import Optional
+import numpy as np
+
+from shared.frames import CHANNEL_INDEX, SENSOR_CHANNELS
+from shared.packer import PACKET_LAYOUTS, PACKET_DTYPES, SPECTRAL_AXES, SPECTRAL_FEATURES, pack_array
+
+# Layout of the (version 1) feature packet published on the 'sensors'
+# channel, i.e. the input to pack_binary()
+PACKET_FIELDS = PACKET_LAYOUTS[1]
+
+PACKET_LENGTH = len(PACKET_FIELDS)
+
+# Channels the window statistics are computed over. These sit next to each
+# other in SENSOR_CHANNELS, so they can also be taken as a slice (a view)
+STAT_CHANNELS = ['acc_x', 'acc_y', 'acc_z', 'gy_x', 'gy_y', 'gy_z']
+STAT_INDEX = np.array([CHANNEL_INDEX[c] for c in STAT_CHANNELS])
+STAT_SLICE = slice(CHANNEL_INDEX['acc_x'], CHANNEL_INDEX['gy_z'] + 1)
+
+# The spectral features are computed over the same axes
+assert SPECTRAL_AXES == STAT_CHANNELS
+
+# Frequency bands for the band energy features, in Hz: broad voluntary
+# movement, tremor and oscillation, and everything above
+SPECTRAL_BANDS = [('band_low', 0.0, 3.0),
+                  ('band_mid', 3.0, 12.0),
+                  ('band_high', 12.0, np.inf)]
+
+_DOM_FREQ = SPECTRAL_FEATURES.index('dom_freq')
+_CENTROID = SPECTRAL_FEATURES.index('centroid')
+_BANDS = np.array([SPECTRAL_FEATURES.index(name) for name, _, _ in SPECTRAL_BANDS])
+
+
+class PacketLayout:
+    """Where each feature goes in the flat packet of a given layout version"""
+
+    def __init__(self, version: int) -> None:
+        fields = PACKET_LAYOUTS[version]
+        self.version = version
+        self.fields = fields
+        self.length = len(fields)
+
+        self.latest_src = np.array([CHANNEL_INDEX[c] for c in fields if c in CHANNEL_INDEX])
+        self.latest_dst = np.array([i for i, c in enumerate(fields) if c in CHANNEL_INDEX])
+        self.mean_dst = np.array([fields.index(f"{c}_mean") for c in STAT_CHANNELS])
+        self.var_dst = np.array([fields.index(f"{c}_var") for c in STAT_CHANNELS])
+        self.acc_energy = fields.index('acc_energy')
+        self.gy_energy = fields.index('gy_energy')
+
+        # (axes, spectral features) grid of packet indices, if there are any
+        self.spectral = f"{SPECTRAL_AXES[0]}_{SPECTRAL_FEATURES[0]}" in fields
+        self.spectral_dst = None
+        if self.spectral:
+            self.spectral_dst = np.array([[fields.index(f"{axis}_{feature}") for feature in SPECTRAL_FEATURES]
+                                          for axis in SPECTRAL_AXES])
+
+        # Binary layout of the packed packet: every feature as a float32,
+        # then the flex bits in one byte
+        self.dtype = PACKET_DTYPES[version]
+
+
+LAYOUTS = {version: PacketLayout(version) for version in PACKET_LAYOUTS}
+
+PACKET_DTYPE = LAYOUTS[1].dtype
+PACKET_SIZE = PACKET_DTYPE.itemsize  # 105 bytes
+
+
+def band_weights(freqs: np.ndarray, n: int) -> np.ndarray:
+    """
+    (bins, bands) matrix that turns the one-sided power spectrum |X_k|^2 of
+    an n sample window into the energy in each of SPECTRAL_BANDS. The scaling
+    follows Parseval, so the bands add up to the window's energy about its
+    mean (sum of (x - mean)^2)
+    """
+    # Each bin stands in for its negative frequency twin too, bar Nyquist
+    scale = np.full(len(freqs), 2.0 / n)
+    if n % 2 == 0:
+        scale[-1] = 1.0 / n
+
+    weights = np.zeros((len(freqs), len(SPECTRAL_BANDS)))
+    for b, (_, low, high) in enumerate(SPECTRAL_BANDS):
+        weights[:, b] = ((freqs >= low) & (freqs < high)) * scale
+    return weights
+
+
+def spectral_features(power: np.ndarray, freqs: np.ndarray, weights: np.ndarray,
+                      out: np.ndarray) -> np.ndarray:
+    """
+    Fill `out`, shaped (..., axes, SPECTRAL_FEATURES), from the one-sided
+    power spectra `power`, shaped (..., axes, bins), with the DC bin left out
+    """
+    total = power.sum(axis=-1)
+    safe_total = np.where(total > 0, total, 1.0)
+
+    out[..., _DOM_FREQ] = freqs[np.argmax(power, axis=-1)]
+    out[..., _CENTROID] = (power @ freqs) / safe_total
+    out[..., _BANDS] = power @ weights
+    return out
+
+
+class SlidingDFT:
+    """
+    Sliding DFT of the statistics channels over the window. For an oldest
+    first window of N samples, bin k is updated as a sample enters and the
+    oldest leaves with
+
+        X_k <- (X_k + x_new - x_old) * exp(2j * pi * k / N)
+
+    which keeps it equal to the rFFT of the window. Only the bins above DC
+    are kept. The recurrence accumulates rounding error, so the bins are
+    recomputed exactly with an FFT whenever the owning SlidingWindowStats
+    re-anchors.
+    """
+
+    def __init__(self, window_size: int, sampling_rate: float) -> None:
+        self.window_size = window_size
+        k = np.arange(1, window_size // 2 + 1)
+        self.freqs = k * sampling_rate / window_size
+        self.twiddle = np.exp(2j * np.pi * k / window_size)
+        self.weights = band_weights(self.freqs, window_size)
+
+        self.bins = np.zeros((len(STAT_CHANNELS), len(k)), dtype=np.complex128)
+        self._out = np.zeros((len(STAT_CHANNELS), len(SPECTRAL_FEATURES)))
+
+    def reset(self) -> None:
+        self.bins[:] = 0.0
+
+    def update(self, new: np.ndarray, old: np.ndarray) -> None:
+        """Slide the window on by one sample"""
+        self.bins += (new - old)[:, None]
+        self.bins *= self.twiddle
+
+    def reanchor(self, window: np.ndarray) -> None:
+        """Recompute the bins exactly from the (window_size, axes) window,
+        oldest sample first"""
+        self.bins[:] = np.fft.rfft(window, axis=0)[1:self.bins.shape[1] + 1].T
+
+    def features(self) -> np.ndarray:
+        """(axes, SPECTRAL_FEATURES) array for the current window, reused
+        between calls"""
+        power = np.square(self.bins.real) + np.square(self.bins.imag)
+        return spectral_features(power, self.freqs, self.weights, self._out)
+
+
+class SlidingWindowStats:
+    """
+    Streaming version of the window statistics. The last `window_size`
+    frames are held in a ring, alongside running sums of (x - k) and
+    (x - k)^2 for every statistics channel. The shift k is set to the
+    channel mean every time the sums are re-anchored, which keeps the
+    variance well conditioned (acc_z sits around 1g with a tiny variance).
+    Re-anchoring recomputes the sums exactly from the ring every
+    `reanchor_interval` samples, which bounds the drift from repeatedly
+    adding and subtracting floating point values.
+
+    For layout versions with spectral features a SlidingDFT is kept up to
+    date alongside, which needs the sampling rate.
+    """
+
+    def __init__(self, window_size: int, reanchor_interval: Optional[int] = None,
+                 version: int = 1, sampling_rate: Optional[float] = None) -> None:
+        self.window_size = window_size
+        self.reanchor_interval = reanchor_interval or window_size
+        self.layout = LAYOUTS[version]
+
+        self.frames = np.zeros((window_size, len(SENSOR_CHANNELS)), dtype=np.float64)
+        self.head = 0    # slot the next frame goes into
+        self.count = 0   # number of valid frames in the ring
+        self.since_anchor = 0
+
+        self.shift = np.zeros(len(STAT_CHANNELS))
+        self.s1 = np.zeros(len(STAT_CHANNELS))
+        self.s2 = np.zeros(len(STAT_CHANNELS))
+
+        self.dft = SlidingDFT(window_size, sampling_rate) if self.layout.spectral else None
+
+        self._delta = np.zeros(len(STAT_CHANNELS))
+        self._old = np.zeros(len(STAT_CHANNELS))
+        self._out = np.zeros(self.layout.length)
+
+    @property
+    def full(self) -> bool:
+        return self.count == self.window_size
+
+    def reset(self) -> None:
+        """Forget everything, e.g. after a gap in the incoming data"""
+        self.head = 0
+        self.count = 0
+        self.since_anchor = 0
+        self.shift[:] = 0.0
+        self.s1[:] = 0.0
+        self.s2[:] = 0.0
+
+        # Empty slots count as zeros as far as the sliding DFT is concerned
+        self.frames[:] = 0.0
+        if self.dft is not None:
+            self.dft.reset()
+
+    def reanchor(self) -> None:
+        """Recompute the running sums exactly from the frames in the ring"""
+        stats = self.frames[:self.count, STAT_INDEX] if self.count < self.window_size else self.frames[:, STAT_INDEX]
+        if self.count:
+            self.shift[:] = stats.mean(axis=0)
+            centred = stats - self.shift
+            self.s1[:] = centred.sum(axis=0)
+            self.s2[:] = np.square(centred).sum(axis=0)
+
+        if self.dft is not None:
+            # The DFT wants the window in time order, oldest first, with any
+            # slots not yet filled as zeros at the start
+            window = np.zeros((self.window_size, len(STAT_CHANNELS)))
+            if self.count < self.window_size:
+                window[self.window_size - self.count:] = stats
+            else:
+                window[:] = np.roll(stats, -self.head, axis=0)
+            self.dft.reanchor(window)
+
+        self.since_anchor = 0
+
+    def push(self, frame: np.ndarray) -> None:
+        """Add a single frame, evicting the oldest once the window is full"""
+        slot = self.frames[self.head]
+        delta = self._delta
+
+        # Keep the outgoing sample (zeros while the window fills up) for the
+        # sliding DFT before the slot is overwritten
+        old = self._old
+        old[:] = slot[STAT_INDEX]
+
+        if self.count == self.window_size:
+            # Remove the outgoing sample's contribution
+            np.subtract(old, self.shift, out=delta)
+            self.s1 -= delta
+            self.s2 -= delta * delta
+        else:
+            self.count += 1
+
+        slot[:] = frame
+        np.subtract(slot[STAT_INDEX], self.shift, out=delta)
+        self.s1 += delta
+        self.s2 += delta * delta
+
+        if self.dft is not None:
+            self.dft.update(slot[STAT_INDEX], old)
+
+        self.head = (self.head + 1) % self.window_size
+
+        self.since_anchor += 1
+        if self.since_anchor >= self.reanchor_interval:
+            self.reanchor()
+
+    def extend(self, frames: np.ndarray) -> None:
+        """Add a batch of frames, oldest first. If the batch covers the whole
+        window it replaces it outright rather than being pushed one by one"""
+        if len(frames) >= self.window_size:
+            self.frames[:] = frames[-self.window_size:]
+            self.head = 0
+            self.count = self.window_size
+            self.reanchor()
+            return
+
+        for frame in frames:
+            self.push(frame)
+
+    def features(self) -> np.ndarray:
+        """
+        Feature packet for the current window, laid out as the layout
+        version's fields: the newest frame's values, then the sample mean
+        and (n - 1) variance of every statistics channel, and the
+        accelerometer and gyro energies (and spectral features for version
+        2). The array returned is reused between calls.
+        """
+        n = self.count
+        out = self._out
+        layout = self.layout
+        latest = self.frames[(self.head - 1) % self.window_size]
+
+        out[layout.latest_dst] = latest[layout.latest_src]
+
+        mean_offset = self.s1 / n
+        out[layout.mean_dst] = self.shift + mean_offset
+        out[layout.var_dst] = (self.s2 - self.s1 * mean_offset) / (n - 1)
+
+        # Sum of x^2 over the window, recovered from the shifted sums
+        sum_sq = self.s2 + self.shift * (2.0 * self.s1 + n * self.shift)
+        out[layout.acc_energy] = sum_sq[:3].sum()
+        out[layout.gy_energy] = sum_sq[3:].sum()
+
+        if self.dft is not None:
+            out[layout.spectral_dst] = self.dft.features()
+
+        return out
+
+
+def window_features(windows: np.ndarray, out: Optional[np.ndarray] = None,
+                    version: int = 1, sampling_rate: Optional[float] = None) -> np.ndarray:
+    """
+    Compute the feature packet for one window of frames, shaped (window,
+    channels), or for a batch of them, shaped (..., window, channels). Frames
+    run oldest first, with channels ordered as in SENSOR_CHANNELS, i.e. as
+    decoded by shared.frames or mapped from the shared memory ring. Returns
+    an array shaped (..., packet length) laid out as the given layout
+    version, written into `out` if given. Spectral features (version 2) are
+    computed with an rFFT of the whole window, and need the sampling rate.
+
+    Float32 windows are fine: the sums are accumulated in float64.
+    """
+    layout = LAYOUTS[version]
+    batch_shape = windows.shape[:-2]
+    n = windows.shape[-2]
+
+    if out is None:
+        out = np.empty(batch_shape + (layout.length,), dtype=np.float64)
+
+    stats = windows[..., STAT_SLICE]
+    s1 = stats.sum(axis=-2, dtype=np.float64)
+    s2 = np.einsum('...wc,...wc->...c', stats, stats, dtype=np.float64)
+
+    mean = s1 / n
+    out[..., layout.latest_dst] = windows[..., -1, layout.latest_src]
+    out[..., layout.mean_dst] = mean
+    out[..., layout.var_dst] = (s2 - s1 * mean) / (n - 1)
+    out[..., layout.acc_energy] = s2[..., :3].sum(axis=-1)
+    out[..., layout.gy_energy] = s2[..., 3:].sum(axis=-1)
+
+    if layout.spectral:
+        k = np.arange(1, n // 2 + 1)
+        freqs = k * sampling_rate / n
+        spectra = np.fft.rfft(stats, axis=-2)[..., 1:len(k) + 1, :]
+        power = np.swapaxes(np.square(spectra.real) + np.square(spectra.imag), -1, -2)
+
+        spectral = np.empty(batch_shape + layout.spectral_dst.shape)
+        spectral_features(power, freqs, band_weights(freqs, n), spectral)
+        out[..., layout.spectral_dst] = spectral
+
+    return out
+
+
+def pack_features(features: np.ndarray, packets: np.ndarray) -> np.ndarray:
+    """
+    Pack feature packets shaped (..., packet length) into `packets`, an
+    array of the layout's dtype of the matching shape - typically
+    np.frombuffer() over a preallocated bytearray, so the result can be
+    published without any further copies. The bytes are identical to
+    pack_binary()'s.
+    """
+    return pack_array(features, out=packets)
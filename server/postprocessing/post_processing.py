@@ -3,36 +3,53 @@
 Post processing to be done server-side for sensor data being received. This
 includes calculating means, variances and energies. There is also an option to
 do an FFT, as this was required for choosing the appropriate corner frequency
-for the LPFs on the controller side. 
+for the LPFs on the controller side. The FFT can either be plotted live, or
+run headless and write its spectra to Redis or to files, and can also be run
+offline over a capture file:
+
+    python post_processing.py --capture capture-20250101-120000.lcap
 """
+import argparse
 import logging
 import sys
+import time
 import redis
 import numpy as np
-import matplotlib
-matplotlib.use('TkAgg')
-import matplotlib.pyplot as plt
-import matplotlib.animation as animation
 
-from shared.packer import pack_binary
+from features import SlidingWindowStats, window_features, pack_features, LAYOUTS
+from spectrum import (SpectrumAnalyser, SPECTRUM_NAMES, spectrum_to_redis, spectrum_to_file)
+from shared.capture import read_capture
+from shared.frames import (CHANNEL_INDEX, STREAM_TIMESTAMP_FIELD, SENSOR_FRAME_SIZE, SEQUENCED_FRAME_SIZE,
+                           decode_frames, decode_stream_entries)
+from shared.shm_ring import SharedFrameRing
+from shared.metrics import LatencyTracker
+from shared.packer import WireEncoder
 from shared.lume_logger import *
 from shared.config import config
-from typing import Tuple, List
-
-import zlib
+from typing import Tuple, List, Optional, Dict
 
-REDIS_SENSORS_CHANNELS = ['pitch', 'roll', 'yaw', 'd_pitch', 'd_roll', 'd_yaw',
-                          'acc_x', 'acc_y', 'acc_z', 'gy_x', 'gy_y', 'gy_z',
-                          'flex0', 'flex1', 'flex2']
+# How long to wait before retrying when the shared memory ring does not exist
+SHM_ATTACH_RETRY = 0.5
 
 class DataProcessor:
-    def __init__(self, redisconn: redis.client.Redis, fft: bool = False, verbose: bool = False):
+    def __init__(self, redisconn: redis.client.Redis, fft: bool = False, verbose: bool = False,
+                 session_id: Optional[str] = None):
         """Initialise the sensor data post-processor.
         
         Args:
             verbose: Enable debug-level logging if True
+            session_id: Controller session to process, as registered by the
+                async ingest server, or None for the global keys
         """
         self.redisconn = redisconn 
+
+        # Redis keys, namespaced per controller session when sharded
+        self.session_id = session_id
+        self.frames_stream = config.get_session_key(config.REDIS_FRAMES_STREAM, session_id)
+        self.version_key = config.get_session_key(config.REDIS_DATA_VERSION_CHANNEL, session_id)
+        self.sensors_channel = config.get_session_key(config.REDIS_SENSORS_CHANNEL, session_id)
+        self.stats_key = config.get_session_key(config.REDIS_PROCESSING_STATS_KEY, session_id)
+
         self.do_fft = fft
         self.mode = redisconn.get(config.LUME_RUN_MODE)
         self._setup_colored_logging(verbose)
@@ -40,35 +57,59 @@ class DataProcessor:
 
         if fft:
             self.sampling_rate = config.LUME_SAMPLING_RATE
-            self.T = 1 / self.sampling_rate
-            self.N = self.window_size
-
-            self.signal_keys = ['acc_x', 'acc_y', 'acc_z', 'gy_x', 'gy_y', 'gy_z', 'pitch', 'roll', 'yaw']
-            self.signal_names = ['Accel X', 'Accel Y', 'Accel Z', 'Gyro X', 'Gyro Y', 'Gyro Z', 'Pitch', 'Roll', 'Yaw']
-
-            # Set up figure and axes
-            plt.ion()
-            self.fig, self.axes = plt.subplots(3, 3, figsize=(18, 12))
-            self.axes = self.axes.flatten()
-
-            self.lines = []
-            for ax, name in zip(self.axes, self.signal_names):
-                line, = ax.plot([], [])
-                ax.set_title(f'FFT of {name}')
-                ax.set_xlabel('Frequency (Hz)')
-                ax.set_ylabel('Amplitude')
-                ax.grid(True)
-                self.lines.append(line)
-
-            # Hide extra axes
-            if len(self.signal_names) < len(self.axes):
-                for idx in range(len(self.signal_names), len(self.axes)):
-                    self.fig.delaxes(self.axes[idx])
+            self.analyser = SpectrumAnalyser(self.window_size, self.sampling_rate,
+                                             config.LUME_FFT_SEGMENT, config.LUME_FFT_OVERLAP)
 
-            plt.tight_layout()
+            if config.LUME_FFT_OUTPUT == "plot":
+                self._setup_plots()
 
         self.last_seen = None
-        self.last_hash = None
+        self.last_entry_id = None
+        self.window_version = None
+
+        # Shared memory transport, attached lazily once sockets.py creates it
+        self.shm_ring = None
+        self.shm_seq = 0
+        self.shm_span = 0
+        self.shm_last_change = time.monotonic()
+
+        # Packet layout version: 2 adds the spectral features
+        self.packet_version = 2 if config.LUME_SPECTRAL_FEATURES else 1
+        self.layout = LAYOUTS[self.packet_version]
+
+        # Running window statistics, updated as frames come in
+        self.stats = SlidingWindowStats(self.window_size, version=self.packet_version,
+                                        sampling_rate=config.LUME_SAMPLING_RATE)
+
+        # Preallocated output: the features of the latest window, and the
+        # packed packet that is published, which are reused for every window
+        self.features = np.zeros(self.layout.length)
+        self.packet = bytearray(self.layout.dtype.itemsize)
+        self.packet_view = np.frombuffer(self.packet, dtype=self.layout.dtype)
+
+        # Wire frames the packets are published in, unless sent bare
+        self.encoder = None
+        if config.LUME_WIRE_ENCODING != "raw":
+            self.encoder = WireEncoder(self.packet_version, config.LUME_WIRE_ENCODING, session_id,
+                                       config.LUME_WIRE_KEYFRAME_INTERVAL)
+
+        # Receipt time (wall clock) of the newest frame read, and the delay
+        # from it to the corresponding feature packet being published
+        self.newest_timestamp = None
+        self.feature_latency = LatencyTracker("sample-to-feature latency")
+        self.published = 0
+        self.idle_wakeups = 0
+
+        # Decimation of the feature stream: a packet goes out once `hop` new
+        # frames have arrived, and no sooner than `min_interval` after the
+        # last one. new_frames is how many frames the last read brought in
+        self.hop = config.LUME_FEATURE_HOP
+        self.min_interval = 1.0 / config.LUME_FEATURE_MAX_RATE if config.LUME_FEATURE_MAX_RATE > 0 else 0.0
+        self.new_frames = 0
+        self.frames_since_emit = 0
+        self.last_emit = 0.0
+        self.period_start = time.monotonic()
+        self.period_published = 0
 
     def _setup_colored_logging(self, verbose: bool):
         """Set up colored logging for the application."""
@@ -94,73 +135,326 @@ class DataProcessor:
         if not COLORS_AVAILABLE:
             self.logger.warning("colorama not installed. For colored logs, install with: pip install colorama")
 
+    def _setup_plots(self) -> None:
+        """Create the live FFT window. matplotlib is only imported here, so
+        that headless runs do not need it (or a display)"""
+        import matplotlib
+        matplotlib.use('TkAgg')
+        import matplotlib.pyplot as plt
+
+        # Set up figure and axes
+        plt.ion()
+        self.fig, self.axes = plt.subplots(3, 3, figsize=(18, 12))
+        self.axes = self.axes.flatten()
+
+        self.lines = []
+        for ax, name in zip(self.axes, SPECTRUM_NAMES):
+            line, = ax.plot([], [])
+            ax.set_title(f'FFT of {name}')
+            ax.set_xlabel('Frequency (Hz)')
+            ax.set_ylabel('Amplitude')
+            ax.grid(True)
+            self.lines.append(line)
+
+        # Hide extra axes
+        if len(SPECTRUM_NAMES) < len(self.axes):
+            for idx in range(len(SPECTRUM_NAMES), len(self.axes)):
+                self.fig.delaxes(self.axes[idx])
+
+        plt.tight_layout()
+
+    def read_spectra(self, wait: bool = True) -> Optional[np.ndarray]:
+        """
+        Compute the spectra of the latest window, but only once per window
+        version, i.e. once every window's worth of new frames. Returns None if
+        there is nothing new to analyse.
+        """
+        # Cheap check first, so the full window is only read from Redis once
+        # per version
+        if config.LUME_TRANSPORT == "redis":
+            current_version = self.redisconn.get(self.version_key)
+            if current_version is None or int(current_version) == self.last_seen:
+                return None
+
+        # Read all signals and the window version in one atomic snapshot, so
+        # every channel is guaranteed to come from the same set of frames
+        window = self.read_window_frames(np.float64, wait)
+        if window is None:
+            return None  # wait until Redis has data
+
+        if self.window_version is None or self.window_version == self.last_seen:
+            return None
+
+        spectra = self.analyser.compute(window)
+
+        # Discard the result if the producer lapped us mid-calculation
+        if self.window_overwritten():
+            return None
+
+        self.last_seen = self.window_version
+        return spectra
+
     def fft(self, frame):
         """Perform an FFT of the filtered accelerometer, gyro, and attitude
         readings. This is displayed in a live window, updating roughly every
         ~16 seconds (for a batch of 1024 readings per window)"""
 
-        current_version = self.redisconn.get(config.REDIS_DATA_VERSION_CHANNEL)
-        if current_version == self.last_seen or current_version == None:
+        # Don't block here, as this runs on the GUI's timer
+        spectra = self.read_spectra(wait=False)
+        if spectra is None:
             return self.lines
 
-        # Read all signals
-        signals = []
-        for key in self.signal_keys:
-            raw = self.redisconn.lrange(key, 0, -1)
-            if not raw or len(raw) < self.window_size:
-                return self.lines  # wait until Redis has data
-            signals.append(np.array([float(x) for x in raw]))
-
-        for idx, (signal, line) in enumerate(zip(signals, self.lines)):
-            # Compute FFT
-            fft_vals = np.fft.fft(signal)
-            fft_freqs = np.fft.fftfreq(self.N, self.T)
-
-            # Trim in the case where it has read the values after socket.py has
-            # pushed the 51st element but not yet trimmed it. There is no need
-            # for a mutex here, it will not make a huge difference to add
-            # atomic reads
-            window_size = self.window_size
-            fft_vals, fft_freqs = fft_vals[:window_size], fft_freqs[:window_size]
-
-            # Only positive freqs
-            pos_mask = fft_freqs >= 0
-            fft_vals = fft_vals[pos_mask]
-            fft_freqs = fft_freqs[pos_mask]
-
-            # Update line
-            line.set_data(fft_freqs, np.abs(fft_vals))
-            self.axes[idx].set_xlim(0, np.max(fft_freqs))
-            self.axes[idx].set_ylim(0, np.max(np.abs(fft_vals)) * 1.1)
-
-        # Update last seen version
-        self.last_seen = current_version
+        freqs = self.analyser.freqs
+        for idx, (amplitudes, line) in enumerate(zip(spectra, self.lines)):
+            line.set_data(freqs, amplitudes)
+            self.axes[idx].set_xlim(0, freqs[-1])
+            self.axes[idx].set_ylim(0, np.max(amplitudes) * 1.1 or 1.0)
 
         return self.lines
 
-    def calculate_mean_and_variance(self, data) -> Tuple[float, float]:
+    def publish_spectra(self, spectra: np.ndarray) -> None:
+        """Hand a set of spectra to wherever LUME_FFT_OUTPUT says they go"""
+        if config.LUME_FFT_OUTPUT == "redis":
+            spectrum_to_redis(self.redisconn, config.REDIS_SPECTRUM_KEY, self.analyser, spectra, self.last_seen)
+            self.logger.debug(f"Spectrum version {self.last_seen} written to {config.REDIS_SPECTRUM_KEY}")
+        else:
+            path = spectrum_to_file(config.LUME_FFT_OUTPUT_DIR, self.analyser, spectra, self.last_seen)
+            self.logger.info(f"Spectrum written to {path}")
+
+    def analyse_headless(self) -> None:
+        """FFT mode without a display: analyse every new window and write the
+        spectra out. New windows only come every window_size frames, so the
+        version is just checked a few times per window in between"""
+        self.logger.info(f"Headless FFT analysis active, writing spectra to {config.LUME_FFT_OUTPUT} "
+                         f"({self.analyser.n_segments} segment(s) of {self.analyser.segment} samples)")
+        check_interval = min(1.0, self.window_size / self.sampling_rate / 4)
+
+        while True:
+            spectra = self.read_spectra()
+            if spectra is None:
+                time.sleep(check_interval)
+                continue
+
+            self.publish_spectra(spectra)
+
+    def read_window(self, wait: bool = True) -> Optional[Dict[str, np.ndarray]]:
         """
-        Calculate both the mean and the variance of a set of data, using
-        Welford's algorithm
+        Read the most recent window of frames and split it into one array per
+        channel, newest sample first. Returns None if there is not yet a full
+        window of data, or if nothing new has been added since the last call.
         """
-        n = 0
-        mean = 0.0
-        m2 = 0.0
+        frames = self.read_window_frames(np.float64, wait)
+        if frames is None:
+            return None
 
-        for x in data: 
-            n += 1
-            delta = x - mean
-            mean += delta / n
-            delta2 = x - mean
-            m2 += delta * delta2
+        newest_first = frames[::-1]
+        return {key: newest_first[:, i] for key, i in CHANNEL_INDEX.items()}
 
-        return mean, m2 / (n - 1)
+    def read_window_frames(self, dtype=np.float32, wait: bool = True) -> Optional[np.ndarray]:
+        """
+        Read the most recent window of frames as a single (window, channels)
+        matrix, oldest first, with channels ordered as in SENSOR_CHANNELS.
+        Returns None if there is not yet a full window of data, or if nothing
+        new has been added since the last call. Unless `wait` is False, this
+        blocks until there is something new.
+
+        The window is a consistent snapshot: every channel comes from the same
+        frames, and self.window_version is the ingest side's window version
+        as of those frames.
+        """
+        if config.LUME_TRANSPORT == "shm":
+            return self._read_shm_window()
+
+        # Block until something newer than the last window lands, rather
+        # than polling
+        if wait and not self._wait_for_stream(self.last_entry_id or b'0-0'):
+            return None
+
+        # Read the version and the window inside one MULTI, so that both come
+        # from the same point in the stream, in a single round trip
+        pipe = self.redisconn.pipeline(transaction=True)
+        pipe.get(self.version_key)
+        pipe.xrevrange(self.frames_stream, count=self.window_size)
+        version, entries = pipe.execute()
+
+        if not entries:
+            return None
+
+        # Stream IDs are strictly increasing, so the newest ID tells us
+        # whether anything has changed since the last window
+        newest_id = entries[0][0]
+        if newest_id == self.last_entry_id:
+            return None
+
+        # Count the frames that are new since the last window
+        self.new_frames = next((i for i, (entry_id, _) in enumerate(entries)
+                                if entry_id == self.last_entry_id), len(entries))
+        self.last_entry_id = newest_id
+
+        if len(entries) < self.window_size:
+            return None  # incomplete, wait for a full window
+
+        self.window_version = int(version) if version is not None else None
+        self.newest_timestamp = self._entry_timestamp(entries[0])
+
+        entries.reverse()
+        return decode_stream_entries(entries, dtype)
+
+    def _wait_for_stream(self, after: bytes) -> bool:
+        """Block until the frame stream has an entry newer than `after`, or
+        the wait times out. Returns immediately if there already is one"""
+        result = self.redisconn.xread({self.frames_stream: after}, count=1,
+                                      block=config.LUME_WAIT_TIMEOUT_MS)
+        if not result:
+            self.idle_wakeups += 1
+            return False
+        return True
+
+    @staticmethod
+    def _entry_timestamp(entry) -> Optional[float]:
+        """Receipt time of a stream entry, as recorded by the ingest side"""
+        timestamp = entry[1].get(STREAM_TIMESTAMP_FIELD)
+        return float(timestamp) if timestamp is not None else None
+
+    def _attach_shm(self) -> bool:
+        """Attach to the shared memory ring if we have not already, returning
+        False if the producer has not created it yet"""
+        if self.shm_ring is None:
+            self.shm_ring = SharedFrameRing.attach(config.LUME_SHM_NAME)
+            if self.shm_ring is None:
+                time.sleep(SHM_ATTACH_RETRY)
+                return False
+            self.shm_last_change = time.monotonic()
+        return True
+
+    def _shm_idle(self) -> None:
+        """Called when the ring has not moved. There is nothing to block on in
+        shared memory, so back off for a poll interval, which bounds the extra
+        delay a new frame can see. If the producer restarts it creates a fresh
+        segment, which we will only see by re-attaching, so do that once it
+        goes quiet"""
+        self.idle_wakeups += 1
+        time.sleep(config.LUME_SHM_POLL_INTERVAL)
+
+        if time.monotonic() - self.shm_last_change > config.LUME_SESSION_TIMEOUT:
+            self.shm_ring.close()
+            self.shm_ring = None
+            self.shm_seq = 0
+
+    def _read_shm_window(self) -> Optional[np.ndarray]:
+        """
+        Shared memory version of read_window_frames(). The window returned is
+        a float32 view straight onto the ring, so nothing is copied; callers
+        should check window_overwritten() before trusting anything computed
+        from it.
+        """
+        if not self._attach_shm():
+            return None  # producer not up yet
+
+        seq, frames, timestamps = self.shm_ring.latest(self.window_size)
+        if seq == self.shm_seq:
+            self._shm_idle()
+            return None
+
+        self.new_frames = seq - self.shm_seq
+        self.shm_seq = seq
+        self.shm_span = self.window_size
+        self.shm_last_change = time.monotonic()
+        if frames is None:
+            return None
+
+        # The ring's write counter doubles as the version, in windows
+        self.window_version = seq // self.window_size
+        if timestamps is not None:
+            self.newest_timestamp = float(timestamps[-1])
+        return frames
+
+    def read_new_frames(self) -> Tuple[Optional[np.ndarray], bool]:
+        """
+        Read only the frames that have landed since the last call, oldest
+        first, as an (n, channels) array, or None if there is nothing new. The
+        flag returned alongside is False when the frames do not follow on from
+        the previous call, i.e. on the first read, or when we have fallen a
+        whole window behind and skipped straight to the newest window instead.
+        """
+        if config.LUME_TRANSPORT == "shm":
+            return self._read_new_shm_frames()
+
+        if self.last_entry_id is None:
+            return self._read_latest_frames()
 
-    def calculate_energy(self, x_in : List[float], y_in : List[float], z_in : List[float]) -> float:
+        # XREAD only returns entries after the given ID, and blocks until
+        # there are some rather than making us poll
+        result = self.redisconn.xread({self.frames_stream: self.last_entry_id}, count=self.window_size,
+                                      block=config.LUME_WAIT_TIMEOUT_MS)
+        if not result:
+            self.idle_wakeups += 1
+            return None, True
+
+        return self.accept_entries(result[0][1])
+
+    def accept_entries(self, entries: List) -> Tuple[Optional[np.ndarray], bool]:
         """
-        Calculate the energy of a signal over a specified window
+        Take the entries that an XREAD of the frame stream returned after
+        self.last_entry_id (read with a count of one window), and return them
+        as read_new_frames() does. This is split out so that one XREAD can
+        serve several processors, as in the sharded workers.
         """
-        return sum(x**2 + y**2 + z**2 for x, y, z in zip(x_in, y_in, z_in))        
+        # A full count means there may be more behind it, in which case there
+        # is no point working through the backlog one by one
+        if len(entries) >= self.window_size:
+            return self._read_latest_frames()
+
+        return self._decode_new(entries), True
+
+    def _read_latest_frames(self) -> Tuple[Optional[np.ndarray], bool]:
+        """Start afresh from the newest window on the stream"""
+        entries = self.redisconn.xrevrange(self.frames_stream, count=self.window_size)
+        if not entries:
+            # Nothing there yet, so block on the stream from its start
+            self.last_entry_id = b'0-0'
+            return None, True
+        if entries[0][0] == self.last_entry_id:
+            return None, True
+
+        entries.reverse()
+        return self._decode_new(entries), False
+
+    def _decode_new(self, entries: List) -> np.ndarray:
+        """Decode new stream entries, oldest first, and note where we are up to"""
+        self.last_entry_id = entries[-1][0]
+        self.newest_timestamp = self._entry_timestamp(entries[-1])
+        self.new_frames = len(entries)
+        return decode_stream_entries(entries)
+
+    def _read_new_shm_frames(self) -> Tuple[Optional[np.ndarray], bool]:
+        """Shared memory version of read_new_frames(). The frames returned are
+        a view onto the ring, so check window_overwritten() once done"""
+        if not self._attach_shm():
+            return None, True
+
+        seq = self.shm_ring.seq
+        new = seq - self.shm_seq
+        if new == 0:
+            self._shm_idle()
+            return None, True
+
+        contiguous = self.shm_seq > 0 and new < self.window_size
+        n = min(new, self.window_size, seq)
+
+        frames, timestamps = self.shm_ring.window(seq, n)
+        self.new_frames = new
+        self.shm_seq = seq
+        self.shm_span = n
+        self.shm_last_change = time.monotonic()
+        self.newest_timestamp = float(timestamps[-1])
+        return frames, contiguous
+
+    def window_overwritten(self) -> bool:
+        """True if the frames last read from shared memory were overwritten
+        while they were being processed. Always False for the Redis transport,
+        where the frames are a private copy"""
+        return self.shm_ring is not None and self.shm_ring.overwritten(self.shm_seq, self.shm_span)
 
     def process(self) -> None:
         """
@@ -179,105 +473,191 @@ class DataProcessor:
             acc_energy, gy_energy,
             flex0, flex1, flex2
 
+        With LUME_SPECTRAL_FEATURES set, layout version 2 is published
+        instead, which adds the dominant frequency, spectral centroid and
+        band energies of every acc/gyro axis before the flex values (see
+        shared/packer.py).
+
         This is what will be used by the ML algorithm to identify gestures. 
         """
 
-        self.logger.info("Post processor active")
+        self.logger.info(f"Post processor active, publishing every {self.hop} frames "
+                         f"(target {self.target_rate():.2f} Hz) with packet layout v{self.packet_version}")
+
+        self.announce()
 
         # Loop indefinitely
         while True:
-            # But only update when the hash of the data has changed. This
-            # prevents duplicate updates. Check using first signal queue,
-            # synchronisation is not a problem as we have only one publisher
-            data = self.redisconn.lrange('pitch', 0, -1)
-            data_bytes = b''.join(x.encode() if isinstance(x, str) else x for x in data)
-            hash = zlib.crc32(data_bytes)
-
-            if hash == self.last_hash:
+            # But only update when new frames have landed on the stream. This
+            # prevents duplicate updates. The reads block (or, for shared
+            # memory, back off) while there is nothing new, so an idle
+            # processor does not spin
+            if config.LUME_FEATURE_ENGINE == "batch":
+                ready = self.update_batch()
+            else:
+                ready = self.update_incremental()
+
+            if not ready:
                 continue  # loop until new data
-        
-            signals = {}
-            got_full_data_set = False
-
-            # This loops until we get a whole set of valid readings - if any of
-            # the sensor readings is bogus, you want to drop the whole set. 
-            while not got_full_data_set:
-                got_full_data_set = True
-                for key in REDIS_SENSORS_CHANNELS:
-                    raw = self.redisconn.lrange(key, 0, -1)
-                    if not raw or len(raw) < self.window_size:
-                        got_full_data_set = False
-                        continue  # wait until required amount
-                    signals[key] = np.array([float(x) for x in raw])
-
-            # To preserve order, we keep the indexing as per the docstring at
-            # the top of this function
-            sensor_data_packet = [0.0 for _ in range(29)]
-            
-            # Calculate the means and variance of every set that we need
-            acc_x_mean, acc_x_var = self.calculate_mean_and_variance(signals['acc_x'])
-            acc_y_mean, acc_y_var = self.calculate_mean_and_variance(signals['acc_y'])
-            acc_z_mean, acc_z_var = self.calculate_mean_and_variance(signals['acc_z'])
-            gy_x_mean, gy_x_var = self.calculate_mean_and_variance(signals['gy_x'])
-            gy_y_mean, gy_y_var = self.calculate_mean_and_variance(signals['gy_y'])
-            gy_z_mean, gy_z_var = self.calculate_mean_and_variance(signals['gy_z'])
-
-            # add in the data according to the order
-            sensor_data_packet[0] = signals['pitch'][0]
-            sensor_data_packet[1] = signals['roll'][0]
-            sensor_data_packet[2] = signals['yaw'][0]
-            sensor_data_packet[3] = signals['d_pitch'][0]
-            sensor_data_packet[4] = signals['d_roll'][0]
-            sensor_data_packet[5] = signals['d_yaw'][0]
-            sensor_data_packet[6] = signals['acc_x'][0]
-            sensor_data_packet[7] = signals['acc_y'][0]
-            sensor_data_packet[8] = signals['acc_z'][0]
-
-            sensor_data_packet[9] = acc_x_mean
-            sensor_data_packet[10] = acc_y_mean
-            sensor_data_packet[11] = acc_z_mean
-            sensor_data_packet[12] = acc_x_var
-            sensor_data_packet[13] = acc_y_var
-            sensor_data_packet[14] = acc_z_var
-
-            sensor_data_packet[15] = signals['gy_x'][0]
-            sensor_data_packet[16] = signals['gy_y'][0]
-            sensor_data_packet[17] = signals['gy_z'][0]
-            
-            sensor_data_packet[18] = gy_x_mean
-            sensor_data_packet[19] = gy_y_mean
-            sensor_data_packet[20] = gy_z_mean
-            sensor_data_packet[21] = gy_x_var
-            sensor_data_packet[22] = gy_y_var
-            sensor_data_packet[23] = gy_z_var
-
-            sensor_data_packet[24] = self.calculate_energy(signals['acc_x'],
-                                                           signals['acc_y'],
-                                                           signals['acc_z'])
-            sensor_data_packet[25] = self.calculate_energy(signals['gy_x'],
-                                                           signals['gy_y'],
-                                                           signals['gy_z'])
-
-            sensor_data_packet[26] = signals['flex0'][0]
-            sensor_data_packet[27] = signals['flex1'][0]
-            sensor_data_packet[28] = signals['flex2'][0]
-
-            self.logger.debug(sensor_data_packet)
-            packed = pack_binary(sensor_data_packet)
-
-            # Publish data window onto sensors channel
-            self.redisconn.publish('sensors', packed)
-
-            # Update hash to signify that we have processed this batch
-            self.last_hash = hash  
+
+            self.publish()
+
+    def publish(self, pipe=None) -> None:
+        """
+        Pack the latest features straight into the preallocated packet, or a
+        wire frame, and publish it on this processor's sensors channel,
+        either immediately or as part of `pipe`. The buffers are reused, so
+        a pipeline must be executed before this processor publishes again.
+        """
+        # Laid out as per the docstring of process()
+        self.logger.debug(self.features)
+        if self.encoder is not None:
+            timestamp = self.newest_timestamp if self.newest_timestamp is not None else time.time()
+            payload = self.encoder.encode(self.features, timestamp)
+        else:
+            pack_features(self.features, self.packet_view)
+            payload = memoryview(self.packet)
+
+        # Publish data window onto sensors channel
+        (pipe or self.redisconn).publish(self.sensors_channel, payload)
+
+        if self.newest_timestamp is not None:
+            self.feature_latency.record(time.time() - self.newest_timestamp)
+
+        self.published += 1
+        self.period_published += 1
+        if self.published % config.LUME_LATENCY_REPORT_INTERVAL == 0:
+            self.report_stats()
+
+    def report_stats(self) -> None:
+        """Log and publish the sample-to-feature latency and the achieved
+        feature packet rate for the last period"""
+        now = time.monotonic()
+        elapsed = now - self.period_start
+        rate = self.period_published / elapsed if elapsed > 0 else 0.0
+        self.period_start = now
+        self.period_published = 0
+
+        latency = self.feature_latency.format_summary(reset=False)
+        if latency is not None:
+            self.logger.info(f"{latency}, {self.idle_wakeups} idle wakeups")
+        self.logger.info(f"Publishing features at {rate:.2f} Hz (target {self.target_rate():.2f} Hz)")
+
+        stats = {
+            **self.rate_settings(),
+            'effective_rate_hz': f"{rate:.2f}",
+            'published_total': self.published,
+            'idle_wakeups': self.idle_wakeups,
+        }
+        summary = self.feature_latency.summary()
+        if summary is not None:
+            stats.update(summary)
+
+        self.redisconn.hset(self.stats_key, mapping=stats)
+        self.idle_wakeups = 0
+
+    def emit_due(self) -> bool:
+        """
+        Account for the frames brought in by the last read, and decide
+        whether a feature packet should be published for them: only every
+        `hop` frames, and no faster than the configured rate cap
+        """
+        self.frames_since_emit += self.new_frames
+        if self.frames_since_emit < self.hop:
+            return False
+
+        now = time.monotonic()
+        if now - self.last_emit < self.min_interval:
+            return False
+
+        self.frames_since_emit = 0
+        self.last_emit = now
+        return True
+
+    def target_rate(self) -> float:
+        """Feature packet rate we aim for, in Hz, given the sampling rate, the
+        hop and the rate cap"""
+        rate = config.LUME_SAMPLING_RATE / self.hop
+        if config.LUME_FEATURE_MAX_RATE > 0:
+            rate = min(rate, config.LUME_FEATURE_MAX_RATE)
+        return rate
+
+    def announce(self) -> None:
+        """Let consumers know what rate to expect before the first report"""
+        self.redisconn.hset(self.stats_key, mapping=self.rate_settings())
+
+    def rate_settings(self) -> Dict[str, str]:
+        """Decimation settings, as published for downstream consumers"""
+        return {
+            'packet_version': str(self.packet_version),
+            'wire_encoding': config.LUME_WIRE_ENCODING,
+            'hop': str(self.hop),
+            'max_rate_hz': f"{config.LUME_FEATURE_MAX_RATE:.2f}",
+            'target_rate_hz': f"{self.target_rate():.2f}",
+        }
+
+    def update_incremental(self) -> bool:
+        """
+        Read only the new frames, update the running window statistics from
+        them, and fill in self.features. Returns False if there is nothing to
+        publish yet.
+        """
+        frames, contiguous = self.read_new_frames()
+        return self.consume(frames, contiguous)
+
+    def consume(self, frames: Optional[np.ndarray], contiguous: bool) -> bool:
+        """
+        Fold newly read frames into the running window statistics and, if a
+        packet is due, fill in self.features. Returns False if there is
+        nothing to publish yet.
+        """
+        if frames is None:
+            return False
+
+        if not contiguous:
+            self.stats.reset()
+        self.stats.extend(frames)
+
+        # Drop everything if the producer lapped us mid-read, and start again
+        # from a fresh window
+        if self.window_overwritten():
+            self.stats.reset()
+            self.shm_seq = 0
+            return False
+
+        if not self.stats.full or not self.emit_due():
+            return False  # wait until we have a whole window, and a packet is due
+
+        self.features[:] = self.stats.features()
+        return True
+
+    def update_batch(self) -> bool:
+        """
+        Read the whole latest window as one matrix and compute every feature
+        from it in one go, into self.features. Returns False if there is
+        nothing to publish yet.
+        """
+        window = self.read_window_frames()
+        if window is None or not self.emit_due():
+            return False
+
+        window_features(window, out=self.features, version=self.packet_version,
+                        sampling_rate=config.LUME_SAMPLING_RATE)
+
+        # Drop the packet if the producer lapped us mid-calculation
+        return not self.window_overwritten()
 
     def run(self):
         """Run the sensor data post-processor"""
         self.logger.info(f"Starting data post-processing client")
         try:
-            if self.do_fft:
+            if self.do_fft and config.LUME_FFT_OUTPUT == "plot":
+                import matplotlib.pyplot as plt
+                import matplotlib.animation as animation
                 self.ani = animation.FuncAnimation(self.fig, self.fft, interval=100, blit=True)
                 plt.show(block=True)
+            elif self.do_fft:
+                self.analyse_headless()
             else: 
                 self.process()
 
@@ -285,8 +665,42 @@ class DataProcessor:
             # Warning is already given by other modules, no point repeating
             pass
 
+def analyse_capture(path: str, output_dir: str) -> str:
+    """
+    Offline FFT analysis of a whole capture file (see shared/capture.py),
+    e.g. a long field recording. All of the sensor frames in the capture are
+    treated as one window and Welch-averaged with LUME_FFT_SEGMENT samples
+    per segment (or LUME_FFT_DATA_WINDOW_SIZE if that is not set). Returns
+    the path of the .npz file the spectra are written to.
+    """
+    payloads = [payload[:SENSOR_FRAME_SIZE] for _, _, payload in read_capture(path)
+                if len(payload) in (SENSOR_FRAME_SIZE, SEQUENCED_FRAME_SIZE)]
+    frames = decode_frames(payloads)
+
+    segment = config.LUME_FFT_SEGMENT or config.LUME_FFT_DATA_WINDOW_SIZE
+    if len(frames) < segment:
+        raise ValueError(f"{path} only holds {len(frames)} frames, need at least {segment}")
+
+    analyser = SpectrumAnalyser(len(frames), config.LUME_SAMPLING_RATE, segment, config.LUME_FFT_OVERLAP)
+    return spectrum_to_file(output_dir, analyser, analyser.compute(frames))
+
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Lume sensor data post-processor")
+    parser.add_argument("--capture", help="Analyse the spectrum of a capture file offline, then exit")
+    args = parser.parse_args()
+
+    if args.capture:
+        print(analyse_capture(args.capture, config.LUME_FFT_OUTPUT_DIR))
+        sys.exit(0)
+
     redisconn = redis.Redis(host=config.REDIS_HOST, port=config.REDIS_PORT, db=0, decode_responses=False)
     is_fft = (config.LUME_RUN_MODE == "fft")
-    post_proc = DataProcessor(redisconn=redisconn, fft=is_fft, verbose=config.LUME_VERBOSE)
-    post_proc.run()
+
+    if config.LUME_POSTPROCESSING_WORKERS > 0 and not is_fft:
+        # One worker process per shard of the controller sessions
+        from sharding import Supervisor
+        Supervisor(redisconn, config.LUME_POSTPROCESSING_WORKERS, config.LUME_VERBOSE).run()
+    else:
+        post_proc = DataProcessor(redisconn=redisconn, fft=is_fft, verbose=config.LUME_VERBOSE)
+        post_proc.run()
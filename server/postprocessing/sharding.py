@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+"""
+Sharded post-processing, for when several controllers are connected at once
+through the async ingest server. A Supervisor starts a pool of worker
+processes, and each controller session (as listed in the sessions hash) is
+owned by exactly one of them, chosen by consistent hashing of the session ID
+onto the live workers. Each worker keeps a DataProcessor per session it owns,
+so all of the window state for a session lives in one process, and publishes
+that session's feature packets on its own channel, i.e. 'sensors:<session>'.
+
+Workers advertise themselves with a heartbeat in Redis and every worker
+builds the same hash ring from the live heartbeats, so no coordination is
+needed beyond that. When a worker dies the supervisor removes its heartbeat,
+the survivors pick up its sessions on their next refresh, and a replacement
+is started shortly after. Consistent hashing means only the dead worker's
+sessions move, each time.
+"""
+import bisect
+import hashlib
+import logging
+import multiprocessing
+import sys
+import time
+import redis
+
+from post_processing import DataProcessor
+from shared.lume_logger import *
+from shared.config import config
+from typing import Dict, List, Optional
+
+# Points per worker on the hash ring, which evens out the share of sessions
+VIRTUAL_NODES = 64
+
+# How often workers heartbeat and re-check which sessions they own
+SESSION_REFRESH_INTERVAL = 1.0
+
+# How often the supervisor checks on its workers, and how long it waits
+# before replacing one that has died
+SUPERVISE_INTERVAL = 1.0
+RESTART_DELAY = 5.0
+
+
+def _hash(value: str) -> int:
+    """Stable 64 bit hash (Python's own hash() is salted per process)"""
+    return int.from_bytes(hashlib.blake2b(value.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+class HashRing:
+    """Consistent hash ring mapping session IDs onto worker IDs"""
+
+    def __init__(self, nodes: List[str], replicas: int = VIRTUAL_NODES) -> None:
+        points = sorted((_hash(f"{node}#{i}"), node) for node in nodes for i in range(replicas))
+        self.hashes = [h for h, _ in points]
+        self.nodes = [node for _, node in points]
+
+    def owner(self, key: str) -> Optional[str]:
+        """Worker that `key` belongs to, or None if the ring is empty"""
+        if not self.nodes:
+            return None
+        i = bisect.bisect(self.hashes, _hash(key)) % len(self.nodes)
+        return self.nodes[i]
+
+
+class ShardWorker:
+    """A single worker process, running the post-processing for every
+    session that hashes onto it"""
+
+    def __init__(self, worker_id: str, redisconn: redis.client.Redis, verbose: bool = False):
+        self.worker_id = worker_id
+        self.redisconn = redisconn
+        self.verbose = verbose
+        self._setup_colored_logging(verbose)
+
+        self.processors: Dict[str, DataProcessor] = {}
+        self.by_stream: Dict[bytes, DataProcessor] = {}
+        self.window_size = config.LUME_DEPLOY_DATA_WINDOW_SIZE
+
+    def _setup_colored_logging(self, verbose: bool):
+        """Set up colored logging for the application."""
+        self.logger = logging.getLogger(__name__)
+
+        # Set log level
+        log_level = logging.DEBUG if verbose else logging.INFO
+        self.logger.setLevel(log_level)
+
+        # Create console handler
+        console = logging.StreamHandler(sys.stdout)
+        console.setLevel(log_level)
+
+        # Create and attach formatter
+        formatter = ColoredFormatter() if COLORS_AVAILABLE else logging.Formatter(
+            '%(asctime)s - %(levelname)s - %(message)s')
+        console.setFormatter(formatter)
+
+        # Add handler to logger if not already added
+        if not self.logger.handlers:
+            self.logger.addHandler(console)
+
+        if not COLORS_AVAILABLE:
+            self.logger.warning("colorama not installed. For colored logs, install with: pip install colorama")
+
+    def heartbeat(self) -> None:
+        self.redisconn.hset(config.REDIS_WORKERS_KEY, self.worker_id, repr(time.time()))
+
+    def live_workers(self) -> List[str]:
+        """Workers that have sent a heartbeat recently, always including us"""
+        now = time.time()
+        workers = {self.worker_id}
+        for worker_id, last_seen in self.redisconn.hgetall(config.REDIS_WORKERS_KEY).items():
+            if now - float(last_seen) <= config.LUME_WORKER_TIMEOUT:
+                workers.add(worker_id.decode('utf-8'))
+        return sorted(workers)
+
+    def rebalance(self) -> None:
+        """Work out which sessions we own now, picking up new ones and
+        letting go of any that have moved elsewhere or gone away"""
+        sessions = [s.decode('utf-8') for s in self.redisconn.hkeys(config.REDIS_SESSIONS_KEY)]
+        ring = HashRing(self.live_workers())
+        owned = {s for s in sessions if ring.owner(s) == self.worker_id}
+
+        for session_id in owned - self.processors.keys():
+            processor = DataProcessor(self.redisconn, verbose=self.verbose, session_id=session_id)
+            processor.announce()
+            self.processors[session_id] = processor
+            self.by_stream[processor.frames_stream.encode('utf-8')] = processor
+            self.logger.info(f"{self.worker_id} took on session {Fore.CYAN}{session_id}{Style.RESET_ALL}")
+
+        for session_id in self.processors.keys() - owned:
+            processor = self.processors.pop(session_id)
+            del self.by_stream[processor.frames_stream.encode('utf-8')]
+            self.logger.info(f"{self.worker_id} released session {session_id}")
+
+    def step(self) -> None:
+        """Wait for new frames on any owned session's stream with a single
+        blocking XREAD, then update and publish every session that got some,
+        with all of the packets going out in one pipeline"""
+        pipe = self.redisconn.pipeline(transaction=False)
+
+        # Sessions that have just been picked up start from their newest
+        # window. A publish only hands the pipeline a view of the processor's
+        # reused packet buffer, so these are sent before the XREAD below can
+        # give the same processor something else to publish
+        for processor in self.processors.values():
+            if processor.last_entry_id is None and processor.consume(*processor.read_new_frames()):
+                processor.publish(pipe)
+        if len(pipe):
+            pipe.execute()
+
+        streams = {p.frames_stream: p.last_entry_id for p in self.processors.values()
+                   if p.last_entry_id is not None}
+        result = self.redisconn.xread(streams, count=self.window_size,
+                                      block=config.LUME_WAIT_TIMEOUT_MS) if streams else None
+
+        for stream, entries in result or []:
+            processor = self.by_stream[stream]
+            if processor.consume(*processor.accept_entries(entries)):
+                processor.publish(pipe)
+
+        pipe.execute()
+
+    def run(self) -> None:
+        self.logger.info(f"Post-processing worker {self.worker_id} started")
+        last_refresh = 0.0
+
+        while True:
+            now = time.monotonic()
+            if now - last_refresh >= SESSION_REFRESH_INTERVAL:
+                self.heartbeat()
+                self.rebalance()
+                last_refresh = now
+
+            if not self.processors:
+                time.sleep(SESSION_REFRESH_INTERVAL)
+                continue
+
+            self.step()
+
+
+def run_worker(worker_id: str, verbose: bool) -> None:
+    """Entry point of a worker process"""
+    redisconn = redis.Redis(host=config.REDIS_HOST, port=config.REDIS_PORT, db=0, decode_responses=False)
+    try:
+        ShardWorker(worker_id, redisconn, verbose).run()
+    except KeyboardInterrupt:
+        pass
+
+
+class Supervisor:
+    """Starts the worker processes, and replaces any that die"""
+
+    def __init__(self, redisconn: redis.client.Redis, workers: int, verbose: bool = False):
+        self.redisconn = redisconn
+        self.verbose = verbose
+        self.worker_ids = [f"worker-{i}" for i in range(workers)]
+        self.processes: Dict[str, multiprocessing.Process] = {}
+        self.restart_at: Dict[str, float] = {}
+        self._setup_colored_logging(verbose)
+
+    def _setup_colored_logging(self, verbose: bool):
+        """Set up colored logging for the application."""
+        self.logger = logging.getLogger(__name__)
+
+        # Set log level
+        log_level = logging.DEBUG if verbose else logging.INFO
+        self.logger.setLevel(log_level)
+
+        # Create console handler
+        console = logging.StreamHandler(sys.stdout)
+        console.setLevel(log_level)
+
+        # Create and attach formatter
+        formatter = ColoredFormatter() if COLORS_AVAILABLE else logging.Formatter(
+            '%(asctime)s - %(levelname)s - %(message)s')
+        console.setFormatter(formatter)
+
+        # Add handler to logger if not already added
+        if not self.logger.handlers:
+            self.logger.addHandler(console)
+
+        if not COLORS_AVAILABLE:
+            self.logger.warning("colorama not installed. For colored logs, install with: pip install colorama")
+
+    def _start(self, worker_id: str) -> None:
+        process = multiprocessing.Process(target=run_worker, args=(worker_id, self.verbose),
+                                          name=worker_id, daemon=True)
+        process.start()
+        self.processes[worker_id] = process
+
+    def run(self) -> None:
+        self.logger.info(f"Starting {len(self.worker_ids)} post-processing workers")
+        for worker_id in self.worker_ids:
+            self._start(worker_id)
+
+        try:
+            while True:
+                time.sleep(SUPERVISE_INTERVAL)
+                now = time.monotonic()
+
+                for worker_id, process in list(self.processes.items()):
+                    if process.is_alive():
+                        continue
+
+                    # Drop its heartbeat straight away, so the survivors take
+                    # over its sessions now rather than after the timeout
+                    self.logger.warning(f"{worker_id} exited with code {process.exitcode}, "
+                                        f"rebalancing its sessions and restarting it in {RESTART_DELAY:.0f}s")
+                    self.redisconn.hdel(config.REDIS_WORKERS_KEY, worker_id)
+                    del self.processes[worker_id]
+                    self.restart_at[worker_id] = now + RESTART_DELAY
+
+                for worker_id, when in list(self.restart_at.items()):
+                    if now >= when:
+                        del self.restart_at[worker_id]
+                        self._start(worker_id)
+                        self.logger.info(f"Restarted {worker_id}")
+
+        except KeyboardInterrupt:
+            self.logger.warning("Received keyboard interrupt, stopping workers...")
+
+        finally:
+            for process in self.processes.values():
+                process.terminate()
+            for process in self.processes.values():
+                process.join()
+            self.redisconn.hdel(config.REDIS_WORKERS_KEY, *self.worker_ids)
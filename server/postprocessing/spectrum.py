@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""
+Spectral analysis for the FFT run mode, which is used to choose the corner
+frequencies of the controller's low-pass filters. SpectrumAnalyser takes a
+whole (samples, channels) window at once and computes the amplitude
+spectrum of every analysed channel with a single batched real FFT, with
+optional Welch averaging over overlapping segments to smooth out the noise
+on long windows. Everything that only depends on the window length (the
+taper, the frequency bins and the segment layout) is computed up front.
+
+Spectra can be written to Redis (as raw float32 arrays in a hash) or to .npz
+files, so they can be looked at from the dashboard or a notebook without the
+post-processor needing a display.
+"""
+
+import os
+import time
+from typing import Dict, List, Optional
+import numpy as np
+
+from shared.frames import CHANNEL_INDEX
+
+# Channels that are analysed, and how they are labelled on the plots
+SPECTRUM_CHANNELS = ['acc_x', 'acc_y', 'acc_z', 'gy_x', 'gy_y', 'gy_z', 'pitch', 'roll', 'yaw']
+SPECTRUM_NAMES = ['Accel X', 'Accel Y', 'Accel Z', 'Gyro X', 'Gyro Y', 'Gyro Z', 'Pitch', 'Roll', 'Yaw']
+
+
+class SpectrumAnalyser:
+    """
+    Batched amplitude spectra of a window of frames. With `segment` equal to
+    the window length this is a single Hann-tapered rFFT per channel; with a
+    shorter segment it is Welch's method, i.e. the power spectra of
+    overlapping segments are averaged before taking the square root. The
+    result is scaled so that a sinusoid of amplitude A shows up as a peak of
+    roughly A, regardless of the segment length.
+    """
+
+    def __init__(self, window_size: int, sampling_rate: float, segment: int = 0,
+                 overlap: float = 0.5, channels: Optional[List[str]] = None) -> None:
+        self.window_size = window_size
+        self.sampling_rate = sampling_rate
+        self.segment = segment if 0 < segment <= window_size else window_size
+        self.step = max(1, int(round(self.segment * (1.0 - overlap))))
+        self.n_segments = (window_size - self.segment) // self.step + 1
+
+        self.channels = channels or SPECTRUM_CHANNELS
+        self.channel_index = np.array([CHANNEL_INDEX[c] for c in self.channels])
+
+        self.freqs = np.fft.rfftfreq(self.segment, 1.0 / sampling_rate)
+        self.taper = np.hanning(self.segment)
+        # Amplitude scaling for a one-sided spectrum of a tapered segment
+        self.scale = 2.0 / self.taper.sum()
+
+    def compute(self, window: np.ndarray) -> np.ndarray:
+        """
+        Amplitude spectra of a (window_size, channels) window, oldest frame
+        first. Returns an array shaped (analysed channels, frequency bins),
+        in the order of self.channels and self.freqs.
+        """
+        # (channels, samples), then (channels, segments, segment) as a view
+        signals = window[:, self.channel_index].T
+        segments = np.lib.stride_tricks.sliding_window_view(signals, self.segment, axis=-1)[:, ::self.step]
+
+        # Remove each segment's mean, so the DC bin does not swamp the plots
+        segments = segments - segments.mean(axis=-1, keepdims=True)
+
+        spectra = np.fft.rfft(segments * self.taper, axis=-1)
+        power = np.square(np.abs(spectra)).mean(axis=1)
+        return np.sqrt(power) * self.scale
+
+    def as_dict(self, spectra: np.ndarray) -> Dict[str, np.ndarray]:
+        """Spectra keyed by channel name, plus the frequency bins"""
+        result = {'freqs': self.freqs}
+        result.update(zip(self.channels, spectra))
+        return result
+
+    def metadata(self) -> Dict[str, str]:
+        """Parameters needed to interpret a spectrum, as a flat dict of strings"""
+        return {
+            'sampling_rate': str(self.sampling_rate),
+            'window_size': str(self.window_size),
+            'segment': str(self.segment),
+            'segments': str(self.n_segments),
+            'channels': ",".join(self.channels),
+        }
+
+
+def spectrum_to_redis(redisconn, key: str, analyser: SpectrumAnalyser, spectra: np.ndarray,
+                      version: Optional[int] = None) -> None:
+    """
+    Store a set of spectra as a Redis hash. Each channel and the frequency
+    bins are raw little-endian float32 arrays, which can be read back with
+    np.frombuffer(value, dtype='<f4')
+    """
+    mapping = {name: np.ascontiguousarray(values, dtype='<f4').tobytes()
+               for name, values in analyser.as_dict(spectra).items()}
+    mapping.update(analyser.metadata())
+    mapping['timestamp'] = repr(time.time())
+    if version is not None:
+        mapping['version'] = str(version)
+
+    redisconn.hset(key, mapping=mapping)
+
+
+def spectrum_to_file(directory: str, analyser: SpectrumAnalyser, spectra: np.ndarray,
+                     version: Optional[int] = None) -> str:
+    """Save a set of spectra as an .npz file in `directory`, returning its path"""
+    os.makedirs(directory, exist_ok=True)
+    now = time.time()
+    name = time.strftime("spectrum-%Y%m%d-%H%M%S", time.localtime(now))
+    if version is not None:
+        name += f"-v{version}"
+    path = os.path.join(directory, name + ".npz")
+
+    np.savez(path, timestamp=now, **analyser.as_dict(spectra), **analyser.metadata())
+    return path
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""
+Compact binary capture of raw UDP sessions, so that field sessions can be
+replayed through the server later (see controller-simulation.py replay). A
+capture file is a short header followed by one record per datagram:
+
+    header: magic (8s), format version (H), reserved (H), start time (d)
+    record: receipt time (d), source IPv4 (I), source port (H), length (H),
+            followed by `length` bytes of payload, exactly as received
+
+All fields are little-endian, and times are wall-clock seconds. This module
+only depends on the standard library so that the simulator can use it
+without the rest of the server's requirements.
+"""
+
+import os
+import socket
+import struct
+import time
+from typing import BinaryIO, Iterator, Optional, Tuple
+
+CAPTURE_MAGIC = b'LUMECAP\0'
+CAPTURE_VERSION = 1
+
+HEADER_STRUCT = struct.Struct('<8sHHd')
+RECORD_STRUCT = struct.Struct('<dIHH')
+
+# Records are buffered and flushed to disk at least this often
+FLUSH_EVERY = 256
+
+
+class CaptureWriter:
+    """Append datagrams to a capture file"""
+
+    def __init__(self, path: str, start_time: float) -> None:
+        self.path = path
+        self.file: BinaryIO = open(path, 'wb')
+        self.file.write(HEADER_STRUCT.pack(CAPTURE_MAGIC, CAPTURE_VERSION, 0, start_time))
+        self.records = 0
+
+    def write(self, timestamp: float, payload, addr: Optional[Tuple[str, int]] = None) -> None:
+        """Record a single datagram. `payload` may be any bytes-like object,
+        e.g. a memoryview onto a receive buffer, and is not copied"""
+        if addr is not None:
+            ip = struct.unpack('<I', socket.inet_aton(addr[0]))[0]
+            port = addr[1]
+        else:
+            ip, port = 0, 0
+
+        self.file.write(RECORD_STRUCT.pack(timestamp, ip, port, len(payload)))
+        self.file.write(payload)
+
+        self.records += 1
+        if self.records % FLUSH_EVERY == 0:
+            self.file.flush()
+
+    def close(self) -> None:
+        self.file.close()
+
+
+def open_capture(directory: str) -> CaptureWriter:
+    """Start a new capture file in `directory`, named after the current time"""
+    os.makedirs(directory, exist_ok=True)
+    now = time.time()
+    path = os.path.join(directory, time.strftime("capture-%Y%m%d-%H%M%S.lcap", time.localtime(now)))
+    return CaptureWriter(path, now)
+
+
+def read_capture(path: str) -> Iterator[Tuple[float, Tuple[str, int], bytes]]:
+    """Yield (receipt time, source address, payload) for every record in a
+    capture file, in the order they were received"""
+    with open(path, 'rb') as f:
+        header = f.read(HEADER_STRUCT.size)
+        if len(header) < HEADER_STRUCT.size:
+            raise ValueError(f"{path} is too short to be a capture file")
+
+        magic, version, _, _ = HEADER_STRUCT.unpack(header)
+        if magic != CAPTURE_MAGIC:
+            raise ValueError(f"{path} is not a capture file")
+        if version != CAPTURE_VERSION:
+            raise ValueError(f"Unsupported capture format version {version}")
+
+        while True:
+            record = f.read(RECORD_STRUCT.size)
+            if len(record) < RECORD_STRUCT.size:
+                return  # end of file (or a record cut short by a crash)
+
+            timestamp, ip, port, length = RECORD_STRUCT.unpack(record)
+            payload = f.read(length)
+            if len(payload) < length:
+                return
+
+            yield timestamp, (socket.inet_ntoa(struct.pack('<I', ip)), port), payload
@@ -1,4 +1,5 @@
 import os
+from typing import Optional
 
 class Config:
     # Load the configuration options from the .env file - note that the values
@@ -11,6 +12,16 @@ class Config:
     REDIS_UID_VARIABLE: str = os.getenv('REDIS_UID_VARIABLE', 'operator_uid')
     REDIS_RECORD_VARIABLE: str = os.getenv('REDIS_RECORD_VARIABLE', 'record_gesture')
     REDIS_DATA_VERSION_CHANNEL: str = os.getenv('REDIS_DATA_VERSION_CHANNEL', 'window_version')
+    REDIS_FRAMES_STREAM: str = os.getenv('REDIS_FRAMES_STREAM', 'sensor_frames')
+    REDIS_SESSIONS_KEY: str = os.getenv('REDIS_SESSIONS_KEY', 'sessions')
+    REDIS_RUN_MODE_VARIABLE: str = os.getenv('REDIS_RUN_MODE_VARIABLE', 'run_mode')
+    REDIS_INGEST_STATS_KEY: str = os.getenv('REDIS_INGEST_STATS_KEY', 'ingest_stats')
+    REDIS_LINK_STATS_KEY: str = os.getenv('REDIS_LINK_STATS_KEY', 'link_stats')
+    REDIS_PROCESSING_STATS_KEY: str = os.getenv('REDIS_PROCESSING_STATS_KEY', 'processing_stats')
+    REDIS_SPECTRUM_KEY: str = os.getenv('REDIS_SPECTRUM_KEY', 'spectrum')
+    REDIS_SENSORS_CHANNEL: str = os.getenv('REDIS_SENSORS_CHANNEL', 'sensors')
+    REDIS_WORKERS_KEY: str = os.getenv('REDIS_WORKERS_KEY', 'postprocessing_workers')
+    REDIS_DB_STATS_KEY: str = os.getenv('REDIS_DB_STATS_KEY', 'training_db_stats')
     
     # Lume System Configuration
     LUME_RUN_MODE: str = os.getenv('LUME_RUN_MODE', 'deploy')  # default to deployment mode
@@ -22,6 +33,52 @@ class Config:
     LUME_FFT_DATA_WINDOW_SIZE: int = int(os.getenv('LUME_FFT_DATA_WINDOW_SIZE', '1024'))
     LUME_DEPLOY_DATA_WINDOW_SIZE: int = int(os.getenv('LUME_DEPLOY_DATA_WINDOW_SIZE', '48'))
     LUME_SAMPLING_RATE: int = int(os.getenv('LUME_SAMPLING_RATE', '64'))
+    LUME_REDIS_PIPELINE: bool = os.getenv('LUME_REDIS_PIPELINE', 'true').lower() == 'true'
+    LUME_LATENCY_REPORT_INTERVAL: int = int(os.getenv('LUME_LATENCY_REPORT_INTERVAL', '640'))
+    LUME_INGEST_MODE: str = os.getenv('LUME_INGEST_MODE', 'sync')  # 'sync' or 'async'
+    LUME_SESSION_TIMEOUT: float = float(os.getenv('LUME_SESSION_TIMEOUT', '3.0'))
+    LUME_INGEST_QUEUE_SIZE: int = int(os.getenv('LUME_INGEST_QUEUE_SIZE', '4096'))
+    LUME_UDP_DRAIN: bool = os.getenv('LUME_UDP_DRAIN', 'true').lower() == 'true'
+    LUME_UDP_RCVBUF: int = int(os.getenv('LUME_UDP_RCVBUF', '1048576'))  # bytes, 0 keeps the OS default
+    # Frame transport between sockets and post-processing: 'redis', or 'shm'
+    # when both run on the same host (and share an IPC namespace, as set up by
+    # docker-compose.shm.yaml)
+    LUME_TRANSPORT: str = os.getenv('LUME_TRANSPORT', 'redis')
+    LUME_SHM_NAME: str = os.getenv('LUME_SHM_NAME', 'lume_frames')
+    LUME_SHM_RING_CAPACITY: int = int(os.getenv('LUME_SHM_RING_CAPACITY', '4096'))
+    # Directory to record raw UDP captures into, empty to disable capturing
+    LUME_CAPTURE_DIR: str = os.getenv('LUME_CAPTURE_DIR', '')
+    # How post-processing computes window features: 'incremental' (running
+    # sums, updated per frame) or 'batch' (whole window at once)
+    LUME_FEATURE_ENGINE: str = os.getenv('LUME_FEATURE_ENGINE', 'incremental')
+    # Add spectral features to the feature packets (packet layout version 2)
+    LUME_SPECTRAL_FEATURES: bool = os.getenv('LUME_SPECTRAL_FEATURES', 'false').lower() == 'true'
+    # Publish a feature packet every LUME_FEATURE_HOP frames, and at most
+    # LUME_FEATURE_MAX_RATE packets per second (0 for no cap)
+    LUME_FEATURE_HOP: int = int(os.getenv('LUME_FEATURE_HOP', '1'))
+    LUME_FEATURE_MAX_RATE: float = float(os.getenv('LUME_FEATURE_MAX_RATE', '0'))
+    # Encoding of the frames published on the sensors channels: 'f32',
+    # 'f16' or 'f16_delta' (see shared/packer.py), or 'raw' for bare packets
+    LUME_WIRE_ENCODING: str = os.getenv('LUME_WIRE_ENCODING', 'f32')
+    # A self-contained frame is sent every this many, for late subscribers
+    LUME_WIRE_KEYFRAME_INTERVAL: int = int(os.getenv('LUME_WIRE_KEYFRAME_INTERVAL', '64'))
+    # Number of post-processing worker processes to shard controller
+    # sessions across (0 runs a single processor on the global keys)
+    LUME_POSTPROCESSING_WORKERS: int = int(os.getenv('LUME_POSTPROCESSING_WORKERS', '0'))
+    # Seconds without a heartbeat before a worker is considered dead
+    LUME_WORKER_TIMEOUT: float = float(os.getenv('LUME_WORKER_TIMEOUT', '5.0'))
+    # Longest a blocking read for new frames waits before returning empty
+    LUME_WAIT_TIMEOUT_MS: int = int(os.getenv('LUME_WAIT_TIMEOUT_MS', '1000'))
+    # Poll interval for the shm transport, which has no way to block
+    LUME_SHM_POLL_INTERVAL: float = float(os.getenv('LUME_SHM_POLL_INTERVAL', '0.002'))
+    # Where FFT mode sends its spectra: 'plot' (live TkAgg window), 'redis'
+    # or 'file' (.npz files in LUME_FFT_OUTPUT_DIR), the last two headless
+    LUME_FFT_OUTPUT: str = os.getenv('LUME_FFT_OUTPUT', 'plot')
+    LUME_FFT_OUTPUT_DIR: str = os.getenv('LUME_FFT_OUTPUT_DIR', 'spectra')
+    # Welch segment length in samples (0 for a single FFT over the window),
+    # and the fraction by which consecutive segments overlap
+    LUME_FFT_SEGMENT: int = int(os.getenv('LUME_FFT_SEGMENT', '0'))
+    LUME_FFT_OVERLAP: float = float(os.getenv('LUME_FFT_OVERLAP', '0.5'))
     
     # PostgreSQL Configuration
     PG_DB_NAME: str = os.getenv('PG_DB_NAME', 'defaultdb')
@@ -29,6 +86,21 @@ class Config:
     PG_DB_USER: str = os.getenv('PG_DB_USER', 'postgres')
     PG_DB_PASS: str = os.getenv('PG_DB_PASS', 'password')
     PG_DB_PORT: int = int(os.getenv('PG_DB_PORT', '5432'))
+    # Connections kept open, and the most that can be open, per process
+    PG_POOL_MIN: int = int(os.getenv('PG_POOL_MIN', '1'))
+    PG_POOL_MAX: int = int(os.getenv('PG_POOL_MAX', '4'))
+    # Gestures fetched per round trip when streaming training data
+    LUME_DB_FETCH_SIZE: int = int(os.getenv('LUME_DB_FETCH_SIZE', '64'))
+    # Recorded gestures waiting to be written to the training DB, beyond
+    # which recording waits for the writer to catch up
+    LUME_DB_WRITE_QUEUE_SIZE: int = int(os.getenv('LUME_DB_WRITE_QUEUE_SIZE', '64'))
+    # Retries of a failed gesture write, the first after LUME_DB_RETRY_DELAY
+    # seconds and doubling from there, before the gestures are spooled to
+    # LUME_DB_SPOOL_DIR as recording files, for importing later. The db
+    # container mounts its default, /app/spool, from the host
+    LUME_DB_WRITE_RETRIES: int = int(os.getenv('LUME_DB_WRITE_RETRIES', '5'))
+    LUME_DB_RETRY_DELAY: float = float(os.getenv('LUME_DB_RETRY_DELAY', '0.5'))
+    LUME_DB_SPOOL_DIR: str = os.getenv('LUME_DB_SPOOL_DIR', 'spool')
     
     # Computed Properties using @property decorator
     @property
@@ -39,6 +111,11 @@ class Config:
     def get_redis_key(self, suffix: str) -> str:
         """Helper method to generate Redis keys with consistent naming"""
         return f"lume:{suffix}"
+
+    def get_session_key(self, base: str, session_id: Optional[str] = None) -> str:
+        """Namespace a Redis key to a single controller session. With no
+        session the global (single controller) key is returned unchanged"""
+        return base if session_id is None else f"{base}:{session_id}"
     
     def validate_config(self) -> bool:
         """Validate configuration values"""
@@ -47,9 +124,35 @@ class Config:
             (self.LUME_FFT_DATA_WINDOW_SIZE > 0, "FFT window size must be positive"),
             (self.LUME_DEPLOY_DATA_WINDOW_SIZE > 0, "Deploy window size must be positive"),
             (self.LUME_SAMPLING_RATE > 0, "Sampling rate must be positive"),
+            (self.LUME_LATENCY_REPORT_INTERVAL > 0, "Latency report interval must be positive"),
+            (self.LUME_INGEST_MODE in ("sync", "async"), "Ingest mode must be 'sync' or 'async'"),
+            (self.LUME_SESSION_TIMEOUT > 0, "Session timeout must be positive"),
+            (self.LUME_INGEST_QUEUE_SIZE > 0, "Ingest queue size must be positive"),
+            (self.LUME_UDP_RCVBUF >= 0, "UDP receive buffer size cannot be negative"),
+            (self.LUME_TRANSPORT in ("redis", "shm"), "Transport must be 'redis' or 'shm'"),
+            (self.LUME_SHM_RING_CAPACITY > 0, "Shared memory ring capacity must be positive"),
+            (self.LUME_FEATURE_ENGINE in ("incremental", "batch"), "Feature engine must be 'incremental' or 'batch'"),
+            (self.LUME_FEATURE_HOP > 0, "Feature hop must be positive"),
+            (self.LUME_FEATURE_MAX_RATE >= 0, "Feature rate cap cannot be negative"),
+            (self.LUME_WIRE_ENCODING in ("raw", "f32", "f16", "f16_delta"),
+             "Wire encoding must be 'raw', 'f32', 'f16' or 'f16_delta'"),
+            (self.LUME_WIRE_KEYFRAME_INTERVAL > 0, "Wire keyframe interval must be positive"),
+            (self.LUME_POSTPROCESSING_WORKERS >= 0, "Number of post-processing workers cannot be negative"),
+            (self.LUME_WORKER_TIMEOUT > 0, "Worker timeout must be positive"),
+            (self.LUME_WAIT_TIMEOUT_MS > 0, "Wait timeout must be positive"),
+            (self.LUME_FFT_OUTPUT in ("plot", "redis", "file"), "FFT output must be 'plot', 'redis' or 'file'"),
+            (self.LUME_FFT_SEGMENT >= 0, "FFT segment length cannot be negative"),
+            (0.0 <= self.LUME_FFT_OVERLAP < 1.0, "FFT overlap must be in [0, 1)"),
+            (self.LUME_SHM_POLL_INTERVAL > 0, "Shared memory poll interval must be positive"),
             (self.PG_DB_PORT > 0, "Database port must be positive"),
             (len(self.PG_DB_NAME.strip()) > 0, "Database name cannot be empty"),
             (len(self.PG_DB_USER.strip()) > 0, "Database user cannot be empty"),
+            (0 <= self.PG_POOL_MIN <= self.PG_POOL_MAX, "Database pool sizes must satisfy 0 <= min <= max"),
+            (self.PG_POOL_MAX > 0, "Database pool size must be positive"),
+            (self.LUME_DB_FETCH_SIZE > 0, "Database fetch size must be positive"),
+            (self.LUME_DB_WRITE_QUEUE_SIZE > 0, "Database write queue size must be positive"),
+            (self.LUME_DB_WRITE_RETRIES >= 0, "Database write retries cannot be negative"),
+            (self.LUME_DB_RETRY_DELAY >= 0, "Database retry delay cannot be negative"),
         ]
         
         for is_valid, error_message in validations:
@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+"""
+Shared access to the training database, for the gesture recorder (db/) and
+the HMM trainer (hmm/). Connections come from a single pool per process, so
+any number of recorders in one process share at most PG_POOL_MAX
+connections. The first connection out of the pool bootstraps the schema:
+the tables, types and indexes are created or migrated under an advisory
+lock, and a version number is recorded, so later startups (in any process)
+only need to read it back. Every pooled connection also prepares the hot
+statements once, when it is first handed out, so that inserting gestures
+does not parse and plan them again each time. Loading gestures goes
+through a named (server-side) cursor instead, which cannot run a prepared
+statement, so that only one batch of rows is held in memory at a time.
+"""
+
+import contextlib
+import threading
+from typing import Iterable, Iterator, List, Tuple
+import numpy as np
+import psycopg2
+import psycopg2.extensions
+import psycopg2.extras
+import psycopg2.pool
+
+from shared.config import config
+from shared.gestures import GESTURE_COLUMNS, GESTURE_SELECT, gesture_to_bytes
+
+USERS_TABLE = "users"
+GESTURES_TABLE = "gestures"
+
+# Columns written for every gesture, in order
+GESTURE_INSERT_COLUMNS = "gesture, user_id, frames, n_frames, n_features, layout"
+
+# Statements per round trip when executing a prepared statement in bulk
+INSERT_PAGE_SIZE = 100
+
+# Bump whenever SCHEMA changes, so that existing databases are migrated
+SCHEMA_VERSION = 2
+
+# Arbitrary key of the advisory lock held while bootstrapping
+SCHEMA_LOCK = 0x4C554D45
+
+# Idempotent, so that it can be run over any earlier version of the schema
+SCHEMA = [
+    f"""
+    CREATE TABLE IF NOT EXISTS {USERS_TABLE}(
+        id TEXT PRIMARY KEY
+    )
+    """,
+    """
+    DO $$
+    BEGIN
+        IF NOT EXISTS (SELECT 1 FROM pg_type WHERE typname = 'gesture_type') THEN
+            CREATE TYPE gesture_type AS ENUM ('takeoff', 'land', 'action_1', 'action_2', 'action_3');
+        END IF;
+    END $$
+    """,
+    f"""
+    CREATE TABLE IF NOT EXISTS {GESTURES_TABLE}(
+        id SERIAL PRIMARY KEY,
+        gesture gesture_type,
+        user_id TEXT REFERENCES users(id) ON DELETE CASCADE,
+        data JSONB
+    )
+    """,
+    # Gestures are stored as columnar float32 frames (see shared/gestures.py).
+    # Older tables only have the JSONB column, which is kept so previously
+    # recorded gestures can still be read
+    *[f"ALTER TABLE {GESTURES_TABLE} ADD COLUMN IF NOT EXISTS {column} {column_type}"
+      for column, column_type in GESTURE_COLUMNS.items()],
+    f"CREATE INDEX IF NOT EXISTS {GESTURES_TABLE}_gesture_idx ON {GESTURES_TABLE} (gesture)",
+]
+
+# Hot statements, prepared on every pooled connection
+PREPARED = {
+    'lume_insert_user': (
+        "(text)",
+        f"INSERT INTO {USERS_TABLE} (id) VALUES ($1) ON CONFLICT (id) DO NOTHING"),
+    'lume_insert_gesture': (
+        "(gesture_type, text, bytea, integer, smallint, smallint)",
+        f"INSERT INTO {GESTURES_TABLE} ({GESTURE_INSERT_COLUMNS}) VALUES ($1, $2, $3, $4, $5, $6)"),
+}
+
+
+class LumeConnection(psycopg2.extensions.connection):
+    """Connection that remembers whether the hot statements are prepared on it"""
+    prepared = False
+
+
+_pool = None
+_pool_lock = threading.Lock()
+_bootstrapped = False
+_bootstrap_lock = threading.Lock()
+
+
+def get_pool() -> psycopg2.pool.ThreadedConnectionPool:
+    """The process-wide connection pool, created on first use"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = psycopg2.pool.ThreadedConnectionPool(
+                config.PG_POOL_MIN, config.PG_POOL_MAX,
+                connection_factory=LumeConnection,
+                database=config.PG_DB_NAME,
+                host=config.PG_DB_HOST,
+                user=config.PG_DB_USER,
+                password=config.PG_DB_PASS,
+                port=config.PG_DB_PORT)
+        return _pool
+
+
+def close_pool() -> None:
+    """Close every pooled connection"""
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.closeall()
+            _pool = None
+
+
+@contextlib.contextmanager
+def connection() -> Iterator[LumeConnection]:
+    """
+    Borrow a pooled connection, with the schema bootstrapped and the hot
+    statements prepared. The transaction is committed if the block
+    completes and rolled back if it raises; a connection that has gone bad
+    is closed rather than returned to the pool
+    """
+    pool = get_pool()
+    conn = pool.getconn()
+    broken = False
+    try:
+        if not conn.prepared:
+            _prepare(conn)
+        yield conn
+        conn.commit()
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        broken = True
+        raise
+    except BaseException:
+        conn.rollback()
+        raise
+    finally:
+        pool.putconn(conn, close=broken or bool(conn.closed))
+
+
+def _prepare(conn: LumeConnection) -> None:
+    """Bootstrap the schema if this process has not yet, then prepare the
+    hot statements on `conn`"""
+    global _bootstrapped
+    with _bootstrap_lock:
+        if not _bootstrapped:
+            bootstrap(conn)
+            _bootstrapped = True
+
+    with conn.cursor() as cursor:
+        for name, (types, statement) in PREPARED.items():
+            cursor.execute(f"PREPARE {name} {types} AS {statement}")
+    conn.commit()
+    conn.prepared = True
+
+
+def bootstrap(conn) -> None:
+    """
+    Create or migrate the schema, unless the recorded version shows it is
+    already current. Runs under an advisory lock, so that recorders starting
+    at the same time do not race each other
+    """
+    with conn.cursor() as cursor:
+        cursor.execute("""
+        SELECT pg_advisory_xact_lock(%s);
+        CREATE TABLE IF NOT EXISTS lume_schema (version INTEGER NOT NULL);
+        SELECT COALESCE(MAX(version), 0) FROM lume_schema;
+        """, (SCHEMA_LOCK,))
+
+        if cursor.fetchone()[0] < SCHEMA_VERSION:
+            for statement in SCHEMA:
+                cursor.execute(statement)
+            cursor.execute("DELETE FROM lume_schema")
+            cursor.execute("INSERT INTO lume_schema (version) VALUES (%s)", (SCHEMA_VERSION,))
+    conn.commit()
+
+
+def insert_users(cursor, ids: Iterable[str]) -> None:
+    """Insert any of `ids` that are not already in the users table"""
+    psycopg2.extras.execute_batch(cursor, "EXECUTE lume_insert_user (%s)",
+                                  [(id,) for id in set(ids)], page_size=INSERT_PAGE_SIZE)
+
+
+def insert_gestures(cursor, gestures: List[Tuple[str, str, np.ndarray, int]]) -> None:
+    """Insert (gesture, user, frames, layout) tuples, creating any users that
+    do not exist yet, with the prepared statements batched into as few round
+    trips as possible. Not committed, so it can be part of a larger
+    transaction"""
+    insert_users(cursor, (user_id for _, user_id, _, _ in gestures))
+    psycopg2.extras.execute_batch(
+        cursor,
+        "EXECUTE lume_insert_gesture (%s, %s, %s, %s, %s, %s)",
+        [(gesture, user_id, psycopg2.Binary(gesture_to_bytes(frames)), frames.shape[0], frames.shape[1], layout)
+         for gesture, user_id, frames, layout in gestures],
+        page_size=INSERT_PAGE_SIZE)
+
+
+def stream_gestures(conn, gesture: str, batch_size: int) -> Iterator[Tuple]:
+    """
+    Every recorded sample of `gesture`, as rows for gesture_array(), fetched
+    through a named server-side cursor `batch_size` rows at a time. Must be
+    consumed inside the transaction of `conn`, i.e. within connection()
+    """
+    with conn.cursor(name=f"lume_stream_{gesture}") as cursor:
+        cursor.itersize = batch_size
+        cursor.execute(f"SELECT {GESTURE_SELECT} FROM {GESTURES_TABLE} WHERE gesture = %s ORDER BY id",
+                       (gesture,))
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            yield from rows
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+"""
+Helpers for the raw sensor frames sent by the controller. Each frame is the
+bitpacked '<12fB' payload exactly as it came off the wire: 12 little-endian
+floats followed by a control byte holding the three flex sensor bits. These
+frames are what sockets.py writes onto the Redis frame stream, and what the
+post-processor reads back out as windows.
+
+Controllers (or the simulator) may also send a sequenced variant, '<12fBI',
+which appends a little-endian uint32 sequence number so that the server can
+count lost packets. Only the '<12fB' part is ever forwarded to Redis.
+"""
+
+from typing import List, Sequence
+import struct
+import numpy as np
+
+SENSOR_FRAME_FORMAT = '<12fB'
+
+SEQUENCED_FRAME_FORMAT = '<12fBI'
+
+# Precompiled, so the format string is not re-parsed for every packet
+SENSOR_FRAME_STRUCT = struct.Struct(SENSOR_FRAME_FORMAT)
+SEQUENCED_FRAME_STRUCT = struct.Struct(SEQUENCED_FRAME_FORMAT)
+
+SENSOR_FRAME_SIZE = SENSOR_FRAME_STRUCT.size        # 49 bytes
+SEQUENCED_FRAME_SIZE = SEQUENCED_FRAME_STRUCT.size  # 53 bytes
+
+# Largest datagram the receive path will accept into a single ring slot
+MAX_DATAGRAM_SIZE = 1024
+
+# Order of the decoded channels, i.e. the 12 floats followed by the 3 flex bits
+SENSOR_CHANNELS = ['pitch', 'roll', 'yaw', 'd_pitch', 'd_roll', 'd_yaw',
+                   'acc_x', 'acc_y', 'acc_z', 'gy_x', 'gy_y', 'gy_z',
+                   'flex0', 'flex1', 'flex2']
+
+CHANNEL_INDEX = {name: i for i, name in enumerate(SENSOR_CHANNELS)}
+
+CONTROL_SIGNAL_LENGTH = 5  # 5 bytes, consisting of LUME and then a number
+
+# Control signal numbers: 0 ESTOP, 1 manual mode, 2 gesture mode, 3 hardware
+# error. Gestures are recorded while a controller is in gesture mode
+CONTROL_GESTURE_MODE = 2
+
+# Field names used inside each Redis stream entry
+STREAM_PAYLOAD_FIELD = b'payload'
+STREAM_TIMESTAMP_FIELD = b'ts'
+
+# Packed (unaligned) layout of a single frame, matching SENSOR_FRAME_FORMAT
+FRAME_DTYPE = np.dtype([('values', '<f4', (12,)), ('control', 'u1')])
+SEQUENCED_FRAME_DTYPE = np.dtype([('values', '<f4', (12,)), ('control', 'u1'), ('seq', '<u4')])
+
+FLEX_MASKS = np.array([0b10000000, 0b01000000, 0b00100000], dtype=np.uint8)
+
+
+def decode_frames(payloads: Sequence[bytes], dtype=np.float64) -> np.ndarray:
+    """
+    Decode a sequence of raw frames into an (n, 15) array, with the channels
+    ordered as in SENSOR_CHANNELS and the flex bits expanded to 0.0/1.0. The
+    whole batch is decoded with a single np.frombuffer call.
+    """
+    raw = np.frombuffer(b''.join(payloads), dtype=FRAME_DTYPE)
+
+    out = np.empty((len(raw), len(SENSOR_CHANNELS)), dtype=dtype)
+    out[:, :12] = raw['values']
+    out[:, 12:] = (raw['control'][:, None] & FLEX_MASKS) != 0
+    return out
+
+
+def decode_stream_entries(entries: List, dtype=np.float64) -> np.ndarray:
+    """Decode the (id, fields) pairs returned by XRANGE/XREVRANGE/XREAD"""
+    return decode_frames([fields[STREAM_PAYLOAD_FIELD] for _, fields in entries], dtype)
+
+
+class FrameRing:
+    """
+    Preallocated ring of receive slots for the UDP server. Datagrams are
+    received straight into the next slot with recv_into(), and each sensor
+    frame is then decoded in place into a fixed-size float32 window array
+    (one row per slot, channels ordered as in SENSOR_CHANNELS). All of the
+    buffers and the per-slot views onto them are built up front, so that
+    receiving and decoding a frame does not allocate in the steady state.
+    """
+
+    def __init__(self, capacity: int, slot_size: int = MAX_DATAGRAM_SIZE) -> None:
+        self.capacity = capacity
+        self.slot_size = slot_size
+
+        self.buffer = bytearray(capacity * slot_size)
+        view = memoryview(self.buffer)
+
+        # Writable views used as recv_into() targets, plus read-only views of
+        # just the frame bytes, handed to Redis when publishing
+        self.slots = [view[i * slot_size:(i + 1) * slot_size] for i in range(capacity)]
+        self.payloads = [view[i * slot_size:i * slot_size + FRAME_DTYPE.itemsize] for i in range(capacity)]
+        self.lengths = [0] * capacity
+
+        # Structured view of the frame at the start of every slot. The
+        # sequence number is only meaningful for sequenced frames
+        frames = np.ndarray((capacity,), dtype=SEQUENCED_FRAME_DTYPE, buffer=self.buffer, strides=(slot_size,))
+        self._raw_seq = frames['seq']
+
+        # Decoded frames, newest at index self.head - 1, plus receipt times
+        self.window = np.zeros((capacity, len(SENSOR_CHANNELS)), dtype=np.float32)
+        self.timestamps = [0.0] * capacity
+
+        # Per-slot views, built once so that nothing is allocated per frame
+        self.rows = [self.window[i] for i in range(capacity)]
+        self._raw_values = [frames['values'][i] for i in range(capacity)]
+        self._raw_control = [frames['control'][i:i + 1] for i in range(capacity)]
+        self._values_rows = [self.window[i, :12] for i in range(capacity)]
+        self._flex_rows = [self.window[i, 12:] for i in range(capacity)]
+        self._flex_scratch = np.zeros(len(FLEX_MASKS), dtype=np.uint8)
+
+        self.head = 0   # index of the next slot to be written
+        self.count = 0  # total number of frames committed
+
+    def next_slot(self) -> memoryview:
+        """Writable buffer for the next datagram, to be passed to recv_into()"""
+        return self.slots[self.head]
+
+    def commit(self, nbytes: int, timestamp: float) -> int:
+        """
+        Decode the frame just received into the window array, and advance the
+        ring. Returns the index of the slot the frame occupies.
+        """
+        i = self.head
+        self.lengths[i] = nbytes
+        self.timestamps[i] = timestamp
+
+        np.copyto(self._values_rows[i], self._raw_values[i])
+        np.bitwise_and(self._raw_control[i], FLEX_MASKS, out=self._flex_scratch)
+        np.not_equal(self._flex_scratch, 0, out=self._flex_rows[i])
+
+        self.head = (i + 1) % self.capacity
+        self.count += 1
+        return i
+
+    def sequence(self, index: int) -> int:
+        """Sequence number of the frame in a slot, or -1 if it was unsequenced"""
+        if self.lengths[index] != SEQUENCED_FRAME_SIZE:
+            return -1
+        return int(self._raw_seq[index])
+
+    def payload(self, index: int) -> memoryview:
+        """The raw frame bytes held in a slot"""
+        return self.payloads[index]
+
+    def ordered_window(self) -> np.ndarray:
+        """Copy of the decoded window, newest frame first. Unlike the rest of
+        the ring this allocates, so it is not meant for the per-packet path"""
+        order = (self.head - 1 - np.arange(min(self.count, self.capacity))) % self.capacity
+        return self.window[order]
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+"""
+Storage format of recorded gestures in the training database. Each gesture
+is one row of the gestures table, with all of its frames in a single bytea
+of little-endian float32 values, row-major (frames, features), alongside its
+shape and the packet layout version that gives the order of the features:
+
+    frames BYTEA, n_frames INTEGER, n_features SMALLINT, layout SMALLINT
+
+This is a fraction of the size of the JSON it replaces, and is read back
+with a single np.frombuffer rather than parsing a dict per frame. Rows
+recorded before this format have their frames as a list of dicts in the
+JSONB `data` column instead, which gesture_array() still reads.
+
+Recordings kept outside the database, e.g. for back-filling, are .npz files
+holding any number of gestures of one user and layout, concatenated:
+
+    frames (all frames, features), lengths (gestures,), gestures (gestures,),
+    user (), layout ()
+"""
+
+from typing import Iterable, Iterator, List, Sequence, Tuple
+import numpy as np
+
+from shared.packer import PACKET_LAYOUTS
+
+GESTURE_DTYPE = np.dtype('<f4')
+
+# Columns added to the gestures table for this format, with their types
+GESTURE_COLUMNS = {
+    'frames': 'BYTEA',
+    'n_frames': 'INTEGER',
+    'n_features': 'SMALLINT',
+    'layout': 'SMALLINT',
+}
+
+# Columns to select for gesture_array(), in order
+GESTURE_SELECT = "frames, n_frames, n_features, layout, data"
+
+
+def gesture_to_bytes(frames: np.ndarray) -> bytes:
+    """Serialise a (frames, features) array for the `frames` column"""
+    return np.ascontiguousarray(frames, dtype=GESTURE_DTYPE).tobytes()
+
+
+def gesture_from_bytes(data, n_frames: int, n_features: int) -> np.ndarray:
+    """View the `frames` column as a (frames, features) float32 array,
+    without copying. `data` may be bytes or a memoryview, as psycopg2
+    returns for bytea"""
+    return np.frombuffer(data, dtype=GESTURE_DTYPE).reshape(n_frames, n_features)
+
+
+def gesture_array(row: Sequence, fields: List[str], dtype=np.float32) -> np.ndarray:
+    """
+    Turn a row selected with GESTURE_SELECT into a (frames, len(fields))
+    array holding just `fields`, in that order, from either storage format.
+    The result is allocated once at its final size and filled in directly
+    """
+    frames, n_frames, n_features, layout, data = row
+
+    if frames is not None:
+        layout_fields = PACKET_LAYOUTS[layout]
+        columns = [layout_fields.index(f) for f in fields]
+        source = gesture_from_bytes(frames, n_frames, n_features)
+        out = np.empty((n_frames, len(fields)), dtype=dtype)
+
+        # A contiguous run of columns is copied straight from a view
+        if columns == list(range(columns[0], columns[0] + len(columns))):
+            out[:] = source[:, columns[0]:columns[0] + len(columns)]
+        else:
+            out[:] = source[:, columns]
+        return out
+
+    # Legacy JSON rows: a list of dicts keyed by field name
+    data = data or []
+    out = np.empty((len(data), len(fields)), dtype=dtype)
+    for i, frame in enumerate(data):
+        out[i] = [frame[f] for f in fields]
+    return out
+
+
+def _copy_text(value: str) -> str:
+    """Escape a text value for COPY text format"""
+    return value.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+def gesture_copy_row(gesture: str, user_id: str, frames: np.ndarray, layout: int) -> str:
+    """One line of COPY text format input for the gestures table, for the
+    columns (gesture, user_id, frames, n_frames, n_features, layout). The
+    bytea is hex encoded, with its backslash escaped for COPY"""
+    return (f"{_copy_text(gesture)}\t{_copy_text(user_id)}\t\\\\x{gesture_to_bytes(frames).hex()}\t"
+            f"{frames.shape[0]}\t{frames.shape[1]}\t{layout}\n")
+
+
+class CopyRows:
+    """
+    Read-only file-like object over an iterable of COPY rows, for
+    cursor.copy_expert(). Rows are only produced as the COPY reads them, so
+    however much is being imported, just one row is held in memory at a time
+    """
+
+    def __init__(self, rows: Iterable[str]) -> None:
+        self.rows = iter(rows)
+        self.row = ''
+        self.pos = 0
+
+    def read(self, size: int = -1) -> str:
+        chunks = []
+        while size != 0:
+            if self.pos == len(self.row):
+                self.row = next(self.rows, '')
+                self.pos = 0
+                if not self.row:
+                    break
+            end = len(self.row) if size < 0 else min(len(self.row), self.pos + size)
+            chunks.append(self.row[self.pos:end])
+            if size > 0:
+                size -= end - self.pos
+            self.pos = end
+        return ''.join(chunks)
+
+
+def save_recording(path: str, user_id: str, layout: int, gestures: List[Tuple[str, np.ndarray]]) -> None:
+    """Save (gesture, (frames, features) array) pairs as a recording file"""
+    np.savez(path,
+             frames=np.concatenate([frames for _, frames in gestures]).astype(GESTURE_DTYPE),
+             lengths=np.array([len(frames) for _, frames in gestures]),
+             gestures=np.array([gesture for gesture, _ in gestures]),
+             user=user_id, layout=layout)
+
+
+def recording_user(path: str) -> str:
+    """The user a recording file belongs to, without loading its frames"""
+    with np.load(path) as recording:
+        return str(recording['user'])
+
+
+def read_recording(path: str) -> Iterator[Tuple[str, str, np.ndarray, int]]:
+    """Yield (gesture, user, frames, layout) for every gesture in a recording
+    file, the frames being views into one array loaded from it"""
+    with np.load(path) as recording:
+        frames = recording['frames']
+        user_id = str(recording['user'])
+        layout = int(recording['layout'])
+        bounds = np.cumsum(recording['lengths'])[:-1]
+        for gesture, gesture_frames in zip(recording['gestures'], np.split(frames, bounds)):
+            yield str(gesture), user_id, gesture_frames, layout
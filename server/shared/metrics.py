@@ -0,0 +1,198 @@
+"""
+Lightweight runtime metrics shared between the server containers. These are
+deliberately dependency-free so that they can sit on the per-packet path
+without pulling in anything heavier than the standard library.
+"""
+
+import time
+from typing import Dict, Optional
+
+PROC_NET_UDP = ('/proc/net/udp', '/proc/net/udp6')
+
+
+class LatencyTracker:
+    """Accumulate latency samples and summarise them over a reporting period.
+
+    Samples are kept in a fixed-size list which is overwritten in place, so
+    recording a sample does not allocate once the tracker has warmed up.
+    """
+
+    def __init__(self, name: str, capacity: int = 1024) -> None:
+        self.name = name
+        self.capacity = capacity
+        self.samples = [0.0] * capacity
+        self.count = 0
+
+    def record(self, seconds: float) -> None:
+        """Record a single latency sample, in seconds"""
+        self.samples[self.count % self.capacity] = seconds
+        self.count += 1
+
+    def record_since(self, start: float) -> float:
+        """Record the time elapsed since `start` (a time.perf_counter() value)"""
+        elapsed = time.perf_counter() - start
+        self.record(elapsed)
+        return elapsed
+
+    def summary(self, reset: bool = True) -> Optional[Dict[str, float]]:
+        """Return mean/p50/p99/max in milliseconds for the current period, or
+        None if nothing has been recorded since the last reset"""
+        n = min(self.count, self.capacity)
+        if n == 0:
+            return None
+
+        ordered = sorted(self.samples[:n])
+        result = {
+            "n": float(self.count),
+            "mean_ms": 1000.0 * sum(ordered) / n,
+            "p50_ms": 1000.0 * ordered[n // 2],
+            "p99_ms": 1000.0 * ordered[min(n - 1, int(n * 0.99))],
+            "max_ms": 1000.0 * ordered[-1],
+        }
+
+        if reset:
+            self.count = 0
+
+        return result
+
+    def format_summary(self, reset: bool = True) -> Optional[str]:
+        """Human readable version of summary(), for logging"""
+        s = self.summary(reset)
+        if s is None:
+            return None
+        return (f"{self.name}: n={int(s['n'])} mean={s['mean_ms']:.3f}ms "
+                f"p50={s['p50_ms']:.3f}ms p99={s['p99_ms']:.3f}ms max={s['max_ms']:.3f}ms")
+
+
+def read_udp_drops(port: int) -> Optional[int]:
+    """
+    Read the number of datagrams the kernel has dropped for the UDP socket(s)
+    bound to `port`, from the 'drops' column of /proc/net/udp. Returns None
+    where this is not available (i.e. not on Linux).
+    """
+    suffix = f":{port:04X}"
+    total = None
+
+    for path in PROC_NET_UDP:
+        try:
+            with open(path) as f:
+                next(f)  # header
+                for line in f:
+                    fields = line.split()
+                    if fields[1].endswith(suffix):
+                        total = (total or 0) + int(fields[-1])
+        except (OSError, StopIteration, ValueError, IndexError):
+            continue
+
+    return total
+
+
+class LinkStats:
+    """
+    Per-controller link quality: achieved packet rate against the nominal
+    sampling rate, inter-arrival jitter, and (for sequenced frames) lost,
+    duplicated and reordered packets. Inter-arrival times are also binned
+    into a histogram, with bin edges set as multiples of the nominal period.
+    The rate and histogram are rolling, i.e. they cover the period since the
+    last call to snapshot(); loss counts are kept both per period and in total.
+    """
+
+    # Histogram bin edges, as multiples of the nominal inter-arrival period.
+    # Anything beyond the last edge lands in a final overflow bin
+    BIN_MULTIPLES = (0.25, 0.5, 0.75, 1.25, 1.5, 2.0, 3.0, 4.0)
+
+    # Sequence numbers are uint32, so allow for them wrapping
+    SEQ_MODULUS = 1 << 32
+
+    def __init__(self, nominal_rate: float) -> None:
+        self.nominal_rate = nominal_rate
+        self.period = 1.0 / nominal_rate
+        self.bin_edges = [m * self.period for m in self.BIN_MULTIPLES]
+
+        self.last_arrival = None
+        self.last_seq = None
+        self.jitter = 0.0
+
+        self.lost_total = 0
+        self.received_total = 0
+        self._reset_period(time.perf_counter())
+
+    def _reset_period(self, now: float) -> None:
+        self.period_start = now
+        self.received = 0
+        self.lost = 0
+        self.duplicated = 0
+        self.reordered = 0
+        self.histogram = [0] * (len(self.bin_edges) + 1)
+
+    def record(self, arrival: Optional[float], seq: int = -1) -> None:
+        """Record a frame arriving at `arrival` (a time.perf_counter() value),
+        with its sequence number if it had one. An arrival of None means the
+        time is not known, e.g. for a frame drained from the socket buffer
+        along with others, and leaves it and the interval after it out of
+        the jitter and histogram"""
+        self.received += 1
+        self.received_total += 1
+
+        if arrival is not None and self.last_arrival is not None:
+            interval = arrival - self.last_arrival
+
+            # Smoothed deviation from the nominal period, as in RFC 3550
+            self.jitter += (abs(interval - self.period) - self.jitter) / 16.0
+
+            b = 0
+            while b < len(self.bin_edges) and interval >= self.bin_edges[b]:
+                b += 1
+            self.histogram[b] += 1
+
+        self.last_arrival = arrival
+
+        if seq < 0:
+            return
+
+        if self.last_seq is not None:
+            gap = (seq - self.last_seq) % self.SEQ_MODULUS
+            if gap == 0:
+                self.duplicated += 1
+                return
+            elif gap > self.SEQ_MODULUS // 2:
+                # Older than the last frame we saw, i.e. arrived out of order.
+                # It was counted as lost when the gap opened, so undo that
+                self.reordered += 1
+                self.lost = max(0, self.lost - 1)
+                self.lost_total = max(0, self.lost_total - 1)
+                return
+            elif gap > 1:
+                self.lost += gap - 1
+                self.lost_total += gap - 1
+
+        self.last_seq = seq
+
+    def snapshot(self, reset: bool = True) -> Dict[str, str]:
+        """Summarise the current period as a flat dict of strings, suitable
+        for HSET. Starts a new period unless `reset` is False"""
+        now = time.perf_counter()
+        elapsed = now - self.period_start
+        rate = self.received / elapsed if elapsed > 0 else 0.0
+        expected = self.received + self.lost
+
+        result = {
+            'rate_hz': f"{rate:.2f}",
+            'nominal_rate_hz': f"{self.nominal_rate:.2f}",
+            'rate_ratio': f"{rate / self.nominal_rate:.3f}",
+            'jitter_ms': f"{1000.0 * self.jitter:.3f}",
+            'received': str(self.received),
+            'lost': str(self.lost),
+            'loss_ratio': f"{self.lost / expected:.4f}" if expected else "0.0000",
+            'duplicated': str(self.duplicated),
+            'reordered': str(self.reordered),
+            'received_total': str(self.received_total),
+            'lost_total': str(self.lost_total),
+            'hist_edges_ms': ",".join(f"{1000.0 * e:.2f}" for e in self.bin_edges),
+            'hist_counts': ",".join(str(c) for c in self.histogram),
+        }
+
+        if reset:
+            self._reset_period(now)
+
+        return result
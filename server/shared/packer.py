@@ -3,68 +3,354 @@
 Post processing to be done server-side for sensor data being received. This
 includes calculating means, variances and energies. There is also an option to
 do an FFT, as this was required for choosing the appropriate corner frequency
-for the LPFs on the controller side. 
+for the LPFs on the controller side.
+
+Feature packets come in versioned layouts. Version 1 is the original
+time-domain packet; version 2 adds spectral features for every accelerometer
+and gyro axis. In both, every feature is a float32 apart from the three flex
+sensors, which are bitpacked into a final byte. The layouts have different
+sizes, so the version of a packet is told apart by its length.
+
+Batches of packets are handled as numpy structured arrays: unpack_array()
+and pack_array() convert a whole run of concatenated packets at once, and
+the per-packet pack_binary()/unpack_binary() are thin wrappers over them.
+
+What is published on the sensors channels is a wire frame around a packet:
+
+    header: magic (2s), wire version (B), flags (B), packet layout (B),
+            session IPv4 (I), session port (H), sequence number (I),
+            timestamp of the newest sample (d)
+    body:   the features, as float32 or float16, optionally as differences
+            from the previous frame, then the flex byte unless unchanged
+
+WireEncoder and WireDecoder keep the state needed for the delta-coded and
+flex-suppressed frames. Every `keyframe_interval` frames a self-contained
+one is sent, so a subscriber joining late, or one that missed a frame,
+can pick the stream back up. Headerless packets (LUME_WIRE_ENCODING=raw)
+are still understood by the decoder.
+
+Recording start and stop are published on the same channel as 12-byte
+control messages (magic, command, reserved, timestamp), so that they arrive
+in order with the frames and the recorder can cut a gesture at the exact
+sample times rather than whenever it next polls.
 """
 
-from typing import List, Dict
+from typing import List, Dict, NamedTuple, Optional, Tuple
+import socket
 import struct
+import numpy as np
+
+# Version 1: time-domain features only
+PACKET_FIELDS_V1 = ['pitch', 'roll', 'yaw',
+                    'd_pitch', 'd_roll', 'd_yaw',
+                    'acc_x', 'acc_y', 'acc_z',
+                    'acc_x_mean', 'acc_y_mean', 'acc_z_mean',
+                    'acc_x_var', 'acc_y_var', 'acc_z_var',
+                    'gy_x', 'gy_y', 'gy_z',
+                    'gy_x_mean', 'gy_y_mean', 'gy_z_mean',
+                    'gy_x_var', 'gy_y_var', 'gy_z_var',
+                    'acc_energy', 'gy_energy',
+                    'flex0', 'flex1', 'flex2']
+
+# Version 2 adds these for every axis, between the energies and the flex bits
+SPECTRAL_AXES = ['acc_x', 'acc_y', 'acc_z', 'gy_x', 'gy_y', 'gy_z']
+SPECTRAL_FEATURES = ['dom_freq', 'centroid', 'band_low', 'band_mid', 'band_high']
+SPECTRAL_FIELDS = [f"{axis}_{feature}" for axis in SPECTRAL_AXES for feature in SPECTRAL_FEATURES]
+
+PACKET_FIELDS_V2 = PACKET_FIELDS_V1[:-3] + SPECTRAL_FIELDS + PACKET_FIELDS_V1[-3:]
+
+PACKET_LAYOUTS = {
+    1: PACKET_FIELDS_V1,
+    2: PACKET_FIELDS_V2,
+}
+
+# Every field but the flex bits is a float, and they share the final byte
+PACKET_STRUCTS = {version: struct.Struct(f'<{len(fields) - 3}fB')
+                  for version, fields in PACKET_LAYOUTS.items()}
+
+# The same layouts as numpy structured dtypes, for whole batches of packets.
+# These are unaligned, so a run of concatenated packets can be viewed with a
+# single np.frombuffer()
+PACKET_DTYPES = {version: np.dtype([('values', '<f4', (len(fields) - 3,)), ('flex', 'u1')])
+                 for version, fields in PACKET_LAYOUTS.items()}
+
+# Lookups for telling layouts apart
+VERSION_BY_SIZE = {s.size: version for version, s in PACKET_STRUCTS.items()}
+VERSION_BY_LENGTH = {len(fields): version for version, fields in PACKET_LAYOUTS.items()}
+
+# Bits of flex0, flex1 and flex2 in the flex byte
+FLEX_BITS = 3
+
+def packet_version(data : bytes) -> int:
+    """Work out the layout version of a packed feature packet from its size"""
+    try:
+        return VERSION_BY_SIZE[len(data)]
+    except KeyError:
+        raise ValueError(f"Feature packet of {len(data)} bytes does not match any known layout")
+
+def batch_version(data : bytes) -> int:
+    """Work out the layout version of a run of concatenated packets. Only
+    possible if exactly one layout divides the length, so callers that know
+    the version should pass it instead"""
+    candidates = [version for size, version in VERSION_BY_SIZE.items() if len(data) % size == 0]
+    if len(candidates) != 1:
+        raise ValueError(f"Cannot tell the layout of {len(data)} bytes of feature packets, "
+                         f"pass the version explicitly")
+    return candidates[0]
 
-def pack_binary(data : List[float]) -> bytes:
-    """Pack the filtered and post-processed sensor data into bytes""" 
+def unpack_records(data : bytes, version : Optional[int] = None) -> np.ndarray:
+    """
+    View a run of concatenated packets as a structured array of the
+    layout's dtype, without copying. `data` may be any bytes-like object
+    (bytes, bytearray, memoryview, ...)
+    """
+    if version is None:
+        version = batch_version(data)
+
+    dtype = PACKET_DTYPES[version]
+    if len(data) % dtype.itemsize:
+        raise ValueError(f"{len(data)} bytes is not a whole number of version {version} packets")
+    return np.frombuffer(data, dtype=dtype)
+
+def unpack_array(data : bytes, version : Optional[int] = None, dtype=np.float32) -> np.ndarray:
+    """
+    Unpack a run of concatenated packets into a (packets, fields) array, in
+    the field order of the layout, with the flex bits expanded to 0.0/1.0
+    """
+    records = unpack_records(data, version)
+    out = np.empty((len(records), records.dtype['values'].shape[0] + FLEX_BITS), dtype=dtype)
+    out[:, :-FLEX_BITS] = records['values']
+    out[:, -FLEX_BITS:] = np.unpackbits(records['flex'][:, None], axis=1, count=FLEX_BITS)
+    return out
+
+def pack_array(values : np.ndarray, version : Optional[int] = None,
+               out : Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    Pack feature packets shaped (..., fields) into a structured array of the
+    layout's dtype, which can be sent as is (it supports the buffer
+    protocol) or turned into bytes with .tobytes(). `out` may be a
+    preallocated array of the right dtype and shape, e.g. np.frombuffer()
+    over a bytearray that gets published, to avoid any allocation
+    """
+    values = np.asarray(values)
+    if version is None:
+        version = VERSION_BY_LENGTH[values.shape[-1]]
+    if out is None:
+        out = np.empty(values.shape[:-1], dtype=PACKET_DTYPES[version])
 
-    # First pack the values of flex0, flex1 and flex2 into a boolean (these
-    # are passed as 0.0, or 1.0 into the function)
-    flex_byte = 0x0
-    flex_byte |= (0b10000000 if data[-3] == 1.0 else 0b0)
-    flex_byte |= (0b01000000 if data[-2] == 1.0 else 0b0)
-    flex_byte |= (0b00100000 if data[-1] == 1.0 else 0b0)
+    out['values'] = values[..., :-FLEX_BITS]
 
-    data = data[:-3]
-    data.append(flex_byte)
+    # The flex bits are the top three bits of the byte, in order, which is
+    # exactly what packbits produces
+    out['flex'] = np.packbits(values[..., -FLEX_BITS:] == 1.0, axis=-1)[..., 0]
+    return out
 
-    packed_data = struct.pack('<26fB', *data)
-    return packed_data
+def pack_binary(data : List[float], version : Optional[int] = None) -> bytes:
+    """Pack the filtered and post-processed sensor data into bytes. The
+    layout version is inferred from the number of values if not given. The
+    flex values are passed as 0.0, or 1.0 into the function"""
+    return pack_array(np.asarray(data, dtype=np.float64), version).tobytes()
 
 def unpack_binary(data : bytes) -> Dict:
     """
     Unpack the data from bytes into a dictionary to be stored in postgres.
     This function is not responsible for converting to json, though this can
-    easily be done using json.dumps() later on
+    easily be done using json.dumps() later on. Any layout version is
+    accepted; the keys are the fields of that version, in order. For more
+    than a handful of packets, use unpack_array() instead
     """
-    
-    unpacked = struct.unpack('<26fB', data)
-
-    result = {
-            "pitch":    unpacked[0], 
-            "roll" :    unpacked[1], 
-            "yaw" :     unpacked[2],
-            "d_pitch" : unpacked[3],
-            "d_roll" :  unpacked[4],
-            "d_yaw" :   unpacked[5],
-            "acc_x" :   unpacked[6],
-            "acc_y" :   unpacked[7],
-            "acc_z" :   unpacked[8],
-            "acc_x_mean" :  unpacked[9],
-            "acc_y_mean" :  unpacked[10],
-            "acc_z_mean" :  unpacked[11],
-            "acc_x_var" :   unpacked[12],
-            "acc_y_var" :   unpacked[13],
-            "acc_z_var" :   unpacked[14],
-            "gy_x" :    unpacked[15],
-            "gy_y" :    unpacked[16],
-            "gy_z" :    unpacked[17],
-            "gy_x_mean" :   unpacked[18],
-            "gy_y_mean" :   unpacked[19],
-            "gy_z_mean" :   unpacked[20],
-            "gy_x_var" :    unpacked[21],
-            "gy_y_var" :    unpacked[22],
-            "gy_z_var" :    unpacked[23],
-            "acc_energy" :  unpacked[24],
-            "gy_energy" :   unpacked[25],
-            "flex0" :   float((unpacked[26] & 0b10000000) != 0),
-            "flex1" :   float((unpacked[26] & 0b01000000) != 0),
-            "flex2" :   float((unpacked[26] & 0b00100000) != 0)
-            }
-
-    return result
+    version = packet_version(data)
+    values = unpack_array(data, version)[0]
+    return dict(zip(PACKET_LAYOUTS[version], values.tolist()))
+
+# Wire frames
+WIRE_MAGIC = b'LF'
+WIRE_VERSION = 1
+WIRE_HEADER = struct.Struct('<2sBBBIHId')
+
+# Frame flags
+WIRE_F16 = 0x01             # features are float16 rather than float32
+WIRE_DELTA = 0x02           # features are differences from the previous frame
+WIRE_FLEX_UNCHANGED = 0x04  # flex byte omitted, same as the previous frame
+
+WIRE_ENCODINGS = ('raw', 'f32', 'f16', 'f16_delta')
+
+
+class WireHeader(NamedTuple):
+    version: int
+    flags: int
+    layout: int
+    session: Tuple[str, int]
+    seq: int
+    timestamp: float
+
+
+def session_address(session_id : Optional[str]) -> Tuple[int, int]:
+    """IPv4 (as an integer) and port of an 'ip:port' session ID, or zeros for
+    the single-controller keys. Anything that is not IPv4 gets a zero IP"""
+    if not session_id:
+        return 0, 0
+    ip, _, port = session_id.rpartition(':')
+    try:
+        return struct.unpack('<I', socket.inet_aton(ip))[0], int(port)
+    except (OSError, ValueError):
+        return 0, int(port) if port.isdigit() else 0
+
+
+class WireEncoder:
+    """
+    Wraps feature packets of one layout into wire frames for one session.
+    encode() returns a memoryview onto a buffer that is reused for every
+    frame, so it must be sent before the next call.
+    """
+
+    def __init__(self, layout : int = 1, encoding : str = 'f32', session_id : Optional[str] = None,
+                 keyframe_interval : int = 64) -> None:
+        if encoding not in WIRE_ENCODINGS[1:]:
+            raise ValueError(f"Unknown wire encoding {encoding!r}")
+
+        self.layout = layout
+        self.encoding = encoding
+        self.ip, self.port = session_address(session_id)
+        self.keyframe_interval = keyframe_interval
+        self.n_values = len(PACKET_LAYOUTS[layout]) - FLEX_BITS
+        self.seq = 0
+
+        # Feature values as the decoder will have reconstructed them, which
+        # is what the next delta is taken from, so rounding never accumulates
+        self.reference = np.zeros(self.n_values, dtype=np.float32)
+        self.flex = None
+
+        # Largest possible frame, with float32 views onto its body
+        self.buffer = bytearray(WIRE_HEADER.size + 4 * self.n_values + 1)
+        self.f32 = np.frombuffer(self.buffer, dtype='<f4', count=self.n_values, offset=WIRE_HEADER.size)
+        self.f16 = np.frombuffer(self.buffer, dtype='<f2', count=self.n_values, offset=WIRE_HEADER.size)
+
+    def encode(self, features : np.ndarray, timestamp : float) -> memoryview:
+        """Encode one flat feature packet, laid out as for pack_array()"""
+        values = features[:-FLEX_BITS]
+        flex = int(np.packbits(features[-FLEX_BITS:] == 1.0)[0])
+        keyframe = self.seq % self.keyframe_interval == 0
+        flags = 0
+
+        if self.encoding != 'f32':
+            delta = self.encoding == 'f16_delta' and not keyframe
+            if delta:
+                np.subtract(values, self.reference, out=self.f32)
+            else:
+                self.f32[:] = values
+            with np.errstate(over='ignore'):
+                half = self.f32.astype('<f2')
+
+            # Anything out of float16 range goes out as float32 instead
+            if np.isfinite(half).all():
+                flags |= WIRE_F16 | (WIRE_DELTA if delta else 0)
+                self.f16[:] = half
+                if delta:
+                    self.reference += half
+                else:
+                    self.reference[:] = half
+
+        if not flags & WIRE_F16:
+            self.f32[:] = values
+            self.reference[:] = self.f32
+
+        size = WIRE_HEADER.size + (2 if flags & WIRE_F16 else 4) * self.n_values
+        if not keyframe and flex == self.flex:
+            flags |= WIRE_FLEX_UNCHANGED
+        else:
+            self.buffer[size] = flex
+            size += 1
+        self.flex = flex
+
+        WIRE_HEADER.pack_into(self.buffer, 0, WIRE_MAGIC, WIRE_VERSION, flags, self.layout,
+                              self.ip, self.port, self.seq, timestamp)
+        self.seq = (self.seq + 1) & 0xFFFFFFFF
+        return memoryview(self.buffer)[:size]
+
+
+class WireDecoder:
+    """
+    Decodes the wire frames of one stream (i.e. one sensors channel) back
+    into flat feature packets, keeping track of the previous frame for the
+    delta-coded and flex-suppressed ones.
+    """
+
+    def __init__(self) -> None:
+        self.reference = None
+        self.flex = None
+        self.layout = None
+        self.next_seq = None
+
+    def decode(self, data : bytes) -> Optional[Tuple[WireHeader, np.ndarray]]:
+        """
+        Decode one message into its header and a (fields,) float32 array, in
+        the field order of its layout. Returns None for a frame that cannot
+        be decoded yet, because it depends on a frame that was missed; the
+        stream picks up again at the next keyframe. Headerless packets are
+        returned with a zeroed header.
+        """
+        # No wire frame is the size of a bare packet, so those are told apart
+        # by size alone
+        if len(data) in VERSION_BY_SIZE:
+            layout = packet_version(data)
+            return WireHeader(0, 0, layout, ('', 0), 0, 0.0), unpack_array(data, layout)[0]
+
+        magic, version, flags, layout, ip, port, seq, timestamp = WIRE_HEADER.unpack_from(data)
+        if magic != WIRE_MAGIC or version != WIRE_VERSION:
+            raise ValueError(f"Not a version {WIRE_VERSION} wire frame")
+        header = WireHeader(version, flags, layout, (socket.inet_ntoa(struct.pack('<I', ip)), port),
+                            seq, timestamp)
+
+        # A gap in the sequence, or a new layout, loses the previous frame
+        if seq != self.next_seq or layout != self.layout:
+            self.reference = None
+            self.flex = None
+        self.next_seq = (seq + 1) & 0xFFFFFFFF
+        self.layout = layout
+
+        n_values = len(PACKET_LAYOUTS[layout]) - FLEX_BITS
+        width = 2 if flags & WIRE_F16 else 4
+        body = np.frombuffer(data, dtype='<f2' if width == 2 else '<f4', count=n_values,
+                             offset=WIRE_HEADER.size).astype(np.float32)
+
+        if flags & WIRE_DELTA:
+            if self.reference is None:
+                return None
+            self.reference += body
+        else:
+            self.reference = body
+
+        if not flags & WIRE_FLEX_UNCHANGED:
+            self.flex = data[WIRE_HEADER.size + width * n_values]
+        if self.flex is None:
+            return None
+
+        out = np.empty(n_values + FLEX_BITS, dtype=np.float32)
+        out[:-FLEX_BITS] = self.reference
+        out[-FLEX_BITS:] = np.unpackbits(np.array([self.flex], dtype=np.uint8), count=FLEX_BITS)
+        return header, out
+
+
+# Recording control messages
+RECORD_MAGIC = b'LR'
+RECORD_CONTROL = struct.Struct('<2sBBd')
+RECORD_STOP = 0
+RECORD_START = 1
+
+
+def pack_record_control(recording : bool, timestamp : float) -> bytes:
+    """Control message starting (or stopping) a recording at `timestamp`,
+    a wall-clock time in the same clock as the wire frame timestamps"""
+    return RECORD_CONTROL.pack(RECORD_MAGIC, RECORD_START if recording else RECORD_STOP, 0, timestamp)
+
 
+def unpack_record_control(data : bytes) -> Optional[Tuple[bool, float]]:
+    """(recording, timestamp) if `data` is a control message, None if it is
+    a frame or packet. No frame or packet is the size of a control message"""
+    if len(data) != RECORD_CONTROL.size:
+        return None
+    magic, command, _, timestamp = RECORD_CONTROL.unpack(data)
+    if magic != RECORD_MAGIC:
+        return None
+    return command == RECORD_START, timestamp
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+"""
+Shared-memory transport for decoded sensor frames, for when sockets.py and
+post_processing.py run on the same host. Instead of round-tripping every
+sample through Redis, the UDP server writes float32 frames into a ring held
+in multiprocessing.shared_memory, and the post-processor maps the latest
+window straight out of it.
+
+The ring has a single producer and needs no locks. Every frame is written
+twice, at slot i and at slot i + capacity, so that any window of up to
+`capacity` frames is always one contiguous slice and can be handed out as a
+NumPy view without copying. The write counter in the header is only bumped
+once a frame is fully written, and readers use it as a sequence lock: a view
+taken at counter value `seq` is still intact for as long as the producer has
+not written `capacity - n` further frames.
+"""
+
+from multiprocessing import shared_memory, resource_tracker
+from typing import Optional, Tuple
+import numpy as np
+
+# Header layout (int64 words)
+_SEQ, _CAPACITY, _CHANNELS = 0, 1, 2
+HEADER_WORDS = 8
+HEADER_SIZE = HEADER_WORDS * 8
+
+
+class SharedFrameRing:
+    """Lock-free single-producer ring of float32 frames in shared memory"""
+
+    def __init__(self, shm: shared_memory.SharedMemory, owner: bool) -> None:
+        self.shm = shm
+        self.owner = owner
+
+        self.header = np.ndarray((HEADER_WORDS,), dtype=np.int64, buffer=shm.buf)
+        self.capacity = int(self.header[_CAPACITY])
+        self.channels = int(self.header[_CHANNELS])
+
+        offset = HEADER_SIZE
+        self.timestamps = np.ndarray((2 * self.capacity,), dtype=np.float64,
+                                     buffer=shm.buf, offset=offset)
+        offset += self.timestamps.nbytes
+        self.frames = np.ndarray((2 * self.capacity, self.channels), dtype=np.float32,
+                                 buffer=shm.buf, offset=offset)
+
+    @staticmethod
+    def size_for(capacity: int, channels: int) -> int:
+        """Number of bytes of shared memory needed for a ring"""
+        return HEADER_SIZE + 2 * capacity * 8 + 2 * capacity * channels * 4
+
+    @classmethod
+    def create(cls, name: str, capacity: int, channels: int) -> "SharedFrameRing":
+        """Create (or re-create) the ring as its producer"""
+        size = cls.size_for(capacity, channels)
+        try:
+            shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        except FileExistsError:
+            # Left over from a previous run - start again from scratch
+            stale = shared_memory.SharedMemory(name=name)
+            stale.close()
+            stale.unlink()
+            shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+
+        header = np.ndarray((HEADER_WORDS,), dtype=np.int64, buffer=shm.buf)
+        header[:] = 0
+        header[_CAPACITY] = capacity
+        header[_CHANNELS] = channels
+        del header
+
+        return cls(shm, owner=True)
+
+    @classmethod
+    def attach(cls, name: str) -> Optional["SharedFrameRing"]:
+        """Attach to an existing ring as a reader, or return None if the
+        producer has not created it yet"""
+        try:
+            shm = shared_memory.SharedMemory(name=name)
+        except FileNotFoundError:
+            return None
+
+        # Readers must not unlink the segment when they exit, which the
+        # resource tracker would otherwise do on our behalf
+        try:
+            resource_tracker.unregister(shm._name, 'shared_memory')
+        except Exception:
+            pass
+
+        return cls(shm, owner=False)
+
+    @property
+    def seq(self) -> int:
+        """Total number of frames written so far"""
+        return int(self.header[_SEQ])
+
+    def write(self, frame: np.ndarray, timestamp: float) -> None:
+        """Append a single frame. Only ever called by the producer"""
+        seq = int(self.header[_SEQ])
+        i = seq % self.capacity
+
+        self.frames[i] = frame
+        self.frames[i + self.capacity] = frame
+        self.timestamps[i] = timestamp
+        self.timestamps[i + self.capacity] = timestamp
+
+        # Publish the frame only once it has been fully written
+        self.header[_SEQ] = seq + 1
+
+    def latest(self, n: int) -> Tuple[int, Optional[np.ndarray], Optional[np.ndarray]]:
+        """
+        Map the newest `n` frames, oldest first, without copying. Returns the
+        write counter the view was taken at, plus views of the frames and of
+        their receipt timestamps, or None for both if fewer than `n` frames
+        have been written.
+        """
+        seq = int(self.header[_SEQ])
+        if seq < n:
+            return seq, None, None
+
+        frames, timestamps = self.window(seq, n)
+        return seq, frames, timestamps
+
+    def window(self, stop: int, n: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Map the `n` frames written before the write counter reached
+        `stop`, oldest first, without copying. As with latest(), check
+        overwritten() before trusting anything computed from them"""
+        if n > self.capacity:
+            raise ValueError(f"Window of {n} frames does not fit in a ring of {self.capacity}")
+
+        end = stop % self.capacity + self.capacity
+        return self.frames[end - n:end], self.timestamps[end - n:end]
+
+    def overwritten(self, seq: int, n: int) -> bool:
+        """True if a window of `n` frames mapped at `seq` may since have been
+        (partially) overwritten by the producer, and so must be discarded"""
+        return int(self.header[_SEQ]) - seq > self.capacity - n
+
+    def close(self) -> None:
+        """Detach from the ring, removing it entirely if we are the producer"""
+        # Views onto the buffer must go before it can be released
+        del self.header, self.timestamps, self.frames
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
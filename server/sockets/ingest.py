@@ -0,0 +1,329 @@
+#!/usr/bin/env python3
+"""
+asyncio based UDP ingest server. Unlike the blocking LumeServer, this serves
+any number of controllers from a single event loop, keeping a session per
+source address. Each session gets its own namespaced frame stream and window
+version in Redis, its own run mode and recording state (driven by the
+controller's control signals), and its own liveness tracking. All Redis
+writes go through an async client and are batched across sessions, so a slow
+round trip never holds up the receive path.
+"""
+import asyncio
+import collections
+import logging
+import sys
+import time
+import redis.asyncio
+
+from shared.lume_logger import *
+from shared.config import config
+from shared.metrics import LatencyTracker, LinkStats
+from shared.frames import (CONTROL_GESTURE_MODE, CONTROL_SIGNAL_LENGTH, STREAM_PAYLOAD_FIELD,
+                           STREAM_TIMESTAMP_FIELD, SENSOR_FRAME_SIZE, SEQUENCED_FRAME_SIZE,
+                           SEQUENCED_FRAME_STRUCT)
+from shared.capture import open_capture
+from shared.packer import pack_record_control
+from typing import Dict, Optional, Tuple
+
+# How often the housekeeping task checks for dead sessions and mode changes
+SESSION_CHECK_INTERVAL = 1.0
+
+
+class ControllerSession:
+    """State held for a single controller, keyed on its source address"""
+
+    def __init__(self, addr: Tuple[str, int], mode: str) -> None:
+        self.addr = addr
+        self.session_id = f"{addr[0]}:{addr[1]}"
+        self.stream_key = config.get_session_key(config.REDIS_FRAMES_STREAM, self.session_id)
+        self.version_key = config.get_session_key(config.REDIS_DATA_VERSION_CHANNEL, self.session_id)
+        self.mode_key = config.get_session_key(config.REDIS_RUN_MODE_VARIABLE, self.session_id)
+        self.link_stats_key = config.get_session_key(config.REDIS_LINK_STATS_KEY, self.session_id)
+        self.record_key = config.get_session_key(config.REDIS_RECORD_VARIABLE, self.session_id)
+        self.sensors_channel = config.get_session_key(config.REDIS_SENSORS_CHANNEL, self.session_id)
+        self.set_mode(mode)
+
+        self.last_seen = time.monotonic()
+        self.published = 0
+        self.recording = False
+        self.link_stats = LinkStats(config.LUME_SAMPLING_RATE)
+
+    def set_mode(self, mode: str) -> None:
+        """Switch the run mode, which also decides the window length"""
+        self.mode = mode
+        self.window_size = (config.LUME_FFT_DATA_WINDOW_SIZE if mode == 'fft'
+                            else config.LUME_DEPLOY_DATA_WINDOW_SIZE)
+
+    @property
+    def publishing(self) -> bool:
+        """Frames are published in deploy mode, and otherwise only while a
+        gesture is being recorded, as in the blocking server"""
+        return self.recording or self.mode == "deploy"
+
+
+class IngestProtocol(asyncio.DatagramProtocol):
+    """Thin protocol shim - all of the work is done by AsyncLumeServer"""
+
+    def __init__(self, server: "AsyncLumeServer") -> None:
+        self.server = server
+
+    def datagram_received(self, data: bytes, addr: Tuple[str, int]) -> None:
+        self.server.handle_datagram(data, addr)
+
+    def error_received(self, exc: Exception) -> None:
+        self.server.logger.warning(f"UDP error: {exc}")
+
+
+class AsyncLumeServer:
+    """Multi-controller UDP ingest server built on asyncio"""
+
+    def __init__(self, redisconn: redis.asyncio.Redis, port: int = 8888, verbose: bool = False):
+        """Initialise the asyncio ingest server.
+
+        Args:
+            redisconn: Async Redis client used for all writes
+            port: UDP port number to use (default: 8888)
+            verbose: Enable debug-level logging if True
+        """
+        self.port = port
+        self.redisconn = redisconn
+        self._setup_colored_logging(verbose)
+
+        self.sessions: Dict[Tuple[str, int], ControllerSession] = {}
+
+        # Frames waiting to be written, shared by every session. This is
+        # bounded so that a stalled Redis sheds the oldest frames rather than
+        # growing without limit.
+        self.pending = collections.deque()
+        self.pending_event: Optional[asyncio.Event] = None
+        self.dropped = 0
+
+        # Recording control messages waiting to be written, as (session,
+        # recording, timestamp). These are rare, so are never shed
+        self.controls = collections.deque()
+
+        self.publish_latency = LatencyTracker("packet-to-redis latency")
+
+        # Optionally record every datagram received, for later replay
+        self.capture = None
+        if config.LUME_CAPTURE_DIR:
+            self.capture = open_capture(config.LUME_CAPTURE_DIR)
+            self.logger.info(f"Capturing raw UDP sessions to {self.capture.path}")
+
+    def _setup_colored_logging(self, verbose: bool):
+        """Set up colored logging for the application."""
+        self.logger = logging.getLogger(__name__)
+
+        # Set log level
+        log_level = logging.DEBUG if verbose else logging.INFO
+        self.logger.setLevel(log_level)
+
+        # Create console handler
+        console = logging.StreamHandler(sys.stdout)
+        console.setLevel(log_level)
+
+        # Create and attach formatter
+        formatter = ColoredFormatter() if COLORS_AVAILABLE else logging.Formatter(
+            '%(asctime)s - %(levelname)s - %(message)s')
+        console.setFormatter(formatter)
+
+        # Add handler to logger if not already added
+        if not self.logger.handlers:
+            self.logger.addHandler(console)
+
+        if not COLORS_AVAILABLE:
+            self.logger.warning("colorama not installed. For colored logs, install with: pip install colorama")
+
+    def get_session(self, addr: Tuple[str, int]) -> ControllerSession:
+        """Look up the session for a source address, creating it if this is
+        the first packet we have seen from it"""
+        session = self.sessions.get(addr)
+        if session is None:
+            session = ControllerSession(addr, config.LUME_RUN_MODE)
+            self.sessions[addr] = session
+            self.logger.info(f"New controller session {Fore.CYAN}{session.session_id}{Style.RESET_ALL}")
+        return session
+
+    def handle_datagram(self, data: bytes, addr: Tuple[str, int]) -> None:
+        """Called from the protocol for every datagram received. This must not
+        block, so frames are only queued here and written by _writer()"""
+        session = self.get_session(addr)
+        session.last_seen = time.monotonic()
+
+        if self.capture is not None:
+            self.capture.write(time.time(), data, addr)
+
+        if len(data) == config.LUME_SENSOR_PAYLOAD_SIZE or len(data) == SEQUENCED_FRAME_SIZE:
+            arrival = time.perf_counter()
+            if len(data) == SEQUENCED_FRAME_SIZE:
+                session.link_stats.record(arrival, SEQUENCED_FRAME_STRUCT.unpack(data)[-1])
+                data = data[:SENSOR_FRAME_SIZE]
+            else:
+                session.link_stats.record(arrival)
+
+            if not session.publishing:
+                return
+
+            if len(self.pending) >= config.LUME_INGEST_QUEUE_SIZE:
+                self.pending.popleft()
+                self.dropped += 1
+            self.pending.append((session, data, time.time(), arrival))
+            self.pending_event.set()
+
+        elif len(data) == CONTROL_SIGNAL_LENGTH:
+            command_str = data.decode('utf-8', errors='replace')
+            if command_str[-1] in "0123":
+                self.logger.info(f"Received control signal {command_str[-1]} from {session.session_id}")
+                self.set_recording(session, int(command_str[-1]) == CONTROL_GESTURE_MODE)
+            else:
+                self.logger.warning(f"Invalid control command << {command_str} >> received from {session.session_id}!")
+
+        else:
+            self.logger.warning(f"Incomplete data received from {session.session_id}: {len(data)} bytes, "
+                                f"expected {config.LUME_SENSOR_PAYLOAD_SIZE}")
+
+    def set_recording(self, session: ControllerSession, recording: bool) -> None:
+        """Start or stop recording a gesture from `session`. Like
+        LumeServer.set_recording(), but the control variable and message are
+        namespaced to the session, and they are written by _writer()"""
+        if recording == session.recording:
+            return
+        session.recording = recording
+        self.logger.info(f"{'Recording' if recording else 'Processing'} gesture from {session.session_id}...")
+        self.controls.append((session, recording, time.time()))
+        self.pending_event.set()
+
+    async def _writer(self) -> None:
+        """Drain every queued frame and control message into a single
+        pipelined round trip. Frames that arrive while a round trip is in
+        flight are picked up by the next one, so batches grow naturally with
+        load"""
+        while True:
+            await self.pending_event.wait()
+            self.pending_event.clear()
+
+            if not self.pending and not self.controls:
+                continue
+
+            pipe = self.redisconn.pipeline(transaction=False)
+
+            controls = list(self.controls)
+            self.controls.clear()
+            for session, recording, timestamp in controls:
+                pipe.set(session.record_key, int(recording))
+                pipe.publish(session.sensors_channel, pack_record_control(recording, timestamp))
+
+            touched = {}
+            queued = collections.Counter()
+            oldest = self.pending[0][3] if self.pending else None
+            count = len(self.pending)
+
+            while self.pending:
+                session, payload, timestamp, _ = self.pending.popleft()
+
+                pipe.xadd(session.stream_key,
+                          {STREAM_PAYLOAD_FIELD: payload, STREAM_TIMESTAMP_FIELD: repr(timestamp)},
+                          maxlen=session.window_size, approximate=True)
+
+                # The counts are only committed once the frames are written, so
+                # the window versions keep track of what is really on the stream
+                queued[session] += 1
+                if (session.published + queued[session]) % session.window_size == 0:
+                    pipe.incr(session.version_key)
+
+                touched[session.session_id] = timestamp
+
+            # Keep the session registry up to date for consumers
+            if touched:
+                pipe.hset(config.REDIS_SESSIONS_KEY, mapping=touched)
+
+            try:
+                await pipe.execute()
+            except redis.RedisError as e:
+                # The frames are lost, but the control messages are retried
+                self.dropped += count
+                self.controls.extendleft(reversed(controls))
+                self.logger.error(f"Redis write failed, dropped {count} frames: {e}")
+                continue
+
+            for session, n in queued.items():
+                session.published += n
+            if oldest is not None:
+                self.publish_latency.record_since(oldest)
+
+    async def _housekeeping(self) -> None:
+        """Expire sessions that have gone quiet, publish each session's link
+        statistics, and pick up any per-session run mode changes made through
+        Redis"""
+        while True:
+            await asyncio.sleep(SESSION_CHECK_INTERVAL)
+            now = time.monotonic()
+
+            for addr, session in list(self.sessions.items()):
+                if now - session.last_seen > config.LUME_SESSION_TIMEOUT:
+                    self.logger.warning(f"Controller session {session.session_id} timed out")
+                    self.set_recording(session, False)
+                    del self.sessions[addr]
+                    try:
+                        await self.redisconn.hdel(config.REDIS_SESSIONS_KEY, session.session_id)
+                    except redis.RedisError as e:
+                        self.logger.error(f"Redis write failed: {e}")
+
+            sessions = list(self.sessions.values())
+            if sessions:
+                # Publish the rolling link statistics for every live session
+                # and fetch their run modes in the same round trip
+                pipe = self.redisconn.pipeline(transaction=False)
+                for session in sessions:
+                    pipe.hset(session.link_stats_key, mapping=session.link_stats.snapshot())
+                pipe.mget([s.mode_key for s in sessions])
+
+                try:
+                    modes = (await pipe.execute())[-1]
+                except redis.RedisError as e:
+                    self.logger.error(f"Redis read failed: {e}")
+                    continue
+
+                for session, mode in zip(sessions, modes):
+                    mode = mode.decode('utf-8').lower() if mode is not None else config.LUME_RUN_MODE
+                    if mode != session.mode:
+                        self.logger.info(f"Session {session.session_id} switched to {mode} mode")
+                        session.set_mode(mode)
+
+            summary = self.publish_latency.format_summary()
+            if summary is not None:
+                self.logger.debug(f"{summary}, {len(self.sessions)} sessions, {self.dropped} dropped")
+
+    async def serve(self) -> None:
+        """Bind the UDP endpoint and run until cancelled"""
+        loop = asyncio.get_running_loop()
+        self.pending_event = asyncio.Event()
+
+        transport, _ = await loop.create_datagram_endpoint(
+            lambda: IngestProtocol(self), local_addr=("0.0.0.0", self.port))
+        self.logger.info(f"Async UDP ingest server initialized on port {self.port}")
+
+        # Set the variable to record gestures as false, and tell any recorder
+        pipe = self.redisconn.pipeline(transaction=False)
+        pipe.set(config.REDIS_RECORD_VARIABLE, 0)
+        pipe.publish(config.REDIS_SENSORS_CHANNEL, pack_record_control(False, time.time()))
+        await pipe.execute()
+
+        tasks = [asyncio.create_task(self._writer()), asyncio.create_task(self._housekeeping())]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+            transport.close()
+            self.logger.info("Socket closed")
+            if self.capture is not None:
+                self.capture.close()
+                self.logger.info(f"Capture saved to {self.capture.path}")
+
+    def run(self) -> None:
+        """Run the ingest server until interrupted"""
+        try:
+            asyncio.run(self.serve())
+        except KeyboardInterrupt:
+            self.logger.warning("Received keyboard interrupt, shutting down...")
@@ -7,18 +7,24 @@ import socket
 import time
 import logging
 import sys
-import struct
 import redis
 
 from shared.lume_logger import *
 from shared.config import config
-from typing import Tuple, Optional, List
+from shared.metrics import LatencyTracker, LinkStats, read_udp_drops
+from shared.frames import (CONTROL_SIGNAL_LENGTH, STREAM_PAYLOAD_FIELD, STREAM_TIMESTAMP_FIELD,
+                           SENSOR_CHANNELS, SENSOR_FRAME_STRUCT, SEQUENCED_FRAME_SIZE, FrameRing)
+from shared.shm_ring import SharedFrameRing
+from shared.capture import open_capture
+from shared.packer import pack_record_control
+from typing import Optional, List
 
 REDIS_SENSORS_CHANNELS = ['pitch', 'roll', 'yaw', 'd_pitch', 'd_roll', 'd_yaw',
                           'acc_x', 'acc_y', 'acc_z', 'gy_x', 'gy_y', 'gy_z',
                           'flex0', 'flex1', 'flex2']
 
-CONTROL_SIGNAL_LENGTH = 5  # 5 bytes, consisting of LUME and then a number
+# Returned by receive_data() in place of a ring index for control signals
+CONTROL_PACKET = -1
 
 # Custom exception for receiving invalid control commands from the controller
 class InvalidControlCommand(Exception):
@@ -45,14 +51,61 @@ class LumeServer:
         self._setup_colored_logging(verbose)
 
         # Set the variable to record gestures as false
-        self.redisconn.set(config.REDIS_RECORD_VARIABLE, 0)
+        self.set_recording(False)
+
+        # Time from a packet leaving recvfrom() to its frame landing in Redis
+        self.publish_latency = LatencyTracker("packet-to-redis latency")
+        self.last_received_at = 0.0
+
+        # Every datagram is received straight into this preallocated ring, and
+        # sensor frames are decoded in place into its float32 window array
+        self.ring = FrameRing(self.window_size)
+        self.last_control = 0
+
+        # When colocated with the post-processor, decoded frames go through
+        # shared memory and Redis is only used for control variables
+        self.shm_ring = None
+        if config.LUME_TRANSPORT == "shm":
+            capacity = max(config.LUME_SHM_RING_CAPACITY, 2 * self.window_size)
+            self.shm_ring = SharedFrameRing.create(config.LUME_SHM_NAME, capacity, len(SENSOR_CHANNELS))
+            self.logger.info(f"Publishing frames to shared memory ring {config.LUME_SHM_NAME} ({capacity} frames)")
+
+        # Optionally record every datagram received, for later replay
+        self.capture = None
+        if config.LUME_CAPTURE_DIR:
+            self.capture = open_capture(config.LUME_CAPTURE_DIR)
+            self.logger.info(f"Capturing raw UDP session to {self.capture.path}")
+
+        # Pipelines reset themselves after execute(), so one can be reused
+        self.pipe = self.redisconn.pipeline(transaction=False)
+        self.pub_counter = 0
+
+        # Ring indices of the frames picked up in the current wakeup. A batch
+        # is kept one short of the ring so it can never overwrite itself
+        self.batch = [0] * self.ring.capacity
+        self.max_batch = max(1, self.ring.capacity - 1)
+
+        # Drain mode counters: wakeups, frames and the largest batch seen since
+        # the last report
+        self.wakeups = 0
+        self.frames_received = 0
+        self.largest_batch = 0
+
+        # Rate, jitter and (for sequenced frames) loss for the controller
+        self.link_stats = LinkStats(config.LUME_SAMPLING_RATE)
         
         # Initialize socket
         try:
             self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            self.sock.settimeout(3)  # 3 second timeout
+            if config.LUME_UDP_RCVBUF > 0:
+                self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, config.LUME_UDP_RCVBUF)
+            self.sock.settimeout(3)  # 3 second timeout, restored after every drain
             self.sock.bind(("0.0.0.0", self.port))
-            self.logger.info(f"UDP server initialized on port {self.port}")
+            rcvbuf = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+            self.logger.info(f"UDP server initialized on port {self.port} (receive buffer {rcvbuf} bytes)")
+
+            # The kernel's drop count for our socket, which only exists once bound
+            self.kernel_drops = read_udp_drops(self.port)
         except socket.error as e:
             self.logger.error(f"Socket initialization failed: {e}")
             sys.exit(1)
@@ -81,6 +134,16 @@ class LumeServer:
         if not COLORS_AVAILABLE:
             self.logger.warning("colorama not installed. For colored logs, install with: pip install colorama")
     
+    def set_recording(self, recording: bool) -> None:
+        """Start or stop recording a gesture. The control variable is kept for
+        anything that polls it, and a control message is published in band
+        on the sensors channel, stamped with the current time so that the
+        recorder can cut the gesture at exactly this point"""
+        pipe = self.redisconn.pipeline(transaction=False)
+        pipe.set(config.REDIS_RECORD_VARIABLE, int(recording))
+        pipe.publish(config.REDIS_SENSORS_CHANNEL, pack_record_control(recording, time.time()))
+        pipe.execute()
+
     def unpack(self, data: bytes) -> List[float]:
         """Decode bitpacked binary data into a list of floats.
         
@@ -94,7 +157,7 @@ class LumeServer:
 
         if len(data) == payload_size:
             # Unpack 12 floats (IEEE 754 format, network byte order)
-            *floats, control = struct.unpack('<12fB', data)
+            *floats, control = SENSOR_FRAME_STRUCT.unpack(data)
 
             # Extract the booleans for flex sensors from the last byte
             flex0 = bool(control & 0b10000000)
@@ -110,7 +173,7 @@ class LumeServer:
         elif len(data) > payload_size:
             self.logger.warning(f"Received more data than expected: {len(data)} bytes")
             # Still try to parse the first 12 floats
-            return list(struct.unpack('<12f', data[:payload_size]))
+            return list(SENSOR_FRAME_STRUCT.unpack_from(data)[:12])
         elif len(data) == CONTROL_SIGNAL_LENGTH:
             return 
         else:
@@ -147,55 +210,168 @@ class LumeServer:
             self.logger.warning("Connection timed out during polling")
             return False
     
-    def receive_data(self) -> Optional[Tuple[List[float], Tuple[str, int]]]:
-        """Receive a UDP packet with float data.
-        
+    def _accept(self, nbytes: int, arrival: Optional[float]) -> Optional[int]:
+        """Classify a datagram that has just been received into the next ring
+        slot, decoding it in place if it is a sensor frame. `arrival` is when
+        it was received (a time.perf_counter() value), or None if it was
+        drained from the socket buffer, where it may have waited for a while
+
         Returns:
-            Tuple of (float_values, address) if successful, None otherwise
+            The ring index of the frame for sensor data, CONTROL_PACKET for a
+            control signal (stored in self.last_control), or None otherwise
         """
-        try:
-            data, addr = self.sock.recvfrom(1024)
-            if len(data) == config.LUME_SENSOR_PAYLOAD_SIZE:
-                values = self.unpack(data)
-                if values:
-                    return values, addr
-                else:
-                    return None
-
-            # Not the best way of doing this but we mimic the return type this
-            # way, dictating which control signal was received. 
-            elif len(data) == CONTROL_SIGNAL_LENGTH:
-                command_str = data.decode('utf-8')
-                if command_str[-1] == "0":
-                    return [0.0], addr
-                elif command_str[-1] == "1":
-                    return [1.0], addr
-                elif command_str[-1] == "2":
-                    return [2.0], addr
-                elif command_str[-1] == "3":
-                    return [3.0], addr
-                else:
-                    self.logger.warning(f"Invalid control command << {command_str} >> received!")
-                    raise(InvalidControlCommand)
+        timestamp = time.time()
+        if self.capture is not None:
+            self.capture.write(timestamp, self.ring.next_slot()[:nbytes])
+
+        if nbytes == config.LUME_SENSOR_PAYLOAD_SIZE or nbytes == SEQUENCED_FRAME_SIZE:
+            index = self.ring.commit(nbytes, timestamp)
+            self.link_stats.record(arrival, self.ring.sequence(index))
+            return index
+
+        # Control signals are rare, so there is no need to avoid
+        # allocating here
+        elif nbytes == CONTROL_SIGNAL_LENGTH:
+            command_str = bytes(self.ring.next_slot()[:nbytes]).decode('utf-8')
+            if command_str[-1] in "0123":
+                self.last_control = int(command_str[-1])
+                return CONTROL_PACKET
             else:
-                return None
-            
+                self.logger.warning(f"Invalid control command << {command_str} >> received!")
+                raise(InvalidControlCommand)
+        else:
+            return None
+
+    def receive_data(self) -> Optional[int]:
+        """Receive a UDP packet straight into the next slot of the frame ring.
+
+        Sensor frames are decoded in place into the ring's window array, so
+        nothing is allocated per packet.
+
+        Returns:
+            The ring index of the frame for sensor data, CONTROL_PACKET for a
+            control signal (stored in self.last_control), or None otherwise
+        """
+        try:
+            nbytes = self.sock.recv_into(self.ring.next_slot())
+            self.last_received_at = time.perf_counter()
+            return self._accept(nbytes, self.last_received_at)
                             
         except (socket.timeout, TimeoutError):
             self.logger.warning("Receive operation timed out")
             return None
 
-    def publish_sensor_data(self, data): 
-        """Publish the filtered sensor data onto the respective Redis channels
-        so that it can be post-processed"""
+    def drain(self, count: int) -> int:
+        """Pull every datagram already queued on the socket, without blocking,
+        appending the sensor frames onto self.batch after the first `count`.
+        Control signals picked up along the way are logged and dropped.
+        There is no telling when these frames actually arrived, so they are
+        left out of the link jitter.
 
-        for i in range(len(data)):
-            queue = REDIS_SENSORS_CHANNELS[i]
-            content = (float(data[i] == 1.0) if (queue in ["flex0","flex1","flex2"]) else data[i])
-            
-            self.logger.debug(f"Publishing {content} to {queue}")
-            self.redisconn.lpush(queue, content)
-            self.redisconn.ltrim(queue, 0, self.window_size - 1)
+        Returns:
+            The new number of frames in self.batch
+        """
+        timeout = self.sock.gettimeout()
+        self.sock.setblocking(False)
+
+        try:
+            while count < self.max_batch:
+                try:
+                    result = self._accept(self.sock.recv_into(self.ring.next_slot()), None)
+                except BlockingIOError:
+                    break
+                except InvalidControlCommand:
+                    continue
+
+                if result is None:
+                    continue
+                elif result == CONTROL_PACKET:
+                    self.logger.info(f"Received control signal: {self.last_control}")
+                else:
+                    self.batch[count] = result
+                    count += 1
+        finally:
+            self.sock.settimeout(timeout)
+
+        return count
+
+    def _queue_frame(self, target, index: int) -> None:
+        """Queue a single frame from the ring for publishing, plus the window
+        version bump if it completes a new full window of data. With the
+        shared memory transport the frame itself is written straight away"""
+        if self.shm_ring is not None:
+            self.shm_ring.write(self.ring.rows[index], self.ring.timestamps[index])
+        else:
+            target.xadd(config.REDIS_FRAMES_STREAM,
+                        {STREAM_PAYLOAD_FIELD: self.ring.payload(index),
+                         STREAM_TIMESTAMP_FIELD: repr(self.ring.timestamps[index])},
+                        maxlen=self.window_size, approximate=True)
+
+        self.pub_counter += 1
+        if self.pub_counter % self.window_size == 0:
+            target.incr(config.REDIS_DATA_VERSION_CHANNEL)
+
+    def publish_sensor_data(self, index: int) -> None:
+        """Publish a single frame from the receive ring so that it can be
+        post-processed.
+
+        Each frame is a single stream entry holding the untouched '<12fB'
+        payload and its receipt timestamp. The stream is capped at roughly one
+        window with an approximate MAXLEN, so readers always see whole frames
+        in arrival order. The XADD (and the window version bump, if one is
+        due) are queued on a single pipeline, so the whole frame costs one
+        round trip. Set LUME_REDIS_PIPELINE=false to issue the commands one at
+        a time instead, for latency comparisons. With LUME_TRANSPORT=shm the
+        decoded frame goes into the shared memory ring instead.
+        """
+        self.batch[0] = index
+        self.publish_batch(1)
+
+    def publish_batch(self, count: int) -> None:
+        """Publish the first `count` frames in self.batch in a single round
+        trip (or one command at a time if LUME_REDIS_PIPELINE=false)"""
+
+        pipelined = config.LUME_REDIS_PIPELINE
+        target = self.pipe if pipelined else self.redisconn
+
+        for i in range(count):
+            self._queue_frame(target, self.batch[i])
+
+        if pipelined:
+            target.execute()
+
+    def report_stats(self) -> None:
+        """Log and publish the receive-side counters for the last period"""
+        drops = read_udp_drops(self.port)
+        new_drops = (drops - self.kernel_drops) if (drops is not None and self.kernel_drops is not None) else 0
+        self.kernel_drops = drops
+
+        mean_batch = self.frames_received / self.wakeups if self.wakeups else 0.0
+
+        latency = self.publish_latency.format_summary()
+        if latency is not None:
+            self.logger.info(latency)
+        self.logger.info(f"{self.frames_received} frames in {self.wakeups} wakeups "
+                         f"(mean {mean_batch:.2f}, max {self.largest_batch} per wakeup), "
+                         f"{new_drops} dropped by the kernel")
+
+        link = self.link_stats.snapshot()
+        self.logger.info(f"Link: {link['rate_hz']} Hz ({link['rate_ratio']} of nominal), "
+                         f"jitter {link['jitter_ms']}ms, {link['lost']} lost, {link['reordered']} reordered")
+        self.redisconn.hset(config.REDIS_LINK_STATS_KEY, mapping=link)
+
+        self.redisconn.hset(config.REDIS_INGEST_STATS_KEY, mapping={
+            'wakeups': self.wakeups,
+            'frames': self.frames_received,
+            'mean_frames_per_wakeup': mean_batch,
+            'max_frames_per_wakeup': self.largest_batch,
+            'kernel_drops': new_drops,
+            'kernel_drops_total': drops if drops is not None else -1,
+        })
+
+        self.wakeups = 0
+        self.frames_received = 0
+        self.largest_batch = 0
 
     def run(self, device_ip: str, polling_interval: float = 2.0):
         """Run the UDP server main loop.
@@ -222,7 +398,7 @@ class LumeServer:
                 # Process incoming data until connection is lost
                 self.logger.debug("Entering data reception mode")
                 old_recording = False
-                pub_counter = 0
+                self.pub_counter = 0
 
                 while True:
                     try:
@@ -242,14 +418,27 @@ class LumeServer:
                     if recording and not old_recording:
                         self.logger.info("Recording gesture...")
                         # Enable recording
-                        self.redisconn.set(config.REDIS_RECORD_VARIABLE, 1)
+                        self.set_recording(True)
                     if not recording and old_recording:
                         self.logger.info("Processing gesture...")
                         # Disable recording
-                        self.redisconn.set(config.REDIS_RECORD_VARIABLE, 0)
+                        self.set_recording(False)
 
                     old_recording = recording
-                    values, _ = result
+
+                    if result == CONTROL_PACKET:
+                        self.logger.info(f"Received control signal: {self.last_control}")
+                        continue
+
+                    # Having been woken up by one frame, pick up everything
+                    # else already sitting in the socket buffer so that it can
+                    # all go to Redis in one round trip
+                    self.batch[0] = result
+                    count = self.drain(1) if config.LUME_UDP_DRAIN else 1
+
+                    self.wakeups += 1
+                    self.frames_received += count
+                    self.largest_batch = max(self.largest_batch, count)
                     
                     # If the system is running in deployment mode, publish the
                     # sensor data regardless. Else, only publish while the
@@ -258,18 +447,17 @@ class LumeServer:
                     # TODO: shift key is deprecated as of dockerising, this
                     # will be replaced by a redis variable set by the frontend. 
 
-                    if len(values) == config.LUME_SENSOR_PAYLOAD_SIZE:
-                        if recording or run_mode == "deploy": 
-                            self.publish_sensor_data(values)
-                    elif len(values) == 1:
-                        self.logger.info(f"Received control signal: {values[0]}")
+                    if recording or run_mode == "deploy": 
+                        self.publish_batch(count)
+                        self.publish_latency.record_since(self.last_received_at)
 
-                    self.logger.debug(f"{log_colour}Received values {values} {Style.RESET_ALL}")
+                    # Reported by frames received rather than published, so
+                    # that the link can be checked before anything is recorded
+                    if self.frames_received >= config.LUME_LATENCY_REPORT_INTERVAL:
+                        self.report_stats()
 
-                    # Publish values and update the version counter if new full window of data
-                    pub_counter += 1
-                    if (pub_counter % self.window_size == 0):
-                        self.redisconn.incr(config.REDIS_DATA_VERSION_CHANNEL)
+                    if self.logger.isEnabledFor(logging.DEBUG):
+                        self.logger.debug(f"{log_colour}Received values {self.ring.window[self.batch[count - 1]]} {Style.RESET_ALL}")
                         
         except KeyboardInterrupt:
             self.logger.warning("Received keyboard interrupt, shutting down...")
@@ -277,13 +465,30 @@ class LumeServer:
             if hasattr(self, 'sock') and self.sock:
                 self.sock.close()
                 self.logger.info("Socket closed")
+            if self.shm_ring is not None:
+                self.shm_ring.close()
+            if self.capture is not None:
+                self.capture.close()
+                self.logger.info(f"Capture saved to {self.capture.path}")
 
 if __name__ == "__main__":
-    
-    redisconn = redis.Redis(host=config.REDIS_HOST, port=config.REDIS_PORT, db=0, decode_responses=False)
 
-    endpoint = LumeServer(port=config.LUME_UDP_PORT, redisconn=redisconn,
-                          verbose=config.LUME_VERBOSE)
+    if config.LUME_INGEST_MODE == "async":
+        # Serve any number of controllers from a single event loop
+        import redis.asyncio
+        from ingest import AsyncLumeServer
+
+        redisconn = redis.asyncio.Redis(host=config.REDIS_HOST, port=config.REDIS_PORT, db=0, decode_responses=False)
+
+        endpoint = AsyncLumeServer(port=config.LUME_UDP_PORT, redisconn=redisconn,
+                                   verbose=config.LUME_VERBOSE)
+
+        endpoint.run()
+
+    else:
+        redisconn = redis.Redis(host=config.REDIS_HOST, port=config.REDIS_PORT, db=0, decode_responses=False)
 
-    endpoint.run(device_ip=config.LUME_CONTROLLER_IP)
+        endpoint = LumeServer(port=config.LUME_UDP_PORT, redisconn=redisconn,
+                              verbose=config.LUME_VERBOSE)
 
+        endpoint.run(device_ip=config.LUME_CONTROLLER_IP)